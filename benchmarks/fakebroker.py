@@ -0,0 +1,204 @@
+'''In-memory stand-in for the data broker used by the benchmarks.
+
+FakeBroker keeps synthetic runs with the same document layout as the XPD
+runs in metadatastore and serves lazy image sequences in place of filestore,
+so xpdacquire functions can be timed without a beamline.  install()
+registers the broker with xpdacquire.devices.
+'''
+
+import time
+import uuid
+
+import numpy as np
+
+
+PE1_SHAPE = (2048, 2048)
+
+
+class Document(dict):
+    '''Dictionary with attribute access like metadatastore documents.'''
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FrameSequence(object):
+    '''Lazy sequence of synthetic detector frames, made when accessed.
+    '''
+
+    def __init__(self, nframes, shape=PE1_SHAPE, seed=0):
+        self.nframes = nframes
+        self.shape = shape
+        rng = np.random.RandomState(seed)
+        self._base = rng.poisson(1000, size=shape).astype(np.uint16)
+        return
+
+
+    def __len__(self):
+        return self.nframes
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.nframes))]
+        if i < 0:
+            i += self.nframes
+        if not 0 <= i < self.nframes:
+            raise IndexError('frame index out of range')
+        return self._base + np.uint16(i % 16)
+
+
+    def __iter__(self):
+        for i in range(self.nframes):
+            yield self[i]
+
+# class FrameSequence
+
+
+class FakeBroker(object):
+    '''Minimal DataBroker with db[-1], db[uid] and db(**query) lookups.
+    '''
+
+    def __init__(self, shape=PE1_SHAPE):
+        self.shape = shape
+        self.headers = []
+        self._by_uid = {}
+        return
+
+
+    def add_run(self, nframes=1, scan_type='Count', acquire_time=0.2,
+                isdark=False, motor=None, start_time=None, **md):
+        '''Add a run of nframes synthetic frames and return its header.
+
+        motor    -- name of the scanned motor for motor scans, its
+                    positions are 0, 1, 2, ...
+        md       -- additional run-start metadata
+        '''
+        if start_time is None:
+            start_time = time.time()
+        uid = str(uuid.uuid4())
+        start = Document(group='XPD', owner='xf28id1', beamline_id='xpd',
+                         sample_name='Ni', experimenters=['bench'],
+                         comments='benchmark run')
+        start.update(md)
+        start.update(uid=uid, time=start_time, scan_type=scan_type, isdark=int(isdark))
+        if motor is not None:
+            start['motor'] = motor
+        data_keys = {'pe1_image_lightfield' : {'source' : 'PV:pe1', 'shape' : list(self.shape)},
+                     'pe1_acquire_time' : {'source' : 'PV:pe1'}}
+        if motor is not None:
+            data_keys[motor] = {'source' : 'PV:' + motor}
+        descriptor = Document(uid=str(uuid.uuid4()), run_start=uid,
+                              time=start_time, data_keys=data_keys)
+        events = []
+        for i in range(nframes):
+            t = start_time + (i + 1) * acquire_time
+            data = {'pe1_image_lightfield' : 'datum-%s-%i' % (uid, i),
+                    'pe1_acquire_time' : acquire_time}
+            if motor is not None:
+                data[motor] = float(i)
+            events.append(Document(seq_num=i + 1, time=t, descriptor=descriptor,
+                                   data=data, timestamps=dict((k, t) for k in data)))
+        stop_time = start_time + (nframes + 1) * acquire_time
+        stop = Document(uid=str(uuid.uuid4()), run_start=uid, time=stop_time,
+                        exit_status='success')
+        header = Document(start=start, stop=stop, descriptors=[descriptor])
+        header['_events'] = events
+        header['_frames'] = FrameSequence(nframes, self.shape, seed=len(self.headers))
+        self.headers.append(header)
+        self._by_uid[uid] = header
+        return header
+
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.headers[key]
+        try:
+            return self._by_uid[key]
+        except KeyError:
+            matches = [h for u, h in self._by_uid.items() if u.startswith(key)]
+            if len(matches) != 1:
+                raise KeyError(key)
+            return matches[0]
+
+
+    def __call__(self, start_time=None, stop_time=None, **query):
+        t0 = _timestamp(start_time) if start_time is not None else None
+        t1 = _timestamp(stop_time) if stop_time is not None else None
+        rv = []
+        for h in self.headers:
+            t = h.start.time
+            if t0 is not None and t < t0:
+                continue
+            if t1 is not None and t > t1:
+                continue
+            if _match(h.start, query):
+                rv.append(h)
+        return rv
+
+
+    def get_images(self, header, field):
+        return header['_frames']
+
+
+    def get_events(self, headers, fill=True):
+        if isinstance(headers, dict):
+            headers = [headers]
+        for h in headers:
+            for event in h['_events']:
+                if fill:
+                    event = Document(event)
+                    event['data'] = dict(event['data'])
+                    event['data']['pe1_image_lightfield'] = h['_frames'][event.seq_num - 1]
+                yield event
+
+# class FakeBroker
+
+
+def _timestamp(value):
+    if isinstance(value, str):
+        import datetime
+        value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    if hasattr(value, 'timetuple'):
+        return time.mktime(value.timetuple())
+    return float(value)
+
+
+def _match(start, query):
+    for k, v in query.items():
+        if k == '$or':
+            if not any(_match(start, q) for q in v):
+                return False
+        elif _lookup(start, k) != v:
+            return False
+    return True
+
+
+def _lookup(d, keychain):
+    for k in keychain.split('.'):
+        if not isinstance(d, dict) or k not in d:
+            return None
+        d = d[k]
+    return d
+
+
+class FakeGlobalState(object):
+    '''Global state with a run engine metadata dictionary only.'''
+
+    def __init__(self):
+        self.RE = Document(md={})
+        return
+
+
+def install(broker):
+    '''Register broker and a fake global state with xpdacquire.devices.
+    '''
+    from xpdacquire import devices
+    devices.register('db', broker)
+    devices.register('get_images', broker.get_images)
+    devices.register('get_events', broker.get_events)
+    devices.register('gs', FakeGlobalState())
+    return
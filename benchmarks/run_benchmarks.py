@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+'''Benchmark the acquisition-to-TIFF pipeline against a simulated broker.
+
+Every stage runs in a fresh process, so that peak RSS belongs to the stage
+alone, with datapath.base pointing to a temporary folder.  Results are
+printed as a table and can be saved as JSON and compared with an earlier
+result file:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --compare before.json
+
+For save_tif stages the size is the number of frames in the run, for the
+other stages it is the number of runs in the broker.  The largest per-frame
+stages write several GB at the full PE1 frame size, use --shape 512 512 for
+a quick run.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHDIR)
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+STAGES = ('save_tif_sum', 'save_tif_frames', 'save_tif_motor',
+          'find_dark', 'time_search', 'table_gen')
+SIZES = (1, 10, 100, 1000)
+ACQUIRE_TIME = 0.2
+
+
+def _folder_bytes(path):
+    rv = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                rv += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                pass
+    return rv
+
+
+def _setup(stage, size, shape):
+    '''Build the broker for stage and return the callable to time.
+    '''
+    import datetime
+    import fakebroker
+    from xpdacquire.catalog import run_catalog
+    broker = fakebroker.FakeBroker(shape)
+    fakebroker.install(broker)
+    import xpdacquire.xpdacquirefuncs as xf
+    catalog = run_catalog()
+
+    dark = broker.add_run(nframes=5, acquire_time=ACQUIRE_TIME, isdark=True)
+    catalog.record_header(dark, ACQUIRE_TIME)
+
+    if stage.startswith('save_tif'):
+        for d in (xf.W_DIR, xf.D_DIR):
+            os.makedirs(d, exist_ok=True)
+        if stage == 'save_tif_motor':
+            h = broker.add_run(nframes=size, scan_type='ascan',
+                               acquire_time=ACQUIRE_TIME, motor='cs700')
+        else:
+            h = broker.add_run(nframes=size, acquire_time=ACQUIRE_TIME)
+        sum_frames = stage == 'save_tif_sum'
+        return lambda: xf._save_header(h, sum_frames=sum_frames, plot=False)
+
+    # runs spread over the last hours of today
+    midnight = time.mktime(datetime.date.today().timetuple())
+    now = time.time()
+    for i in range(size):
+        t = midnight + (now - midnight) * (i + 1) / (size + 1.)
+        h = broker.add_run(nframes=1, acquire_time=ACQUIRE_TIME,
+                           isdark=(stage == 'find_dark'), start_time=t)
+        if stage == 'find_dark':
+            catalog.record_header(h, ACQUIRE_TIME + 1 + i)
+    if stage == 'find_dark':
+        return lambda: xf.find_dark(ACQUIRE_TIME)
+    if stage == 'time_search':
+        from xpdacquire.xpd_search import time_search
+        return lambda: time_search(0, 23)
+    if stage == 'table_gen':
+        from xpdacquire.xpd_search import table_gen
+        headers = list(broker.headers)
+        return lambda: table_gen(headers)
+    raise ValueError('unknown stage %r' % stage)
+
+
+def _run_stage(stage, size, shape):
+    '''Run one stage in this process and return its measurements.
+    '''
+    base = tempfile.mkdtemp(prefix='xpdbench-')
+    from xpdacquire.config import datapath
+    datapath.base = base
+    rv = {'stage' : stage, 'size' : size, 'seconds' : None,
+          'peak_rss_mb' : None, 'bytes_written' : None, 'error' : ''}
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    try:
+        func = _setup(stage, size, shape)
+        before = _folder_bytes(base)
+        sys.stdout = devnull
+        t0 = time.time()
+        func()
+        rv['seconds'] = time.time() - t0
+        sys.stdout = stdout
+        rv['bytes_written'] = _folder_bytes(base) - before
+    except Exception as e:
+        sys.stdout = stdout
+        rv['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        devnull.close()
+        shutil.rmtree(base, ignore_errors=True)
+    rv['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    if sys.platform == 'darwin':
+        rv['peak_rss_mb'] /= 1024.
+    return rv
+
+
+def run(stages=STAGES, sizes=SIZES, shape=None):
+    '''Run all combinations of stages and sizes and return their results.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from fakebroker import PE1_SHAPE
+    shape = tuple(shape or PE1_SHAPE)
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for stage in stages:
+        for size in sizes:
+            with ProcessPoolExecutor(1, mp_context=ctx) as executor:
+                rv = executor.submit(_run_stage, stage, size, shape).result()
+            results.append(rv)
+            _print_row(rv)
+    return {'revision' : _revision(), 'python' : platform.python_version(),
+            'shape' : list(shape), 'time' : time.time(), 'results' : results}
+
+
+def _revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=BENCHDIR, stderr=subprocess.DEVNULL)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _print_row(rv, ref=None):
+    if rv['error']:
+        print('%-16s %6i  failed: %s' % (rv['stage'], rv['size'], rv['error']))
+        return
+    line = '%-16s %6i %10.3f s %9.1f MB %12i B' % (rv['stage'], rv['size'],
+            rv['seconds'], rv['peak_rss_mb'], rv['bytes_written'])
+    if ref is not None and not ref['error'] and ref['seconds']:
+        line += '   x%.2f time  x%.2f rss' % (rv['seconds'] / ref['seconds'],
+                rv['peak_rss_mb'] / ref['peak_rss_mb'])
+    print(line)
+
+
+def compare(current, reference):
+    '''Print current results with time and memory ratios to reference.
+    '''
+    refs = dict(((r['stage'], r['size']), r) for r in reference['results'])
+    print('compared with revision %s' % (reference.get('revision') or 'unknown'))
+    for rv in current['results']:
+        _print_row(rv, refs.get((rv['stage'], rv['size'])))
+    return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--shape', nargs=2, type=int, default=None,
+                        help='frame shape, default is the PE1 2048 x 2048')
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of earlier results')
+    args = parser.parse_args(argv)
+    current = run(args.stages, args.sizes, args.shape)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        compare(current, reference)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
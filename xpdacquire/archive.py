@@ -0,0 +1,310 @@
+'''Copy beamtime folders to the archive drive with checksums and resume.
+
+ArchiveJob copies every file of a set of source folders with a pool of
+threads, which keeps a networked drive busy, and computes the SHA-256 of
+each file while it is copied.  Every finished file is appended to a
+manifest in the archive folder, so an interrupted archive continues where
+it stopped.  Copies are verified against the manifest by hashing them
+again, and a source file is deleted only after its copy was verified.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+
+MANIFEST_NAME = 'xpd_archive_manifest.jsonl'
+CHUNK_SIZE = 4 * 2**20
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE, progress=None):
+    '''Return the hex SHA-256 digest of the file at path.
+
+    progress is called with the number of bytes of every read chunk.
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+            if progress is not None:
+                progress(len(chunk))
+    return h.hexdigest()
+
+
+def copy_with_sha256(src, dst, chunk_size=CHUNK_SIZE, progress=None):
+    '''Copy src to dst and return the SHA-256 of the copied data.
+
+    The data go to a temporary file next to dst, which is renamed to dst
+    only when it is complete.  progress is called with the number of bytes
+    of every written chunk.
+    '''
+    d = os.path.dirname(dst)
+    if d and not os.path.isdir(d):
+        os.makedirs(d, exist_ok=True)
+    tmp = dst + '.part'
+    h = hashlib.sha256()
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            h.update(chunk)
+            fout.write(chunk)
+            if progress is not None:
+                progress(len(chunk))
+        fout.flush()
+        os.fsync(fout.fileno())
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+    return h.hexdigest()
+
+
+class Progress(object):
+    '''Thread-safe byte counter that prints throughput and time left.
+
+    total    -- number of bytes expected
+    label    -- text in front of the progress line
+    interval -- least seconds between printed lines
+    '''
+
+    def __init__(self, total, label='', interval=1.0):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self._t0 = time.time()
+        self._last = 0.
+        self._lock = threading.Lock()
+        return
+
+
+    def __call__(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+        return
+
+
+    def line(self):
+        '''Return the current progress as a line of text.
+        '''
+        elapsed = max(time.time() - self._t0, 1e-6)
+        rate = self.done / elapsed
+        if rate > 0:
+            eta = '%.0f s left' % (max(self.total - self.done, 0) / rate)
+        else:
+            eta = '-- s left'
+        pct = 100. * self.done / self.total if self.total else 100.
+        return '%s %5.1f%% %.1f of %.1f MB, %.1f MB/s, %s' % (
+            self.label, pct, self.done / 1e6, self.total / 1e6, rate / 1e6, eta)
+
+
+    def show(self, force=False):
+        '''Print the progress line when interval has passed since the last one.
+        '''
+        now = time.time()
+        if force or now - self._last >= self.interval:
+            self._last = now
+            sys.stdout.write('\r' + self.line().ljust(79))
+            sys.stdout.flush()
+        return
+
+# class Progress
+
+
+class ArchiveJob(object):
+    '''Copy, verify and optionally delete a set of folders.
+
+    folders  -- list of (source, destination) folder pairs
+    manifest -- path of the manifest file.  Entries already in the
+                manifest whose source is unchanged are not copied again.
+    workers  -- number of copy threads.  Network drives reach their
+                throughput only with several files in flight.
+    chunk_size -- bytes read and hashed at a time
+    '''
+
+    def __init__(self, folders, manifest, workers=8, chunk_size=CHUNK_SIZE):
+        self.folders = list(folders)
+        self.manifest = manifest
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        return
+
+
+    def plan(self):
+        '''Return a list of (source, destination, size) of all files to archive.
+        '''
+        rv = []
+        for src_dir, dst_dir in self.folders:
+            for root, dirs, files in os.walk(src_dir):
+                dirs.sort()
+                rel = os.path.relpath(root, src_dir)
+                for fn in sorted(files):
+                    src = os.path.join(root, fn)
+                    if os.path.islink(src) or not os.path.isfile(src):
+                        continue
+                    dst = os.path.normpath(os.path.join(dst_dir, rel, fn))
+                    rv.append((src, dst, os.path.getsize(src)))
+        return rv
+
+
+    def load_manifest(self):
+        '''Return a dictionary of the manifest entries keyed by source path.
+
+        A line that was cut off by an interruption is ignored.
+        '''
+        rv = {}
+        if not os.path.isfile(self.manifest):
+            return rv
+        with open(self.manifest) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                rv[entry['src']] = entry
+        return rv
+
+
+    def _record(self, entry):
+        with self._lock:
+            with open(self.manifest, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        return
+
+
+    @staticmethod
+    def _is_done(entry, src, dst, size):
+        if entry is None or entry['dst'] != dst:
+            return False
+        if entry['size'] != size or entry['mtime'] != os.path.getmtime(src):
+            return False
+        return os.path.isfile(dst) and os.path.getsize(dst) == size
+
+
+    def _copy(self, src, dst, size, progress):
+        mtime = os.path.getmtime(src)
+        sha = copy_with_sha256(src, dst, self.chunk_size, progress)
+        entry = {'src' : src, 'dst' : dst, 'size' : size,
+                 'mtime' : mtime, 'sha256' : sha}
+        self._record(entry)
+        return entry
+
+
+    def _wait(self, futures, progress):
+        from concurrent.futures import wait, FIRST_COMPLETED
+        if not futures:
+            return
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=progress.interval,
+                                 return_when=FIRST_COMPLETED)
+            progress.show()
+        progress.show(force=True)
+        print('')
+        return
+
+
+    def copy(self):
+        '''Copy all files that are not in the manifest yet.
+
+        Returns a tuple of the manifest entries of all files and a list of
+        (source, error) of files that could not be copied.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        files = self.plan()
+        d = os.path.dirname(self.manifest)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+        done = self.load_manifest()
+        entries = []
+        todo = []
+        for src, dst, size in files:
+            entry = done.get(src)
+            if self._is_done(entry, src, dst, size):
+                entries.append(entry)
+            else:
+                todo.append((src, dst, size))
+        if entries:
+            print('%i files were archived before, resuming with %i files' % (len(entries), len(todo)))
+        progress = Progress(sum(el[2] for el in todo), 'copy')
+        failed = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = dict((executor.submit(self._copy, src, dst, size, progress), src)
+                           for src, dst, size in todo)
+            self._wait(futures, progress)
+        for f, src in futures.items():
+            try:
+                entries.append(f.result())
+            except (IOError, OSError) as e:
+                failed.append((src, str(e)))
+        return entries, failed
+
+
+    def verify(self, entries):
+        '''Hash the archived copies again and return a list of (source, error) that differ.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        progress = Progress(sum(e['size'] for e in entries), 'verify')
+
+        def check(entry):
+            try:
+                if os.path.getsize(entry['dst']) != entry['size']:
+                    return 'size of copy differs'
+                if file_sha256(entry['dst'], self.chunk_size, progress) != entry['sha256']:
+                    return 'checksum of copy differs'
+            except (IOError, OSError) as e:
+                return str(e)
+            return None
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = dict((executor.submit(check, e), e['src']) for e in entries)
+            self._wait(futures, progress)
+        return [(src, f.result()) for f, src in futures.items() if f.result()]
+
+
+    def delete_sources(self, entries):
+        '''Delete the sources of verified entries and the emptied source folders.
+        '''
+        for entry in entries:
+            # skip files that were changed after they were copied
+            if os.path.isfile(entry['src']) and os.path.getmtime(entry['src']) == entry['mtime']:
+                os.remove(entry['src'])
+        for src_dir, dst_dir in self.folders:
+            for root, dirs, files in os.walk(src_dir, topdown=False):
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass # not empty
+        return
+
+
+    def run(self, delete=True):
+        '''Copy, verify and, when delete is True, remove the archived sources.
+
+        Returns a dictionary with the number of 'files' and 'bytes'
+        archived, the 'seconds' it took and a list of (source, error) of
+        'failed' files.  Sources are kept when any file failed.
+        '''
+        t0 = time.time()
+        entries, failed = self.copy()
+        bad = self.verify(entries)
+        failed += bad
+        if bad:
+            # copy the files again when the archive is resumed
+            bad_src = set(src for src, err in bad)
+            entries = [e for e in entries if e['src'] not in bad_src]
+            with self._lock:
+                with open(self.manifest, 'w') as f:
+                    for e in entries:
+                        f.write(json.dumps(e) + '\n')
+        if delete and not failed:
+            self.delete_sources(entries)
+        rv = {'files' : len(entries), 'bytes' : sum(e['size'] for e in entries),
+              'seconds' : time.time() - t0, 'failed' : failed}
+        return rv
+
+# class ArchiveJob
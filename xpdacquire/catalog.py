@@ -0,0 +1,484 @@
+'''Local SQLite catalog of runs collected at XPD.
+
+Every run is recorded when it finishes, together with the files written
+from it, so that questions like "latest dark with this exposure time" or
+"exposure time of this run" are answered by an indexed query instead of a
+round-trip to the data broker.  CatalogRecorder, subscribed once to the
+run engine, records every run the run engine executes.
+'''
+
+import os
+import time
+import sqlite3
+import threading
+
+import numpy as np
+
+from xpdacquire.config import datapath
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    uid TEXT PRIMARY KEY,
+    scan_type TEXT,
+    isdark INTEGER,
+    iscalib INTEGER,
+    acquire_time REAL,
+    sample_name TEXT,
+    start_time REAL,
+    stop_time REAL
+);
+CREATE INDEX IF NOT EXISTS runs_by_dark ON runs (isdark, acquire_time, stop_time);
+CREATE INDEX IF NOT EXISTS runs_by_start ON runs (start_time);
+CREATE TABLE IF NOT EXISTS files (
+    uid TEXT,
+    path TEXT,
+    UNIQUE (uid, path)
+);
+CREATE INDEX IF NOT EXISTS files_by_uid ON files (uid);
+CREATE TABLE IF NOT EXISTS dark_exposures (
+    uid TEXT,
+    acquire_time REAL,
+    frames INTEGER,
+    stop_time REAL,
+    UNIQUE (uid, acquire_time)
+);
+CREATE INDEX IF NOT EXISTS darks_by_time ON dark_exposures (acquire_time, stop_time);
+CREATE TABLE IF NOT EXISTS backfills (
+    t0 REAL,
+    t1 REAL
+);
+CREATE INDEX IF NOT EXISTS backfills_by_time ON backfills (t0, t1);
+CREATE TABLE IF NOT EXISTS reductions (
+    uid TEXT PRIMARY KEY,
+    method TEXT,
+    frames INTEGER,
+    rejected INTEGER,
+    nonfinite INTEGER,
+    masked INTEGER,
+    time REAL
+);
+'''
+
+_COLUMNS = ('uid', 'scan_type', 'isdark', 'iscalib', 'acquire_time',
+            'sample_name', 'start_time', 'stop_time')
+
+
+class RunCatalog(object):
+    '''Index of runs stored in an SQLite file.
+
+    path     -- location of the SQLite file, created on first use
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        return
+
+
+    @property
+    def conn(self):
+        '''Connection to the database of this thread, reopened in forked processes.'''
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            d = os.path.dirname(self.path)
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            local.conn = sqlite3.connect(self.path, timeout=30)
+            local.conn.row_factory = sqlite3.Row
+            local.conn.executescript(_SCHEMA)
+            local.pid = os.getpid()
+        return local.conn
+
+
+    def record_run(self, uid, scan_type=None, isdark=False, iscalib=False,
+                   acquire_time=None, sample_name=None, start_time=None,
+                   stop_time=None):
+        '''Add or update the catalog entry of a run.
+        '''
+        row = (uid, scan_type, int(bool(isdark)), int(bool(iscalib)),
+               acquire_time, sample_name, start_time, stop_time)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?,?,?)', row)
+        return
+
+
+    def record_header(self, header, acquire_time=None):
+        '''Add or update the catalog entry from a data broker header.
+
+        header   -- finished run from the data broker
+        acquire_time -- exposure time of the run if it is known
+        '''
+        try:
+            stop = header.stop
+        except (KeyError, AttributeError):
+            stop = None
+        self.record_documents(header.start, stop, acquire_time)
+        return
+
+
+    def record_documents(self, start, stop=None, acquire_time=None):
+        '''Add or update the catalog entry from run start and stop documents.
+
+        start    -- run start document
+        stop     -- run stop document, None while the run is acquired
+        acquire_time -- exposure time of the run if it is known
+        '''
+        try:
+            stop_time = stop['time']
+        except (KeyError, TypeError):
+            stop_time = None
+        iscalib = start.get('iscalibration', start.get('iscalib', False))
+        self.record_run(start['uid'], scan_type=start.get('scan_type'),
+                        isdark=start.get('isdark', False), iscalib=iscalib,
+                        acquire_time=acquire_time,
+                        sample_name=start.get('sample_name'),
+                        start_time=start.get('time'), stop_time=stop_time)
+        return
+
+
+    def add_files(self, uid, paths):
+        '''Remember files written from run uid.
+        '''
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO files VALUES (?,?)',
+                                  [(uid, p) for p in paths])
+        return
+
+
+    def files(self, uid):
+        '''Return a list of files written from run uid.
+        '''
+        cur = self.conn.execute('SELECT path FROM files WHERE uid = ?', (uid,))
+        return [r[0] for r in cur]
+
+
+    def record_reduction(self, uid, method, frames, rejected=0, nonfinite=0, masked=0):
+        '''Remember how the images of run uid were reduced.
+
+        method   -- how frames were combined, e.g., 'sigma_clip'
+        frames   -- number of frames reduced
+        rejected -- number of rejected outlier pixel values
+        nonfinite -- number of NaN or infinite pixel values
+        masked   -- number of pixels in the bad pixel mask
+        '''
+        row = (uid, method, int(frames), int(rejected), int(nonfinite), int(masked), time.time())
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO reductions VALUES (?,?,?,?,?,?,?)', row)
+        return
+
+
+    def reduction(self, uid):
+        '''Return the last recorded reduction of run uid as a dictionary or None.
+        '''
+        cur = self.conn.execute('SELECT * FROM reductions WHERE uid = ?', (uid,))
+        r = cur.fetchone()
+        return None if r is None else dict(r)
+
+
+    def get(self, uid):
+        '''Return the catalog entry of run uid as a dictionary or None.
+        '''
+        cur = self.conn.execute('SELECT * FROM runs WHERE uid = ?', (uid,))
+        r = cur.fetchone()
+        return None if r is None else dict(r)
+
+
+    def acquire_time(self, uid):
+        '''Return the recorded exposure time of run uid or None.
+        '''
+        r = self.get(uid)
+        return None if r is None else r['acquire_time']
+
+
+    def entries(self, uids):
+        '''Return a dictionary of the catalog entries of runs uids by uid.
+
+        Runs that are not in the catalog are left out.
+        '''
+        uids = list(uids)
+        rv = {}
+        # stay below the SQLite limit of 999 query parameters
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i+500]
+            cur = self.conn.execute(
+                'SELECT * FROM runs WHERE uid IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            rv.update((r['uid'], dict(r)) for r in cur)
+        return rv
+
+
+    def record_dark(self, uid, acquire_time, frames, stop_time=None):
+        '''Remember that dark run uid holds frames dark frames of acquire_time.
+
+        Dark runs with several exposure times are recorded once per exposure.
+        '''
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO dark_exposures VALUES (?,?,?,?)',
+                              (uid, acquire_time, int(frames), stop_time))
+        return
+
+
+    def dark_times(self):
+        '''Return a sorted list of the exposure times that have dark runs.
+        '''
+        cur = self.conn.execute(
+            'SELECT acquire_time FROM runs WHERE isdark = 1 AND acquire_time IS NOT NULL '
+            'UNION SELECT acquire_time FROM dark_exposures')
+        return sorted(r[0] for r in cur)
+
+
+    def has_dark(self, uid, acquire_time, tolerance=1e-6):
+        '''Return True when dark run uid is recorded with frames of acquire_time.
+        '''
+        cur = self.conn.execute(
+            'SELECT 1 FROM runs WHERE uid = ? AND isdark = 1 AND acquire_time BETWEEN ? AND ? '
+            'UNION ALL SELECT 1 FROM dark_exposures WHERE uid = ? AND acquire_time BETWEEN ? AND ? LIMIT 1',
+            (uid, acquire_time - tolerance, acquire_time + tolerance) * 2)
+        return cur.fetchone() is not None
+
+
+    def latest_dark(self, acquire_time, tolerance=1e-6):
+        '''Return uid of the most recent dark run with acquire_time or None.
+        '''
+        cur = self.conn.execute(
+            'SELECT uid, stop_time FROM runs WHERE isdark = 1 AND acquire_time BETWEEN ? AND ? '
+            'UNION ALL SELECT uid, stop_time FROM dark_exposures WHERE acquire_time BETWEEN ? AND ? '
+            'ORDER BY stop_time DESC LIMIT 1',
+            (acquire_time - tolerance, acquire_time + tolerance) * 2)
+        r = cur.fetchone()
+        return None if r is None else r[0]
+
+
+    def find(self, since=None, until=None, limit=None, **fields):
+        '''Return entries that match fields, most recent first.
+
+        since, until -- optional range of run start times as timestamps
+        limit    -- maximum number of returned entries
+        fields   -- exact values of catalog columns, e.g., isdark=True
+        '''
+        where = []
+        args = []
+        for k, v in fields.items():
+            if k not in _COLUMNS:
+                raise ValueError('%s is not a column of the run catalog' % k)
+            where.append('%s = ?' % k)
+            args.append(int(v) if isinstance(v, bool) else v)
+        if since is not None:
+            where.append('start_time >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('start_time <= ?')
+            args.append(until)
+        query = 'SELECT * FROM runs'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY start_time DESC'
+        if limit is not None:
+            query += ' LIMIT %i' % int(limit)
+        return [dict(r) for r in self.conn.execute(query, args)]
+
+
+    def record_backfill(self, t0, t1):
+        '''Remember that all runs started between timestamps t0 and t1 were read from the data broker.
+        '''
+        if t1 > t0:
+            with self.conn:
+                self.conn.execute('INSERT INTO backfills VALUES (?,?)', (t0, t1))
+        return
+
+
+    def missing(self, t0, t1):
+        '''Return a list of (t0, t1) parts of an interval that were never read from the data broker.
+        '''
+        cur = self.conn.execute('SELECT t0, t1 FROM backfills WHERE t1 >= ? AND t0 <= ? '
+                                'ORDER BY t0', (t0, t1))
+        rv = []
+        pos = t0
+        for a, b in cur:
+            if a > pos:
+                rv.append((pos, a))
+            pos = max(pos, b)
+            if pos >= t1:
+                break
+        if pos < t1:
+            rv.append((pos, t1))
+        return rv
+
+
+    def changes(self, after=0):
+        '''Return (rowid, uid, start_time, stop_time) of runs recorded after rowid after.
+
+        Updated entries get a new rowid, so they are returned again.
+        '''
+        cur = self.conn.execute('SELECT rowid, uid, start_time, stop_time FROM runs '
+                                'WHERE rowid > ? ORDER BY rowid', (after,))
+        return [tuple(r) for r in cur]
+
+# class RunCatalog
+
+
+class TimeIndex(object):
+    '''Sorted arrays of run start and stop times for fast range queries.
+
+    catalog  -- RunCatalog the index is read from.  Only entries added or
+                updated since the last refresh are read.
+    '''
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._rowid = 0
+        self._entries = {}
+        self._starts = np.empty(0)
+        self._stops = np.empty(0)
+        self._uids = np.empty(0, dtype=object)
+        self._dirty = False
+        return
+
+
+    def __len__(self):
+        self.refresh()
+        return len(self._entries)
+
+
+    def refresh(self):
+        '''Read new catalog entries and resort the arrays if needed.
+        '''
+        rows = self.catalog.changes(self._rowid)
+        for rowid, uid, start_time, stop_time in rows:
+            if start_time is not None:
+                self._entries[uid] = (start_time, stop_time)
+            self._rowid = max(self._rowid, rowid)
+        if rows:
+            self._dirty = True
+        if self._dirty:
+            uids = list(self._entries)
+            starts = np.array([self._entries[u][0] for u in uids], dtype=float)
+            # runs without stop time are still running
+            stops = np.array([np.inf if self._entries[u][1] is None else self._entries[u][1]
+                              for u in uids], dtype=float)
+            order = np.argsort(starts, kind='mergesort')
+            self._starts = starts[order]
+            self._stops = stops[order]
+            self._uids = np.array(uids, dtype=object)[order]
+            self._dirty = False
+        return
+
+
+    def between(self, t0, t1, overlap=False):
+        '''Return uids of runs started between timestamps t0 and t1, oldest first.
+
+        overlap  -- also return runs that started before t0 and were still
+                    running at t0
+        '''
+        self.refresh()
+        i1 = np.searchsorted(self._starts, t1, side='right')
+        if overlap:
+            mask = self._stops[:i1] >= t0
+            return list(self._uids[:i1][mask])
+        i0 = np.searchsorted(self._starts, t0, side='left')
+        return list(self._uids[i0:i1])
+
+# class TimeIndex
+
+
+class CatalogRecorder(object):
+    '''Run engine callback that records every run in run_catalog().
+
+    The run is recorded when it starts and again when it stops, with the
+    exposure time of its frames if all of them have the same one.
+    '''
+
+    def __init__(self):
+        self._start = None
+        self._fields = {}
+        self._times = set()
+        return
+
+
+    def __call__(self, name, doc):
+        try:
+            getattr(self, name, self._ignore)(doc)
+        except Exception as e:
+            # recording never interrupts the run, time_search reads the broker
+            print('Recording run in the catalog failed, %s: %s' % (type(e).__name__, e))
+        return
+
+
+    def _ignore(self, doc):
+        return
+
+
+    def start(self, doc):
+        self._start = doc
+        self._fields = {}
+        self._times = set()
+        run_catalog().record_documents(doc)
+        return
+
+
+    def descriptor(self, doc):
+        cnt = [k for k in doc['data_keys'] if k.endswith('acquire_time')]
+        if cnt:
+            self._fields[doc['uid']] = cnt[0]
+        return
+
+
+    def event(self, doc):
+        desc = doc['descriptor']
+        desc_uid = desc if isinstance(desc, str) else desc['uid']
+        if desc_uid in self._fields:
+            self._times.add(round(float(doc['data'][self._fields[desc_uid]]), 6))
+        return
+
+
+    def stop(self, doc):
+        if self._start is None:
+            return
+        catalog = run_catalog()
+        if len(self._times) == 1:
+            acquire_time = self._times.pop()
+        else:
+            # keep an exposure time recorded by other callbacks
+            acquire_time = catalog.acquire_time(self._start['uid'])
+        catalog.record_documents(self._start, doc, acquire_time)
+        self._start = None
+        return
+
+# class CatalogRecorder
+
+
+def record_runs(RE):
+    '''Subscribe a CatalogRecorder to run engine RE, once.
+    '''
+    if getattr(RE, '_xpd_catalog_recorder', None) is not None:
+        return
+    recorder = CatalogRecorder()
+    try:
+        RE.subscribe('all', recorder)
+    except (TypeError, ValueError, KeyError):
+        # run engines with subscribe(func, name='all')
+        RE.subscribe(recorder)
+    RE._xpd_catalog_recorder = recorder
+    return
+
+
+_run_catalog = None
+_time_index = None
+
+def run_catalog():
+    '''Return the catalog of this beamtime stored at datapath.catalog.
+    '''
+    global _run_catalog
+    if _run_catalog is None or _run_catalog.path != datapath.catalog:
+        _run_catalog = RunCatalog(datapath.catalog)
+    return _run_catalog
+
+
+def time_index():
+    '''Return the TimeIndex of run_catalog(), refreshed on every query.
+    '''
+    global _time_index
+    catalog = run_catalog()
+    if _time_index is None or _time_index.catalog is not catalog:
+        _time_index = TimeIndex(catalog)
+    return _time_index
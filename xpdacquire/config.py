@@ -21,11 +21,26 @@ class DataPath(object):
         "Folder for saving dark tiff files."
         return os.path.join(self.base, 'dark_base')
 
+    @property
+    def dark_cache(self):
+        "Folder for cached .npy copies of reduced dark frames."
+        return os.path.join(self.dark, 'dark_cache')
+
     @property
     def config(self):
         "Folder for calibration files."
         return os.path.join(self.base, 'config_base')
 
+    @property
+    def catalog(self):
+        "SQLite index of runs and their output files."
+        return os.path.join(self.config, 'xpd_runs.sqlite')
+
+    @property
+    def correction_maps(self):
+        "Folder for cached per-pixel correction maps of calibrations."
+        return os.path.join(self.config, 'correction_maps')
+
     @property
     def script(self):
         "Folder for saving script files for the experiment."
@@ -0,0 +1,145 @@
+'''Per-pixel intensity corrections derived from the loaded calibration.
+
+The polarization factor and solid angle of every pixel depend only on the
+detector geometry, which is fixed for a calibration.  They are computed
+once, together with 2theta and chi, combined with an optional flat field
+into a single multiplicative factor and stored as .npy files in a folder
+named by the hash of the calibration config_data.  Later runs, and other
+processes, open the stored maps as memory maps.  Correcting a frame is one
+multiplication with the combined factor.
+'''
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from xpdacquire.config import datapath
+from xpdacquire.integration import config_key, geometry_from_config, pixel_angles, solid_angle
+
+
+MAP_NAMES = ('tth', 'chi', 'polarization', 'solid_angle', 'factor')
+
+# fraction of horizontal polarization of the synchrotron beam
+DEFAULT_POLARIZATION = 0.99
+
+MAX_CACHED_MAPS = 4
+
+_maps = OrderedDict()
+# maps are used by the acquisition and the export thread
+_lock = threading.Lock()
+
+
+def _load_flat(flat_field):
+    if flat_field is None or isinstance(flat_field, np.ndarray):
+        return flat_field
+    if flat_field.endswith('.npy'):
+        return np.load(flat_field, mmap_mode='r')
+    import tifffile
+    return tifffile.imread(flat_field)
+
+
+def polarization_fraction(config_data):
+    '''Return the polarization fraction of the calibration or None when its correction is disabled.
+    '''
+    options = {}
+    for v in config_data.values():
+        if isinstance(v, dict):
+            options.update(v)
+    if str(options.get('polcorrectionenable', 'true')).strip().lower() in ('false', '0', 'no', 'off'):
+        return None
+    try:
+        return float(options['polcorrectf'])
+    except (KeyError, TypeError, ValueError):
+        return DEFAULT_POLARIZATION
+
+
+def compute_maps(geometry, shape=None, polarization=DEFAULT_POLARIZATION, flat_field=None):
+    '''Return a dictionary of the per-pixel maps of a detector geometry.
+
+    geometry -- dictionary from integration.geometry_from_config
+    shape    -- (rows, columns) of the frames
+    polarization -- fraction of horizontal polarization, None to skip the
+                polarization correction
+    flat_field -- optional array of the relative pixel efficiency
+
+    'factor' is the product that corrects a dark subtracted frame for
+    polarization, solid angle and flat field.
+    '''
+    tth, chi = pixel_angles(geometry, shape)
+    sa = solid_angle(geometry, shape)
+    if polarization is None:
+        pol = np.ones_like(tth)
+    else:
+        sin2 = np.sin(tth) ** 2
+        pol = 0.5 * (1 + np.cos(tth) ** 2 - polarization * np.cos(2 * chi) * sin2)
+    norm = pol * sa
+    if flat_field is not None:
+        norm = norm * flat_field
+    factor = np.zeros(norm.shape, dtype=np.float32)
+    np.divide(1., norm, out=factor, where=norm > 0)
+    return {'tth' : tth.astype(np.float32), 'chi' : chi.astype(np.float32),
+            'polarization' : pol.astype(np.float32),
+            'solid_angle' : sa.astype(np.float32), 'factor' : factor}
+
+
+def maps_key(config_data, shape=None, polarization=DEFAULT_POLARIZATION, flat_field=None):
+    '''Return the name of the stored maps of a calibration, frame shape and flat field.
+    '''
+    h = hashlib.sha1(repr((config_key(config_data), shape, polarization)).encode())
+    if flat_field is not None:
+        h.update(np.ascontiguousarray(flat_field).tobytes())
+    return h.hexdigest()[:16]
+
+
+def correction_maps(config_data, shape=None, flat_field=None, cache_dir=None):
+    '''Return the memory mapped correction maps of a calibration.
+
+    config_data -- calibration config data as stored by load_calibration
+    shape    -- (rows, columns) of the frames, default is the detector
+                dimension of the calibration
+    flat_field -- optional array, .npy or .tif file of the relative pixel
+                efficiency
+    cache_dir -- folder of the stored maps, default is datapath.correction_maps
+
+    Returns a dictionary of the MAP_NAMES arrays.
+    '''
+    if cache_dir is None:
+        cache_dir = datapath.correction_maps
+    flat = _load_flat(flat_field)
+    if shape is not None:
+        shape = tuple(shape)
+    polarization = polarization_fraction(config_data)
+    key = maps_key(config_data, shape, polarization, flat)
+    with _lock:
+        if key in _maps:
+            _maps.move_to_end(key)
+            return _maps[key]
+    d = os.path.join(cache_dir, key)
+    paths = dict((name, os.path.join(d, name + '.npy')) for name in MAP_NAMES)
+    if not all(os.path.isfile(p) for p in paths.values()):
+        maps = compute_maps(geometry_from_config(config_data), shape, polarization, flat)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        for name, p in paths.items():
+            # write next to the final name, other processes may read the maps
+            tmp = p[:-len('.npy')] + '.%i.tmp.npy' % os.getpid()
+            np.save(tmp, maps[name])
+            os.replace(tmp, p)
+    rv = dict((name, np.load(p, mmap_mode='r')) for name, p in paths.items())
+    with _lock:
+        _maps[key] = rv
+        while len(_maps) > MAX_CACHED_MAPS:
+            _maps.popitem(last=False)
+    return rv
+
+
+def correction_factor(config_data, shape=None, flat_field=None):
+    '''Return the combined per-pixel correction factor of a calibration.
+
+    Multiplying a dark subtracted frame with it applies the polarization,
+    solid angle and flat field corrections at once.
+    '''
+    return correction_maps(config_data, shape, flat_field)['factor']
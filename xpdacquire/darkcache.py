@@ -0,0 +1,121 @@
+'''In-memory cache of reduced dark frames keyed by exposure time.
+
+Dark frames are looked up by detector name, acquire time and any extra
+detector settings.  The cache keeps the most recently used frames within a
+memory bound and can mirror them as .npy files, which are read back as
+memory maps, so that repeated saves never go back to the broker for darks.
+'''
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class DarkCache(object):
+    '''LRU cache of dark frames with an optional on-disk .npy store.
+
+    maxbytes -- upper bound of the memory used by cached frames
+    cache_dir -- directory for .npy copies of cached frames.  Nothing is
+                 written to disk when None.
+
+    The cache may be shared by the acquisition and the export thread.
+    '''
+
+    def __init__(self, maxbytes=512 * 2**20, cache_dir=None):
+        self.maxbytes = maxbytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+
+    @staticmethod
+    def key(detector, acquire_time, **settings):
+        '''Return a hashable cache key.
+
+        detector -- str - name of the detector, e.g., 'pe1'
+        acquire_time -- float - exposure time of the dark frame
+        settings -- any other detector settings the dark depends on
+        '''
+        rv = (str(detector), round(float(acquire_time), 6),
+              tuple(sorted((k, str(v)) for k, v in settings.items())))
+        return rv
+
+
+    def get(self, key):
+        '''Return the cached frame for key or None when it is not cached.
+        '''
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                return self._frames[key]
+        fp = self._filename(key)
+        if fp is None or not os.path.isfile(fp):
+            return None
+        frame = np.load(fp, mmap_mode='r')
+        self._store(key, frame)
+        return frame
+
+
+    def put(self, key, frame):
+        '''Cache frame under key and mirror it to the on-disk store.
+        '''
+        frame = np.asarray(frame)
+        fp = self._filename(key)
+        if fp is not None:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write next to the final name, the other thread may read the file
+            tmp = fp[:-len('.npy')] + '.%i.tmp.npy' % threading.get_ident()
+            np.save(tmp, frame)
+            os.replace(tmp, fp)
+        self._store(key, frame)
+        return
+
+
+    def clear(self, disk=True):
+        '''Drop all cached frames, including the on-disk store when disk.
+        '''
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+        if disk and self.cache_dir and os.path.isdir(self.cache_dir):
+            for f in os.listdir(self.cache_dir):
+                if f.endswith('.npy') and not f.endswith('.tmp.npy'):
+                    os.remove(os.path.join(self.cache_dir, f))
+        return
+
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+    def __len__(self):
+        return len(self._frames)
+
+
+    def _store(self, key, frame):
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._frames.pop(key).nbytes
+            self._frames[key] = frame
+            self.nbytes += frame.nbytes
+            # evict least recently used frames, but always keep the newest one
+            while self.nbytes > self.maxbytes and len(self._frames) > 1:
+                k, f = self._frames.popitem(last=False)
+                self.nbytes -= f.nbytes
+        return
+
+
+    def _filename(self, key):
+        if not self.cache_dir:
+            return None
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        fname = '_'.join(['dark', key[0], digest]) + '.npy'
+        return os.path.join(self.cache_dir, fname)
+
+# class DarkCache
@@ -0,0 +1,213 @@
+'''Acquire dark frames of several exposure times in a single run.
+
+dark_plan flushes residual charge from the detector with a few short
+frames that are not saved, then opens one run and takes the dark frames of
+every exposure time in an event stream of its own.  DarkRegistrar listens
+to the documents of that run and registers every exposure in the run
+catalog and the dark cache as soon as the run stops, without asking the
+data broker for the run again.  DarkDrift follows the dark level of a
+series of such runs, e.g., the darks a temperature series takes while the
+controller ramps.
+'''
+
+import numpy as np
+
+from xpdacquire.devices import lookup
+from xpdacquire.reduction import combine_frames
+from xpdacquire.catalog import run_catalog
+
+
+DEFAULT_DARK_TIMES = (0.1, 0.2, 0.3, 0.4)
+
+
+def stream_name(acquire_time):
+    '''Return the name of the event stream of darks with acquire_time.
+    '''
+    return 'dark_%g' % acquire_time
+
+
+def dark_plan(detector, exposure_times=DEFAULT_DARK_TIMES, num=1, flush_num=10, flush_time=0.1):
+    '''Generate the messages of a run with dark frames of every exposure time.
+
+    detector -- area detector with an acquire_time attribute, e.g., pe1
+    exposure_times -- exposure times of the dark frames
+    num      -- number of frames per exposure time
+    flush_num -- number of frames of flush_time taken before the run and
+                 thrown away, they clear residual charge of the detector
+    flush_time -- exposure of the flush frames
+
+    The exposure time of the detector is restored when the plan ends.
+    '''
+    from bluesky import Msg
+    acquire_time_hold = detector.acquire_time
+    try:
+        if flush_num:
+            detector.acquire_time = flush_time
+            for i in range(flush_num):
+                yield Msg('trigger', detector, block_group='flush')
+                yield Msg('wait', None, 'flush')
+        yield Msg('open_run')
+        for t in exposure_times:
+            detector.acquire_time = t
+            for i in range(num):
+                yield Msg('create', name=stream_name(t))
+                yield Msg('trigger', detector, block_group='dark')
+                yield Msg('wait', None, 'dark')
+                yield Msg('read', detector)
+                yield Msg('save')
+        yield Msg('close_run')
+    finally:
+        detector.acquire_time = acquire_time_hold
+
+
+class DarkRegistrar(object):
+    '''Run engine callback that registers the darks of a dark_plan run.
+
+    It collects the image datum and exposure time of every event, and when
+    the run stops records each exposure time of the run in the catalog.
+    With a dark_cache the clipped average of the frames of every exposure
+    is stored there as well, so that the first light run after a dark
+    refresh does not read the darks from the broker.
+
+    dark_cache -- optional DarkCache of the dark frames
+    fill     -- function that returns the frame of an event datum, default
+                is filestore.api.retrieve
+    '''
+
+    def __init__(self, dark_cache=None, fill=None):
+        self.dark_cache = dark_cache
+        self.fill = fill
+        self.uid = None
+        self.exposures = {}
+        self._start = None
+        self._fields = {}
+        return
+
+
+    def __call__(self, name, doc):
+        try:
+            getattr(self, name, self._ignore)(doc)
+        except Exception as e:
+            # a failed registration never interrupts the run, the catalog
+            # is updated from the broker by get_dark_images
+            print('Registering darks failed, %s: %s' % (type(e).__name__, e))
+        return
+
+
+    def _ignore(self, doc):
+        return
+
+
+    def start(self, doc):
+        self._start = doc
+        self.uid = doc['uid']
+        self.exposures = {}
+        self._fields = {}
+        return
+
+
+    def descriptor(self, doc):
+        keys = doc['data_keys']
+        img = [k for k in keys if k.endswith('_image_lightfield')]
+        cnt = [k for k in keys if k.endswith('acquire_time')]
+        if img:
+            self._fields[doc['uid']] = (img[0], cnt[0] if cnt else None)
+        return
+
+
+    def event(self, doc):
+        desc = doc['descriptor']
+        desc_uid = desc if isinstance(desc, str) else desc['uid']
+        if desc_uid not in self._fields:
+            return
+        img_field, cnt_field = self._fields[desc_uid]
+        if cnt_field is None:
+            return
+        t = round(float(doc['data'][cnt_field]), 6)
+        self.exposures.setdefault(t, (img_field, []))[1].append(doc['data'][img_field])
+        return
+
+
+    def stop(self, doc):
+        catalog = run_catalog()
+        times = sorted(self.exposures)
+        catalog.record_documents(self._start, doc, times[0] if len(times) == 1 else None)
+        for t in times:
+            catalog.record_dark(self.uid, t, len(self.exposures[t][1]), doc['time'])
+        if self.dark_cache is None:
+            return
+        for t in times:
+            try:
+                self._cache_dark(t, *self.exposures[t])
+            except Exception as e:
+                # the dark is read from the broker when it is first used
+                print('Caching dark of %s s failed, %s: %s' % (t, type(e).__name__, e))
+        return
+
+
+    def _cache_dark(self, acquire_time, img_field, frames):
+        fill = self.fill if self.fill is not None else lookup('retrieve')
+        frames = (f if isinstance(f, np.ndarray) else fill(f) for f in frames)
+        dark, acc = combine_frames(frames, method='sigma_clip')
+        detector = img_field[:-len('_image_lightfield')]
+        self.dark_cache.put(self.dark_cache.key(detector, acquire_time, uid=self.uid), dark)
+        return
+
+# class DarkRegistrar
+
+
+class DarkDrift(object):
+    '''Follow how the dark frames of a series change with time.
+
+    The first dark of every exposure time is the reference of the later
+    ones.  For each dark the mean level, its change from the reference and
+    the RMS of the pixel-wise difference to the reference are kept.
+    '''
+
+    def __init__(self):
+        self.records = []
+        self._reference = {}
+        return
+
+
+    def add(self, uid, acquire_time, dark, **info):
+        '''Add the dark frame of run uid and return its record.
+
+        info     -- additional values kept in the record, e.g., temperature
+        '''
+        dark = np.asarray(dark, dtype=np.float32)
+        t = round(float(acquire_time), 6)
+        ref = self._reference.setdefault(t, dark)
+        if ref.shape == dark.shape:
+            rms = float(np.sqrt(np.mean(np.square(dark - ref, dtype=np.float64))))
+        else:
+            rms = float('nan')
+        mean = float(np.mean(dark, dtype=np.float64))
+        record = dict(info, uid=uid, acquire_time=t, mean=mean,
+                      drift=mean - float(np.mean(ref, dtype=np.float64)), rms_change=rms)
+        self.records.append(record)
+        return record
+
+
+    def report(self, extra=()):
+        '''Print the level and drift of every dark and return the records.
+
+        extra    -- keys of additional record values printed as columns
+        '''
+        if not self.records:
+            print('No darks were taken')
+            return self.records
+        print(' '.join(['%-6s' % 'uid', '%9s' % 'exposure'] + ['%12s' % k for k in extra]
+                       + ['%12s' % k for k in ('mean', 'drift', 'rms_change')]))
+        for r in self.records:
+            cols = ['%-6s' % r['uid'][:5], '%9g' % r['acquire_time']]
+            cols += ['%12s' % r.get(k, '') for k in extra]
+            cols += ['%12.2f' % r[k] for k in ('mean', 'drift', 'rms_change')]
+            print(' '.join(cols))
+        for t in sorted(self._reference):
+            drift = [r['drift'] for r in self.records if r['acquire_time'] == t]
+            print('darks of %g s: largest drift of the mean %.2f counts over %i darks'
+                  % (t, max(drift, key=abs), len(drift)))
+        return self.records
+
+# class DarkDrift
@@ -0,0 +1,144 @@
+'''Lazy registry of beamline devices and data broker handles.
+
+Nothing is imported or looked up until an object is first used.  Devices
+such as pe1 or photon_shutter are taken from the IPython session that runs
+the collection environment, broker functions from dataportal and
+filestore.  Scripts, worker processes and tests can register their own
+objects instead, so that xpdacquire can be imported outside IPython and
+without a live broker.
+'''
+
+import builtins
+
+
+_registry = {}
+
+
+def register(name, obj):
+    '''Use obj whenever name is looked up.
+
+    name -- str - name of the object, e.g., 'pe1', 'gs' or 'db'
+    obj  -- the object to return for name
+    '''
+    _registry[name] = obj
+    return
+
+
+def reset(name=None):
+    '''Forget a resolved or registered object, or all of them when name is None.
+    '''
+    if name is None:
+        _registry.clear()
+    else:
+        _registry.pop(name, None)
+    return
+
+
+def lookup(name):
+    '''Return the object registered as name, resolving it on first use.
+
+    Raises RuntimeError when name cannot be resolved.
+    '''
+    try:
+        return _registry[name]
+    except KeyError:
+        pass
+    factory = _factories.get(name)
+    obj = factory() if factory is not None else _from_user_ns(name)
+    _registry[name] = obj
+    return obj
+
+
+def _user_ns():
+    get_ipython = getattr(builtins, 'get_ipython', None)
+    ipshell = get_ipython() if get_ipython is not None else None
+    return None if ipshell is None else ipshell.user_ns
+
+
+def _from_user_ns(name):
+    ns = _user_ns()
+    if ns is None:
+        emsg = ('%s is not registered and there is no IPython session to '
+                'take it from.  Use xpdacquire.devices.register.' % name)
+        raise RuntimeError(emsg)
+    try:
+        return ns[name]
+    except KeyError:
+        emsg = '%s is not defined in the IPython namespace' % name
+        raise RuntimeError(emsg)
+
+
+def _global_state():
+    ns = _user_ns()
+    if ns is not None and 'gs' in ns:
+        gs = ns['gs']
+    else:
+        from bluesky.standard_config import gs
+    try:
+        gs.TEMP_CONTROLLER = lookup('cs700')
+    except RuntimeError:
+        pass
+    # every run of the session goes to the run catalog
+    from xpdacquire.catalog import record_runs
+    record_runs(gs.RE)
+    return gs
+
+
+def _dataportal(attr):
+    def factory():
+        import dataportal
+        return getattr(dataportal, attr)
+    return factory
+
+
+def _filestore_retrieve():
+    from filestore.api import retrieve
+    return retrieve
+
+
+_factories = {
+    'gs' : _global_state,
+    'db' : _dataportal('DataBroker'),
+    'get_images' : _dataportal('get_images'),
+    'get_events' : _dataportal('get_events'),
+    'retrieve' : _filestore_retrieve,
+}
+
+
+class LazyObject(object):
+    '''Stand-in for a registry object that resolves it on first use.
+    '''
+
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+        return
+
+
+    def __getattr__(self, attr):
+        return getattr(lookup(self._name), attr)
+
+
+    def __getitem__(self, key):
+        return lookup(self._name)[key]
+
+
+    def __call__(self, *args, **kwargs):
+        return lookup(self._name)(*args, **kwargs)
+
+
+    def __repr__(self):
+        return '<lazy %s>' % self._name
+
+# class LazyObject
+
+
+# data broker handles, same call signatures as in dataportal
+db = LazyObject('db')
+
+
+def get_images(*args, **kwargs):
+    return lookup('get_images')(*args, **kwargs)
+
+
+def get_events(*args, **kwargs):
+    return lookup('get_events')(*args, **kwargs)
@@ -2,11 +2,10 @@ import datetime
 import os
 from xpdacquire.xpdacquirefuncs import _bluesky_metadata_store
 from xpdacquire.config import datapath
+from xpdacquire.archive import ArchiveJob, MANIFEST_NAME
 import sys
 
 
-metadata = _bluesky_metadata_store()
-
 W_SUB_DIR = 'tif_base'
 D_SUB_DIR = 'dark_base'
 R_SUB_DIR = 'config_base'
@@ -28,7 +27,7 @@ def end_beamtime():
     directory in the remote file-store with filename B_DIR/useriD
 
     '''
-    
+    metadata = _bluesky_metadata_store()
     SAF_num = metadata['SAF_number']
     userID = SAF_num
     userIn = input('SAF number to current experiment is %s. Is it correct (y/n)? ' % SAF_num)
@@ -76,19 +75,28 @@ def end_beamtime():
     dir_list = [todir_w, todir_d, todir_r, todir_s]
 
     #print(dir_list)
-    
+    manifest = os.path.join(backup_trunk, MANIFEST_NAME)
+    resume = os.path.isfile(manifest)
+    if resume:
+        print('an archive manifest was found in %s, files archived before are skipped' % backup_trunk)
     for el in dir_list:
         try:
             os.makedirs(el)
         except OSError:
-            print('%s has already existed. Please investigate what happen' % el)
-            return
-
-    # os.renames already testing if user has the right to write files
-    os.renames(W_DIR, todir_w)
-    os.renames(D_DIR, todir_d)
-    os.renames(R_DIR, todir_r)
-    os.renames(S_DIR, todir_s)
+            if not resume:
+                print('%s has already existed. Please investigate what happen' % el)
+                return
+
+    # files are copied and verified before anything is deleted
+    job = ArchiveJob(zip([W_DIR, D_DIR, R_DIR, S_DIR], dir_list), manifest)
+    report = job.run(delete=True)
+    print('%i files, %.1f MB archived in %.0f s' % (report['files'], report['bytes'] / 1e6, report['seconds']))
+    if report['failed']:
+        print('The following files could not be archived:')
+        for src, err in report['failed']:
+            print('    %s: %s' % (src, err))
+        print('Nothing has been deleted. Fix the problem and run end_beamtime() again to resume')
+        return
     print('All user generated files have been moved from:')
     print(W_DIR)
     print(R_DIR)
@@ -100,6 +108,7 @@ def end_beamtime():
     print(todir_d)
     print(todir_s)
     print('where they will be archived for at least one year')
+    print('the list of files and their SHA-256 checksums is in %s' % manifest)
     print('END of process')
 
 #if __name__ == '__main__':
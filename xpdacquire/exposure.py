@@ -0,0 +1,134 @@
+'''Choose frame time and number of frames of area detector scans.
+
+Every frame costs its exposure plus a readout dead time, and a frame that
+is exposed too long saturates.  The planner takes the readout overhead of
+the detector, calibrated once with calibrate_readout, and the count rate of
+a short probe frame and returns the longest frame time below saturation and
+the 5 s detector limit together with the number of frames that meets a
+target of total counts or signal-to-noise ratio.  The frame time can be
+restricted to exposure times that have dark frames.
+'''
+
+import os
+import json
+
+import numpy as np
+
+from xpdacquire.config import datapath
+
+
+# longest exposure that does not damage the detector
+MAX_EXPOSURE = 5.0
+# counts of a saturated PE1 pixel
+PE1_SATURATION = 65535
+# readout dead time per frame when the detector was never calibrated
+DEFAULT_READOUT_OVERHEAD = 0.07
+
+
+def _calibration_file(detector):
+    return os.path.join(datapath.config, '%s_readout.json' % detector)
+
+
+def readout_overhead(detector='pe1'):
+    '''Return the calibrated readout seconds per frame of detector.
+    '''
+    try:
+        with open(_calibration_file(detector)) as f:
+            return json.load(f)['readout_overhead']
+    except (IOError, ValueError, KeyError):
+        return DEFAULT_READOUT_OVERHEAD
+
+
+def measure_readout(event_times, exposure_time):
+    '''Return the dead time per frame from event times of a Count scan.
+
+    event_times -- times of consecutive frames of one run
+    exposure_time -- exposure of every frame
+    '''
+    dt = np.diff(np.sort(np.asarray(event_times, dtype=float)))
+    if not len(dt):
+        raise ValueError('at least two frames are needed to measure the readout time')
+    return max(float(np.median(dt)) - exposure_time, 0.)
+
+
+def save_readout(overhead, detector='pe1', **info):
+    '''Store the readout overhead of detector in the config folder.
+    '''
+    d = dict(info, readout_overhead=overhead)
+    with open(_calibration_file(detector), 'w') as f:
+        json.dump(d, f)
+    return
+
+
+def probe_rates(frame, exposure_time, dark=None):
+    '''Return the count rates of a probe frame per second.
+
+    Returns a dictionary with the rate of the brightest pixel 'max_rate',
+    of the whole frame 'total_rate' and of an average pixel 'mean_rate'.
+    '''
+    img = np.asarray(frame, dtype=np.float64)
+    if dark is not None:
+        img = img - dark
+    return {'max_rate' : float(img.max()) / exposure_time,
+            'total_rate' : float(img.sum()) / exposure_time,
+            'mean_rate' : float(img.mean()) / exposure_time}
+
+
+def plan_exposure(scan_time, rates=None, overhead=DEFAULT_READOUT_OVERHEAD,
+                  target_counts=None, target_snr=None, max_exposure=MAX_EXPOSURE,
+                  saturation=PE1_SATURATION, fill=0.8, frame_times=None):
+    '''Return frame time and number of frames of a scan as a dictionary.
+
+    scan_time -- total exposure when no target is given
+    rates    -- count rates of a probe frame from probe_rates.  Without it
+                only the max_exposure limit is applied.
+    overhead -- readout seconds per frame
+    target_counts -- total counts to collect over the whole frame
+    target_snr -- signal-to-noise ratio of an average pixel, counting
+                  statistics only
+    max_exposure -- longest allowed frame time
+    saturation -- counts of a saturated pixel
+    fill     -- fraction of saturation the brightest pixel may reach
+    frame_times -- optional exposure times that frames may have, e.g., those
+                   with dark frames.  The longest one that is not above the
+                   planned frame time is used, or the shortest when all are
+                   longer, and the number of frames is raised to cover the
+                   total exposure.
+
+    Frames are as few and as long as allowed, which minimizes the share of
+    readout dead time.  The returned dictionary also holds the expected
+    'duty_cycle', 'wall_time' and 'max_counts' per frame, and 'limit', the
+    reason for the frame time.
+    '''
+    frame_time = max_exposure
+    limit = 'max_exposure'
+    if rates and rates['max_rate'] > 0:
+        t_sat = fill * saturation / rates['max_rate']
+        if t_sat < frame_time:
+            frame_time = t_sat
+            limit = 'saturation'
+    if target_counts and rates and rates['total_rate'] > 0:
+        total = target_counts / rates['total_rate']
+    elif target_snr and rates and rates['mean_rate'] > 0:
+        total = target_snr ** 2 / rates['mean_rate']
+    else:
+        total = scan_time
+    if total < frame_time:
+        frame_time = total
+        limit = 'total_exposure'
+    num = max(int(np.ceil(total / frame_time - 1e-9)), 1)
+    # spread the total exposure evenly over the frames
+    frame_time = total / num
+    if frame_times:
+        allowed = [t for t in frame_times if t <= frame_time * (1 + 1e-6)]
+        frame_time = max(allowed) if allowed else min(frame_times)
+        num = max(int(np.ceil(total / frame_time - 1e-6)), 1)
+    rv = {'frame_time' : frame_time, 'num' : num, 'limit' : limit,
+          'readout_overhead' : overhead,
+          'duty_cycle' : frame_time / (frame_time + overhead),
+          'wall_time' : num * (frame_time + overhead),
+          'target_counts' : target_counts, 'target_snr' : target_snr}
+    if rates:
+        rv['max_counts'] = rates['max_rate'] * frame_time
+        rv['probe_rates'] = rates
+    return rv
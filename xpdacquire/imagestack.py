@@ -0,0 +1,127 @@
+'''Lazy access to the image frames of a run.
+
+ImageStack wraps the lazy sequence returned by get_images, or a list of
+image files, and reads a frame only when it is used.  Files are opened as
+memory maps where the format allows it, so that slicing, per-frame sums and
+means never hold more than one frame in memory.
+'''
+
+import os
+
+import numpy as np
+
+from xpdacquire.devices import get_images
+from xpdacquire.reduction import average_frames
+
+
+class ImageStack(object):
+    '''Sequence of 2D frames that are read on access.
+
+    frames   -- sequence of frames, e.g., from get_images, that supports
+                len and integer indexing
+    index    -- optional list or range of frame indices into frames.  Slices
+                of a stack share frames and only keep their own index.
+    '''
+
+    def __init__(self, frames, index=None):
+        self._frames = frames
+        self._index = range(len(frames)) if index is None else index
+        return
+
+
+    @classmethod
+    def from_header(cls, header, field=None):
+        '''Return the stack of image frames of a header.
+
+        header   -- a bluesky header object
+        field    -- name of the image field, default is the first field
+                    ending with '_image_lightfield'
+        '''
+        if field is None:
+            fields = [el for el in header.descriptors[0]['data_keys'] if el.endswith('_image_lightfield')]
+            if not fields:
+                raise RuntimeError('header with uid = %s does not contain any image' % header.start.uid)
+            field = fields[0]
+        return cls(get_images(header, field))
+
+
+    @classmethod
+    def from_files(cls, paths):
+        '''Return the stack of frames stored in a list of .npy or .tif files.
+
+        Every file holds one frame.  Files are memory mapped when possible.
+        '''
+        return cls(_FileFrames(list(paths)))
+
+
+    def __len__(self):
+        return len(self._index)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ImageStack(self._frames, self._index[i])
+        return np.asarray(self._frames[self._index[i]])
+
+
+    def __iter__(self):
+        for i in self._index:
+            yield np.asarray(self._frames[i])
+
+
+    @property
+    def frame_shape(self):
+        '''Shape of a single frame, read from the first frame.'''
+        if not len(self):
+            return ()
+        return self[0].shape
+
+
+    @property
+    def shape(self):
+        return (len(self),) + self.frame_shape
+
+
+    def sums(self):
+        '''Return a list of the total counts of every frame.
+        '''
+        return [float(np.sum(frame, dtype=np.float64)) for frame in self]
+
+
+    def mean(self, dark=None, scale=None):
+        '''Return the mean frame, dark corrected if dark is given, or None.
+
+        scale is an optional per-pixel factor applied to the mean.
+        '''
+        return average_frames(self, dark, scale)[0]
+
+# class ImageStack
+
+
+class _FileFrames(object):
+    '''Sequence of frames read from one file per frame.'''
+
+    def __init__(self, paths):
+        self.paths = paths
+        return
+
+
+    def __len__(self):
+        return len(self.paths)
+
+
+    def __getitem__(self, i):
+        return _read_frame(self.paths[i])
+
+
+def _read_frame(path):
+    '''Return the frame in path, memory mapped when the file allows it.
+    '''
+    if os.path.splitext(path)[1] == '.npy':
+        return np.load(path, mmap_mode='r')
+    import tifffile
+    try:
+        return tifffile.memmap(path, mode='r')
+    except (AttributeError, ValueError):
+        # old tifffile or compressed files cannot be memory mapped
+        return tifffile.imread(path)
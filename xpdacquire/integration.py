@@ -0,0 +1,237 @@
+'''Azimuthal integration of detector frames with the SrXplanar geometry.
+
+The calibration loaded by load_calibration holds the detector geometry of
+the SrXplanar config file.  Integrator turns it once into the bin index of
+every pixel, in 2theta or Q and optionally in azimuthal sectors, so that a
+frame is integrated by a single weighted numpy.bincount.  Integrators are
+cached per calibration and frame shape, thus a series of frames pays for
+the geometry only once.
+'''
+
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# SrXplanar defaults of the geometry options.  Lengths are in mm, angles in
+# degrees and beam center in pixels.
+GEOMETRY_DEFAULTS = {
+    'xbeamcenter' : 1024.0,
+    'ybeamcenter' : 1024.0,
+    'wavelength' : 0.1,
+    'distance' : 200.0,
+    'rotationd' : 0.0,
+    'tiltd' : 0.0,
+    'tthstepd' : 0.02,
+    'qstep' : 0.02,
+    'xdimension' : 2048,
+    'ydimension' : 2048,
+    'xpixelsize' : 0.2,
+    'ypixelsize' : 0.2,
+    'fliphorizontal' : False,
+    'flipvertical' : False,
+    'integrationspace' : 'twotheta',
+}
+
+SPACES = ('tth', 'q')
+
+MAX_CACHED_INTEGRATORS = 4
+
+_integrators = OrderedDict()
+# integrators are used by the acquisition and the export thread
+_lock = threading.Lock()
+
+
+def config_key(config_data):
+    '''Return a short hash that identifies a calibration config_data dictionary.
+    '''
+    s = json.dumps(config_data, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode()).hexdigest()[:16]
+
+
+def geometry_from_config(config_data):
+    '''Return the detector geometry of SrXplanar config_data as dictionary.
+
+    config_data -- dictionary of config sections as stored by load_calibration,
+                   or a flat dictionary of options.  Missing options take
+                   the SrXplanar defaults.
+    '''
+    options = {}
+    for k, v in config_data.items():
+        if isinstance(v, dict):
+            options.update(v)
+        else:
+            options[k] = v
+    rv = dict(GEOMETRY_DEFAULTS)
+    for k, default in GEOMETRY_DEFAULTS.items():
+        if options.get(k) in (None, ''):
+            continue
+        value = options[k]
+        if isinstance(default, bool):
+            rv[k] = str(value).strip().lower() in ('true', '1', 'yes', 'on')
+        elif isinstance(default, int):
+            rv[k] = int(float(value))
+        elif isinstance(default, float):
+            rv[k] = float(value)
+        else:
+            rv[k] = str(value).strip().lower()
+    return rv
+
+
+def _detector_coordinates(geometry, shape=None):
+    '''Return pixel x and y on the detector and the sample position in mm.
+
+    Coordinates are relative to the beam center.  x is a row and y a column
+    vector, so that they broadcast to the frame shape.
+    '''
+    if shape is None:
+        shape = (geometry['ydimension'], geometry['xdimension'])
+    ny, nx = shape
+    x = np.arange(nx, dtype=np.float64)
+    y = np.arange(ny, dtype=np.float64)
+    if geometry['fliphorizontal']:
+        x = x[::-1]
+    if geometry['flipvertical']:
+        y = y[::-1]
+    xr = (x - geometry['xbeamcenter']) * geometry['xpixelsize']
+    yr = (y - geometry['ybeamcenter']) * geometry['ypixelsize']
+    rot = np.radians(geometry['rotationd'])
+    tilt = np.radians(geometry['tiltd'])
+    d = geometry['distance']
+    # sample position seen from the beam center on the detector plane
+    sample = (d * np.sin(tilt) * np.cos(rot), -d * np.sin(tilt) * np.sin(rot), d * np.cos(tilt))
+    return xr[np.newaxis, :], yr[:, np.newaxis], sample
+
+
+def pixel_angles(geometry, shape=None):
+    '''Return arrays of 2theta and chi of every pixel in radians.
+
+    geometry -- dictionary from geometry_from_config
+    shape    -- (rows, columns) of the frame, default is the detector
+                dimension of the geometry
+    '''
+    xr, yr, (sx, sy, sz) = _detector_coordinates(geometry, shape)
+    d = geometry['distance']
+    r = np.sqrt((xr - sx) ** 2 + (yr - sy) ** 2 + sz * sz)
+    # angle between the direct beam and the sample to pixel direction
+    cos2t = (d * d - xr * sx - yr * sy) / (r * d)
+    tth = np.arccos(np.clip(cos2t, -1., 1.))
+    chi = np.arctan2(yr, xr) + np.zeros_like(tth)
+    return tth, chi
+
+
+def solid_angle(geometry, shape=None):
+    '''Return the solid angle of every pixel relative to a pixel hit at normal incidence.
+    '''
+    xr, yr, (sx, sy, sz) = _detector_coordinates(geometry, shape)
+    r = np.sqrt((xr - sx) ** 2 + (yr - sy) ** 2 + sz * sz)
+    # sz is the distance of the sample from the detector plane
+    return (sz / r) ** 3
+
+
+class Integrator(object):
+    '''Integrate frames into 1D patterns with a fixed pixel to bin lookup.
+
+    geometry -- dictionary from geometry_from_config
+    shape    -- (rows, columns) of the frames
+    space    -- 'tth' for 2theta in degrees or 'q' for Q in inverse angstrom.
+                Default is the integrationspace of the geometry.
+    step     -- bin width, default is tthstepd or qstep of the geometry
+    nchi     -- number of azimuthal sectors, 1 integrates full rings
+    mask     -- optional boolean array of shape, True marks excluded pixels
+    '''
+
+    def __init__(self, geometry, shape=None, space=None, step=None, nchi=1, mask=None):
+        if space is None:
+            space = 'q' if geometry['integrationspace'].startswith('q') else 'tth'
+        if space not in SPACES:
+            raise ValueError('space must be one of %s, not %r' % (SPACES, space))
+        if step is None:
+            step = geometry['qstep'] if space == 'q' else geometry['tthstepd']
+        self.geometry = geometry
+        self.space = space
+        self.step = step
+        self.nchi = nchi
+        tth, chi = pixel_angles(geometry, shape)
+        self.shape = tth.shape
+        if space == 'q':
+            x = 4 * np.pi * np.sin(tth / 2) / geometry['wavelength']
+        else:
+            x = np.degrees(tth)
+        bins = (x / step).astype(np.intp).ravel()
+        self.nbins = int(bins.max()) + 1
+        if nchi > 1:
+            sector = ((chi.ravel() + np.pi) * (nchi / (2 * np.pi))).astype(np.intp)
+            bins += np.minimum(sector, nchi - 1) * self.nbins
+        self._pixels = None
+        if mask is not None and np.any(mask):
+            self._pixels = np.flatnonzero(~np.asarray(mask, dtype=bool).ravel())
+            bins = bins[self._pixels]
+        self._bins = bins
+        counts = np.bincount(bins, minlength=nchi * self.nbins)
+        self._scale = np.zeros(counts.shape)
+        np.divide(1., counts, out=self._scale, where=counts > 0)
+        self.x = (np.arange(self.nbins) + 0.5) * step
+        return
+
+
+    def integrate(self, frame):
+        '''Return the bin centers and the mean intensity of every bin.
+
+        The intensity has nchi rows when the integrator has sectors.
+        '''
+        w = np.asarray(frame).ravel()
+        if w.size != self.shape[0] * self.shape[1]:
+            raise ValueError('frame shape %s does not match integrator shape %s'
+                             % (np.shape(frame), self.shape))
+        if self._pixels is not None:
+            w = w[self._pixels]
+        intensity = np.bincount(self._bins, weights=w, minlength=self._scale.size) * self._scale
+        if self.nchi > 1:
+            intensity = intensity.reshape(self.nchi, self.nbins)
+        return self.x, intensity
+
+
+    def write(self, path, frame, comments=None):
+        '''Integrate frame and save the pattern as text file at path.
+
+        Columns are the bin center and the intensity of every sector.
+        Returns path.
+        '''
+        x, intensity = self.integrate(frame)
+        data = np.column_stack([x] + list(np.atleast_2d(intensity)))
+        xlabel = 'Q(1/A)' if self.space == 'q' else '2theta(degree)'
+        lines = ['xpdAcquire integration, %s, %i sector(s)' % (xlabel, self.nchi)]
+        if comments:
+            lines += [str(el) for el in comments]
+        lines.append('%s intensity' % xlabel)
+        np.savetxt(path, data, fmt='%.6g', header='\n'.join(lines))
+        return path
+
+# class Integrator
+
+
+def integrator(config_data, shape=None, space=None, step=None, nchi=1, mask=None):
+    '''Return the cached Integrator of a calibration, frame shape and mask.
+
+    config_data -- calibration config data as stored by load_calibration
+    Other arguments are the same as for Integrator.
+    '''
+    mask_key = None
+    if mask is not None:
+        mask_key = hashlib.sha1(np.packbits(np.asarray(mask, dtype=bool)).tobytes()).hexdigest()
+    key = (config_key(config_data), tuple(shape) if shape is not None else None,
+           space, step, nchi, mask_key)
+    with _lock:
+        if key in _integrators:
+            _integrators.move_to_end(key)
+            return _integrators[key]
+    rv = Integrator(geometry_from_config(config_data), shape, space, step, nchi, mask)
+    with _lock:
+        _integrators[key] = rv
+        while len(_integrators) > MAX_CACHED_INTEGRATORS:
+            _integrators.popitem(last=False)
+    return rv
@@ -0,0 +1,220 @@
+'''Reduce and save frames while a run is acquired.
+
+LiveSave is subscribed to the run engine together with a scan.  It fetches
+every frame once, when its event arrives, subtracts the cached dark frame
+and either accumulates the running average or writes the frame right away.
+The files are complete seconds after the run stops, without reading the run
+back from the broker with save_tif.
+'''
+
+import os
+
+import numpy as np
+
+from xpdacquire.devices import lookup
+from xpdacquire.reduction import ClippedAverage, RunningAverage, apply_mask
+from xpdacquire.stackwriter import open_stack
+from xpdacquire.catalog import run_catalog
+
+
+class LiveSave(object):
+    '''Run engine callback that writes dark corrected tif files during a run.
+
+    It follows the bluesky CallbackBase protocol, the run engine calls it
+    with the name and content of every document.  Errors are printed and
+    never interrupt the run, save_tif(db[-1]) can be used afterwards.
+
+    sum_frames -- write the average of a Count run as one file, otherwise
+                one file per frame.  Motor scans are never summed.
+    dark_uid -- uid of the dark scan to use, default is the dark_uid in
+                the scan_info of the run, or else the latest dark with the
+                same exposure time
+    dark_correct -- subtract the dark frame
+    stack_format -- 'hdf5' or 'bigtiff' to append frames that are not
+                summed to a single file, see save_tif
+    frame_tifs -- write one tif file per frame as well, default is True
+                without stack_format
+    motor    -- name of the scanned motor.  Default is the 'motor' entry of
+                the start document.
+    fill     -- function that returns the frame of an event datum, default
+                is filestore.api.retrieve
+    combine  -- how summed frames are combined, 'sigma_clip', 'median' or
+                'mean', see save_tif
+    mask_bad_pixels -- set bad pixels of the dark scan to NaN in dark
+                corrected images, see save_tif
+    '''
+
+    def __init__(self, sum_frames=True, dark_uid=False, dark_correct=True,
+                 stack_format=None, frame_tifs=None, motor=None, fill=None,
+                 combine='sigma_clip', mask_bad_pixels=False):
+        self.sum_frames = sum_frames
+        self.dark_uid = dark_uid
+        self.dark_correct = dark_correct
+        self.stack_format = stack_format
+        self.frame_tifs = frame_tifs
+        self.motor = motor
+        self.fill = fill
+        self.combine = combine
+        self.mask_bad_pixels = mask_bad_pixels
+        self.written = []
+        self._reset()
+        return
+
+
+    def _reset(self):
+        self._start = None
+        self._fields = {}
+        self._average = None
+        self._dark = None
+        self._mask = None
+        self._corrected = self.dark_correct
+        self._cnt_time = None
+        self._stack = None
+        self._nframes = 0
+        self._failed = False
+        return
+
+
+    def __call__(self, name, doc):
+        if name == 'start':
+            self._reset()
+        elif self._failed or self._start is None:
+            return
+        try:
+            getattr(self, name, self._ignore)(doc)
+        except Exception as e:
+            self._failed = True
+            self._close_stack()
+            print('Live saving stopped, %s: %s' % (type(e).__name__, e))
+            print('The run continues, use save_tif(db[-1]) when it is finished')
+        return
+
+
+    def _ignore(self, doc):
+        return
+
+
+    def start(self, doc):
+        self._start = doc
+        self.written = []
+        if self.motor is None:
+            self._motor = doc.get('motor')
+        else:
+            self._motor = self.motor
+        return
+
+
+    def descriptor(self, doc):
+        keys = doc['data_keys']
+        img = [k for k in keys if k.endswith('_image_lightfield')]
+        if not img:
+            return
+        cnt = [k for k in keys if k.endswith('acquire_time')]
+        motor = self._motor if self._motor in keys else None
+        self._fields[doc['uid']] = (img[0], cnt[0] if cnt else None, motor)
+        return
+
+
+    def event(self, doc):
+        desc = doc['descriptor']
+        # a uid in documents from the run engine, a document in metadatastore
+        desc_uid = desc if isinstance(desc, str) else desc['uid']
+        if desc_uid not in self._fields:
+            return
+        img_field, cnt_field, motor_field = self._fields[desc_uid]
+        data = doc['data']
+        if self._nframes == 0:
+            self._first_frame(data, cnt_field, img_field)
+        frame = data[img_field]
+        if not isinstance(frame, np.ndarray):
+            fill = self.fill if self.fill is not None else lookup('retrieve')
+            frame = fill(frame)
+        i = self._nframes
+        self._nframes += 1
+        if self._average is not None:
+            self._average.add(frame)
+            return
+        img = np.array(frame, dtype=np.float32)
+        if self._dark is not None:
+            img -= self._dark
+            apply_mask(img, self._mask)
+        timestamp = doc['timestamps'].get(img_field, doc['time'])
+        motor_step = data[motor_field] if motor_field else None
+        if self._stack is not None:
+            self._stack.append(img, timestamp, motor_step)
+        if self.frame_tifs or (self.frame_tifs is None and not self.stack_format):
+            import xpdacquire.xpdacquirefuncs as xf
+            f_name = xf._frame_tif_name(self._start, False, self._corrected, i, timestamp, motor_step)
+            self.written.append(xf._write_tif(os.path.join(xf.W_DIR, f_name), img))
+        return
+
+
+    def _first_frame(self, data, cnt_field, img_field):
+        '''Find the dark frame and prepare the outputs of the run.'''
+        # imported here, xpdacquirefuncs subscribes this callback
+        import xpdacquire.xpdacquirefuncs as xf
+        start = self._start
+        if cnt_field is not None:
+            self._cnt_time = data[cnt_field]
+        if self.dark_correct:
+            detector = img_field[:-len('_image_lightfield')]
+            dark_uid = self.dark_uid or xf._run_dark_uid(start, self._cnt_time)
+            if self._cnt_time is not None:
+                self._dark = xf.get_dark_frame(self._cnt_time, dark_uid, detector)
+            if self._dark is None:
+                print('No dark frame with cnt_time = %s, frames of this run are saved raw' % self._cnt_time)
+                self._corrected = False
+            elif self.mask_bad_pixels:
+                self._mask = xf.get_bad_pixel_mask(self._cnt_time, dark_uid, detector)
+        if self.sum_frames and start.get('scan_type') == 'Count' and not self._motor:
+            if self.combine == 'mean':
+                self._average = RunningAverage(self._dark)
+            else:
+                self._average = ClippedAverage(self._dark, method=self.combine)
+        elif self.stack_format:
+            s_name = xf.filename_gen(start) + ('' if self._corrected else '_raw') + '_stack'
+            attrs = {'uid' : start['uid'], 'scan_type' : start.get('scan_type', ''),
+                     'acquire_time' : self._cnt_time, 'dark_corrected' : bool(self._corrected)}
+            self._stack = open_stack(os.path.join(xf.W_DIR, s_name), self.stack_format,
+                                     motor=self._motor, attrs=attrs, append=False)
+        return
+
+
+    def _close_stack(self):
+        if self._stack is not None:
+            self._stack.close()
+            self.written.append(self._stack.path)
+            self._stack = None
+        return
+
+
+    def stop(self, doc):
+        import xpdacquire.xpdacquirefuncs as xf
+        start = self._start
+        self._close_stack()
+        reduction = {'method' : 'frames', 'frames' : self._nframes, 'rejected' : 0, 'nonfinite' : 0,
+                     'masked' : 0 if self._mask is None else int(np.count_nonzero(self._mask))}
+        if self._average is not None and self._average.count:
+            parts = [xf._timestampstr(doc['time']), start['uid'][:5], xf.feature_gen(start)]
+            if not self._corrected:
+                parts.append('raw')
+            f_name = '_'.join(parts) + '.tif'
+            img = self._average.mean()
+            if self._corrected:
+                apply_mask(img, self._mask)
+            self.written.append(xf._write_tif(os.path.join(xf.W_DIR, f_name), img))
+            reduction['method'] = self.combine
+            reduction['rejected'] = getattr(self._average, 'rejected', 0)
+            reduction['nonfinite'] = getattr(self._average, 'nonfinite', 0)
+        if self._nframes:
+            self.written += xf._write_run_info(start, reduction)
+        catalog = run_catalog()
+        catalog.record_documents(start, doc, self._cnt_time)
+        if self._nframes:
+            catalog.record_reduction(start['uid'], **reduction)
+        catalog.add_files(start['uid'], self.written)
+        print('%i frames of run %s saved while acquiring' % (self._nframes, start['uid'][:5]))
+        self._start = None
+        return
+
+# class LiveSave
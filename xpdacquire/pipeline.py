@@ -0,0 +1,149 @@
+'''Overlap temperature moves of a series with export of the previous point.
+
+SettleDetector decides when a temperature controller has reached a new set
+point by polling its readback, instead of trusting a blocking move to
+return at the right time.  ExportPipeline saves finished runs on a worker
+thread while the next point is approached and acquired, with a bounded
+queue, and keeps the timing of every stage for a report at the end.
+'''
+
+import time
+
+
+class SettleDetector(object):
+    '''Wait until a readback stays close to its target.
+
+    tolerance -- largest accepted distance between readback and target
+    stable_time -- seconds the readback has to stay within tolerance
+    timeout  -- give up after this many seconds and continue
+    poll_interval -- seconds between readback polls
+    '''
+
+    def __init__(self, tolerance=1.0, stable_time=10., timeout=900., poll_interval=0.5):
+        self.tolerance = tolerance
+        self.stable_time = stable_time
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        return
+
+
+    def wait(self, readback, target):
+        '''Poll readback until it is stable at target.
+
+        readback -- function without arguments returning the current value
+        target   -- set point the readback should settle at
+
+        Returns a dictionary with the last 'value', the waited 'seconds'
+        and 'settled', which is False after a timeout.
+        '''
+        t0 = time.time()
+        stable_since = None
+        while True:
+            value = readback()
+            now = time.time()
+            if abs(value - target) <= self.tolerance:
+                if stable_since is None:
+                    stable_since = now
+                if now - stable_since >= self.stable_time:
+                    settled = True
+                    break
+            else:
+                stable_since = None
+            if now - t0 >= self.timeout:
+                settled = False
+                print('readback %s did not settle at %s within %s s, continuing' % (value, target, self.timeout))
+                break
+            time.sleep(self.poll_interval)
+        return {'value' : value, 'seconds' : time.time() - t0, 'settled' : settled}
+
+# class SettleDetector
+
+
+class ExportPipeline(object):
+    '''Run an export function on a worker thread, one run at a time.
+
+    export   -- function called with a run uid on the worker
+    max_queue -- number of runs that may wait for export.  submit blocks
+                when the queue is full, so the series cannot run away from
+                a slow export.
+    '''
+
+    def __init__(self, export, max_queue=2):
+        from concurrent.futures import ThreadPoolExecutor
+        self.export = export
+        self.max_queue = max_queue
+        self.records = []
+        self._executor = ThreadPoolExecutor(1)
+        self._pending = []
+        return
+
+
+    def _run(self, record):
+        record['export_start'] = time.time()
+        try:
+            self.export(record['uid'])
+            record['status'] = 'saved'
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = '%s: %s' % (type(e).__name__, e)
+        record['export_seconds'] = time.time() - record['export_start']
+        return record
+
+
+    @property
+    def queue_depth(self):
+        '''Number of submitted runs not exported yet.'''
+        self._pending = [f for f in self._pending if not f.done()]
+        return len(self._pending)
+
+
+    def submit(self, uid, **timing):
+        '''Queue run uid for export and return its record.
+
+        timing   -- seconds of the stages of this point, e.g., ramp=12.3,
+                    stored in the record for the report
+        '''
+        t0 = time.time()
+        while self.queue_depth >= self.max_queue:
+            self._pending[0].result()
+        record = dict(timing, uid=uid, submitted=time.time(),
+                      queue_wait=time.time() - t0, queue_depth=self.queue_depth,
+                      status='queued', error='')
+        self.records.append(record)
+        self._pending.append(self._executor.submit(self._run, record))
+        return record
+
+
+    def drain(self):
+        '''Wait for all exports and return the seconds waited.
+        '''
+        t0 = time.time()
+        for f in self._pending:
+            f.result()
+        self._pending = []
+        self._executor.shutdown(wait=True)
+        return time.time() - t0
+
+
+    def report(self, tail=None):
+        '''Print the timing of every point and the totals per stage.
+
+        tail     -- seconds waited for exports after the last point
+        '''
+        stages = [k for k in ('ramp', 'dark', 'settle', 'acquire') if any(k in r for r in self.records)]
+        stages += ['queue_wait', 'export_seconds']
+        print(' '.join(['%-6s' % 'uid', '%5s' % 'queue'] + ['%14s' % s for s in stages] + ['status']))
+        for r in self.records:
+            cols = ['%-6s' % r['uid'][:5], '%5i' % r['queue_depth']]
+            cols += ['%14.1f' % r.get(s, 0.) for s in stages]
+            print(' '.join(cols + [r['status'] + (' ' + r['error'] if r['error'] else '')]))
+        totals = dict((s, sum(r.get(s, 0.) for r in self.records)) for s in stages)
+        print('total seconds: ' + ', '.join('%s %.1f' % (s, totals[s]) for s in stages))
+        if tail is not None:
+            print('%.1f s waited for exports after the last point' % tail)
+        failed = [r for r in self.records if r['status'] != 'saved']
+        if failed:
+            print('%i points failed to export, use save_tif on their uids' % len(failed))
+        return totals
+
+# class ExportPipeline
@@ -0,0 +1,299 @@
+'''Streaming reductions of area detector frames.
+
+Frames are pulled one at a time from whatever iterable is given, usually the
+lazy sequence returned by dataportal.get_images, so memory stays at a single
+frame no matter how many frames are in a run.
+'''
+
+import numpy as np
+
+
+class RunningAverage(object):
+    '''Accumulate the mean of a sequence of frames in a float buffer.
+
+    dark -- optional dark frame.  It is subtracted once from the mean,
+            which is the same as subtracting it from every frame.
+    scale -- optional per-pixel factor, e.g., from corrections, that
+             multiplies the dark corrected mean
+    '''
+
+    def __init__(self, dark=None, scale=None):
+        self.dark = dark
+        self.scale = scale
+        self.count = 0
+        self._total = None
+        return
+
+
+    def add(self, frame):
+        '''Add one frame to the accumulator.
+        '''
+        if self._total is None:
+            self._total = np.array(frame, dtype=np.float64)
+        else:
+            self._total += frame
+        self.count += 1
+        return
+
+
+    def mean(self):
+        '''Return the dark corrected mean frame or None if nothing was added.
+        '''
+        if not self.count:
+            return None
+        rv = self._total / self.count
+        if self.dark is not None:
+            rv -= self.dark
+        if self.scale is not None:
+            rv *= self.scale
+        return rv
+
+# class RunningAverage
+
+
+def average_frames(frames, dark=None, scale=None):
+    '''Return the dark corrected mean of frames and the number of frames used.
+
+    frames   -- iterable of 2D arrays, consumed one frame at a time
+    dark     -- optional dark frame to subtract
+    scale    -- optional per-pixel factor applied to the mean
+    '''
+    acc = RunningAverage(dark, scale)
+    for frame in frames:
+        acc.add(frame)
+    return acc.mean(), acc.count
+
+
+class ClippedAverage(object):
+    '''Accumulate the mean of frames with zingers and other outliers rejected.
+
+    Frames are buffered in chunks of chunk_size, so memory is bounded by
+    one chunk.  In a chunk a pixel value is rejected when it deviates from
+    the chunk median by more than nsigma times the noise, estimated from the
+    median absolute deviation and never below the counting noise.  Chunks
+    of less than 3 frames are compared with the previous chunk.
+
+    dark     -- optional dark frame subtracted from the mean
+    scale    -- optional per-pixel factor that multiplies the mean
+    method   -- 'sigma_clip' averages the accepted values, 'median' the
+                chunk medians
+    nsigma   -- rejection threshold in units of the noise
+    chunk_size -- number of frames combined at a time
+
+    count, rejected and nonfinite are the numbers of added frames, of
+    rejected pixel values and of NaN or infinite pixel values.
+    '''
+
+    def __init__(self, dark=None, scale=None, method='sigma_clip', nsigma=5., chunk_size=8):
+        if method not in COMBINE_METHODS or method == 'mean':
+            raise ValueError('method must be sigma_clip or median, not %r' % (method,))
+        self.dark = dark
+        self.scale = scale
+        self.method = method
+        self.nsigma = nsigma
+        self.chunk_size = max(int(chunk_size), 3)
+        self.count = 0
+        self.rejected = 0
+        self.nonfinite = 0
+        self._buffer = []
+        self._total = None
+        self._weight = None
+        self._reference = None
+        return
+
+
+    def add(self, frame):
+        '''Add one frame to the accumulator.
+        '''
+        self._buffer.append(np.array(frame, dtype=np.float32))
+        self.count += 1
+        if len(self._buffer) >= self.chunk_size:
+            self._flush()
+        return
+
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        chunk = np.stack(self._buffer)
+        self._buffer = []
+        bad = ~np.isfinite(chunk)
+        nbad = int(bad.sum())
+        if nbad:
+            self.nonfinite += nbad
+            chunk[bad] = np.nan
+        n = len(chunk)
+        if self._total is None:
+            self._total = np.zeros(chunk.shape[1:])
+            self._weight = np.zeros(chunk.shape[1:], dtype=np.int64)
+        if n >= 3:
+            median = np.nanmedian(chunk, axis=0) if nbad else np.median(chunk, axis=0)
+            # a non-finite value must not turn the scatter of its pixel into NaN
+            mad = (np.nanmedian if nbad else np.median)(np.abs(chunk - median), axis=0)
+            sigma = np.maximum(1.4826 * mad, np.sqrt(np.abs(median)))
+            self._reference = (median, sigma)
+        if self.method == 'median' and n >= 3:
+            # frames that are NaN in every value keep the pixel out
+            ok = np.isfinite(median)
+            self._total[ok] += n * median[ok]
+            self._weight[ok] += n
+            return
+        if self._reference is None:
+            keep = ~bad
+        else:
+            median, sigma = self._reference
+            with np.errstate(invalid='ignore'):
+                keep = np.abs(chunk - median) <= self.nsigma * sigma
+        self.rejected += int(keep.size - keep.sum()) - nbad
+        self._total += np.where(keep, chunk, 0).sum(axis=0)
+        self._weight += keep.sum(axis=0)
+        return
+
+
+    def mean(self):
+        '''Return the dark corrected mean frame or None if nothing was added.
+
+        Pixels without any accepted value take the median of the last chunk.
+        '''
+        self._flush()
+        if not self.count:
+            return None
+        rv = np.zeros(self._total.shape)
+        np.divide(self._total, self._weight, out=rv, where=self._weight > 0)
+        empty = self._weight == 0
+        if empty.any() and self._reference is not None:
+            rv[empty] = np.nan_to_num(self._reference[0][empty])
+        if self.dark is not None:
+            rv -= self.dark
+        if self.scale is not None:
+            rv *= self.scale
+        return rv
+
+# class ClippedAverage
+
+
+COMBINE_METHODS = ('mean', 'sigma_clip', 'median')
+
+
+def combine_frames(frames, dark=None, scale=None, method='sigma_clip', **kwargs):
+    '''Return the dark corrected combined frame and the accumulator used.
+
+    frames   -- iterable of 2D arrays, consumed one frame at a time
+    method   -- 'mean' for the plain average, or 'sigma_clip' or 'median'
+                to reject outliers, see ClippedAverage
+    kwargs   -- nsigma and chunk_size of ClippedAverage
+
+    The accumulator holds the number of frames in count and, for the
+    robust methods, the rejected and nonfinite pixel counts.
+    '''
+    if method == 'mean':
+        acc = RunningAverage(dark, scale)
+    else:
+        acc = ClippedAverage(dark, scale, method, **kwargs)
+    for frame in frames:
+        acc.add(frame)
+    return acc.mean(), acc
+
+
+def bad_pixel_mask(frames, nsigma=8., min_frames=5):
+    '''Return a boolean mask of hot, dead and noisy pixels found in dark frames.
+
+    Hot and dead pixels have a dark level far above or below that of the
+    whole detector.  With at least min_frames frames, pixels whose frame to
+    frame scatter is far above the typical one, or exactly zero, are noisy
+    or stuck.  With fewer frames integer counts often repeat by chance, so
+    the scatter is not tested.  Levels are compared in units of the median
+    absolute deviation.
+    '''
+    n = 0
+    mean = None
+    m2 = None
+    for frame in frames:
+        x = np.asarray(frame, dtype=np.float64)
+        n += 1
+        if mean is None:
+            mean = x.copy()
+            m2 = np.zeros_like(x)
+            continue
+        delta = x - mean
+        mean += delta / n
+        m2 += delta * (x - mean)
+    if mean is None:
+        return None
+
+    def outliers(values, upper_only=False):
+        med = np.median(values)
+        mad = max(1.4826 * np.median(np.abs(values - med)), 1e-6)
+        if upper_only:
+            return values - med > nsigma * mad
+        return np.abs(values - med) > nsigma * mad
+
+    rv = outliers(mean) | ~np.isfinite(mean)
+    if n >= max(min_frames, 2):
+        std = np.sqrt(m2 / (n - 1))
+        rv |= outliers(std, upper_only=True) | (std == 0)
+    return rv
+
+
+def apply_mask(img, mask):
+    '''Set the pixels of img where mask is True to NaN, in place.
+
+    img must be a floating point array.  A missing mask or one of another
+    shape leaves img unchanged.
+    '''
+    if mask is None or mask.shape != img.shape:
+        return
+    if not np.issubdtype(img.dtype, np.floating):
+        raise TypeError('bad pixels can only be masked in floating point images, not %s' % img.dtype)
+    img[mask] = np.nan
+    return
+
+
+def corrected_frames(frames, dark=None, dtype=np.float32, scale=None):
+    '''Yield dark corrected copies of frames one at a time.
+
+    frames   -- iterable of 2D arrays
+    dark     -- optional dark frame to subtract
+    dtype    -- floating type of the yielded frames, so that subtraction
+                of unsigned detector counts cannot wrap around
+    scale    -- optional per-pixel factor that multiplies every corrected
+                frame in place
+    '''
+    for frame in frames:
+        img = np.array(frame, dtype=dtype)
+        if dark is not None:
+            img -= dark
+        if scale is not None:
+            img *= scale
+        yield img
+
+
+def last_frame(frames):
+    '''Return the last frame of a lazy sequence without loading the others.
+    '''
+    try:
+        n = len(frames)
+    except TypeError:
+        n = None
+    if n:
+        return np.asarray(frames[n - 1])
+    rv = None
+    for rv in frames:
+        pass
+    return None if rv is None else np.asarray(rv)
+
+
+def downsample(img, max_size=512):
+    '''Return a block averaged copy of img no larger than max_size pixels.
+
+    img      -- 2D array
+    max_size -- largest allowed dimension of the result
+    '''
+    img = np.asarray(img)
+    step = int(np.ceil(max(img.shape) / float(max_size)))
+    if step <= 1:
+        return img
+    h = img.shape[0] // step * step
+    w = img.shape[1] // step * step
+    blocks = img[:h, :w].reshape(h // step, step, w // step, step)
+    return blocks.mean(axis=(1, 3))
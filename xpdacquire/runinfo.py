@@ -0,0 +1,158 @@
+'''Cheap access to acquisition parameters of a run.
+
+Exposure time, number of frames, frame timestamps and motor positions are
+read from the run-start and descriptor documents when they are recorded
+there, otherwise from the events without filling the image data.  Only the
+first event is read when a single scalar is asked for.  Results are cached
+per run uid, so repeated calls from the save and search paths are free.
+'''
+
+import threading
+from collections import OrderedDict
+
+from xpdacquire.devices import get_events
+
+
+MAX_CACHED_RUNS = 256
+
+_cache = OrderedDict()
+# the export thread reads runs while the next point is acquired
+_lock = threading.Lock()
+
+
+def _entry(header):
+    uid = header.start.uid
+    with _lock:
+        rv = _cache.pop(uid, None)
+        if rv is None:
+            rv = {}
+        _cache[uid] = rv
+        while len(_cache) > MAX_CACHED_RUNS:
+            _cache.popitem(last=False)
+    return rv
+
+
+def clear_cache():
+    '''Forget all cached run information.
+    '''
+    with _lock:
+        _cache.clear()
+    return
+
+
+def _first_event(header):
+    entry = _entry(header)
+    if 'first_event' not in entry:
+        if 'events' in entry:
+            events = entry['events']
+            entry['first_event'] = events[0] if events else None
+        else:
+            entry['first_event'] = next(iter(get_events(header, fill=False)), None)
+    return entry['first_event']
+
+
+def _events(header):
+    entry = _entry(header)
+    if 'events' not in entry:
+        entry['events'] = [{'seq_num' : e.get('seq_num'),
+                            'time' : e['time'],
+                            'data' : dict(e['data']),
+                            'timestamps' : dict(e['timestamps'])}
+                           for e in get_events(header, fill=False)]
+    return entry['events']
+
+
+def _from_descriptors(header, suffix):
+    '''Return the value of the first configuration field ending with suffix.
+    '''
+    for desc in header.descriptors:
+        for conf in (desc.get('configuration') or {}).values():
+            data = conf.get('data') or {}
+            for k in sorted(data):
+                if k.endswith(suffix):
+                    return data[k]
+    return None
+
+
+def acquire_time(header):
+    '''Return the detector exposure time of a run.
+
+    argument:
+        header - obj - a bluesky header object
+    '''
+    entry = _entry(header)
+    if 'acquire_time' not in entry:
+        rv = _from_descriptors(header, 'acquire_time')
+        if rv is None:
+            event = _first_event(header)
+            if event is None:
+                raise RuntimeError('header with uid = %s has no events' % header.start.uid)
+            fields = [el for el in event['data'] if el.endswith('acquire_time')]
+            if not fields:
+                raise RuntimeError('header with uid = %s does not record acquire_time' % header.start.uid)
+            rv = event['data'][fields[0]]
+        entry['acquire_time'] = rv
+    return entry['acquire_time']
+
+
+def num_frames(header):
+    '''Return the number of events, i.e., of image frames of a run.
+
+    argument:
+        header - obj - a bluesky header object
+    '''
+    entry = _entry(header)
+    if 'num_frames' not in entry:
+        try:
+            rv = header.stop['num_events']
+        except (KeyError, AttributeError, TypeError):
+            rv = None
+        if isinstance(rv, dict):
+            rv = sum(rv.values())
+        if rv is None:
+            rv = len(_events(header))
+        entry['num_frames'] = rv
+    return entry['num_frames']
+
+
+def timestamps(header, field):
+    '''Return a list of the per-frame timestamps of field.
+
+    argument:
+        header - obj - a bluesky header object
+        field - str - data key, e.g., 'pe1_image_lightfield'
+    '''
+    return [e['timestamps'][field] for e in _events(header)]
+
+
+def event_times(header):
+    '''Return a list of the times of all events of a run.
+
+    argument:
+        header - obj - a bluesky header object
+    '''
+    return [e['time'] for e in _events(header)]
+
+
+def event_data(header, field):
+    '''Return a list of the values of a scalar data field, one per event.
+
+    argument:
+        header - obj - a bluesky header object
+        field - str - data key, e.g., 'pe1_acquire_time'
+
+    Raises KeyError when field is not recorded in the run.
+    '''
+    return [e['data'][field] for e in _events(header)]
+
+
+def motor_positions(header, motor_name):
+    '''Return a list of the positions of motor_name, one per frame.
+
+    argument:
+        header - obj - a bluesky header object
+        motor_name - str - name of the motor in the scan
+
+    Raises KeyError when motor_name is not recorded in the run.
+    '''
+    return event_data(header, motor_name)
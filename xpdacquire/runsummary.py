@@ -0,0 +1,181 @@
+'''Columnar summary of many runs for search result tables.
+
+A summary row holds the fields of a run that are shown after a search:
+uid, start time, sample, exposure time, number of frames, dark and
+calibration flags, temperature, comments and the tif file name stub.  Rows
+are built once per run uid and cached, so displaying an overlapping search
+again only reads the runs that are new.  The columns the run catalog holds
+are filled from one catalog query, the data broker is only asked for the
+other columns and for runs missing in the catalog.
+'''
+
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+from xpdacquire import runinfo
+from xpdacquire.catalog import run_catalog
+
+
+MAX_CACHED_ROWS = 100000
+
+# column names and numpy types of a summary
+COLUMNS = OrderedDict([
+    ('uid', object),
+    ('time', np.float64),
+    ('sample_name', object),
+    ('acquire_time', np.float64),
+    ('num_frames', np.int64),
+    ('isdark', np.bool_),
+    ('iscalib', np.bool_),
+    ('temperature', np.float64),
+    ('comments', object),
+    ('features', object),
+])
+
+# columns stored in the run catalog and their names there
+CATALOG_COLUMNS = OrderedDict([
+    ('uid', 'uid'),
+    ('time', 'start_time'),
+    ('sample_name', 'sample_name'),
+    ('acquire_time', 'acquire_time'),
+    ('isdark', 'isdark'),
+    ('iscalib', 'iscalib'),
+])
+
+_rows = OrderedDict()
+
+_INDEX = dict((name, i) for i, name in enumerate(COLUMNS))
+
+_NUMBER = re.compile(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?')
+
+
+def clear_cache():
+    '''Forget all cached summary rows.
+    '''
+    _rows.clear()
+    return
+
+
+def _temperature(start):
+    '''Return the sample temperature recorded in start as float or nan.
+
+    tseries stores it as number or as string like '300.0k'.
+    '''
+    sample = start.get('sample') or {}
+    if not isinstance(sample, dict):
+        return np.nan
+    for key in ('temp', 'temperature'):
+        value = sample.get(key)
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            m = _NUMBER.search(value)
+            if m:
+                return float(m.group())
+    return np.nan
+
+
+def _num_frames(header):
+    try:
+        return runinfo.num_frames(header)
+    except Exception:
+        return -1
+
+
+def _acquire_time(header, entry):
+    if entry is not None and entry['acquire_time'] is not None:
+        return entry['acquire_time']
+    try:
+        return float(runinfo.acquire_time(header))
+    except (RuntimeError, TypeError, ValueError):
+        return np.nan
+
+
+def _summary_row(header, entry):
+    from xpdacquire.xpd_search import filename_gen
+    start = header.start
+    iscalib = start.get('iscalibration', start.get('iscalib', False))
+    return (start['uid'], start.get('time', np.nan), start.get('sample_name', ''),
+            _acquire_time(header, entry), _num_frames(header),
+            bool(start.get('isdark', False)), bool(iscalib), _temperature(start),
+            start.get('comments', 'None'), filename_gen(start))
+
+
+def _catalog_value(entry, name):
+    value = entry[CATALOG_COLUMNS[name]]
+    if value is None:
+        return '' if name == 'sample_name' else np.nan
+    if COLUMNS[name] is np.bool_:
+        return bool(value)
+    return value
+
+
+def _store(uid, row):
+    _rows[uid] = row
+    while len(_rows) > MAX_CACHED_ROWS:
+        _rows.popitem(last=False)
+    return
+
+
+def summary_columns(headers, columns=None):
+    '''Return the summary of runs as dictionary of numpy arrays, one per column.
+
+    headers  -- a header, a list of headers or the result of a search.
+                Results of time_search only pull the headers of runs that
+                are needed and not cached yet.
+    columns  -- names of the columns to return, default all of COLUMNS.
+                When all of them are in CATALOG_COLUMNS, catalogued runs
+                are summarized without the data broker.
+    '''
+    columns = list(COLUMNS) if columns is None else list(columns)
+    unknown = [name for name in columns if name not in COLUMNS]
+    if unknown:
+        raise ValueError('unknown summary columns %r' % unknown)
+    if isinstance(headers, dict):
+        headers = [headers]
+    if hasattr(headers, 'uids'):
+        uids = list(headers.uids)
+    else:
+        headers = list(headers)
+        uids = [h['start']['uid'] for h in headers]
+    entries = run_catalog().entries(uids)
+    needbroker = any(name not in CATALOG_COLUMNS for name in columns)
+    needtime = 'acquire_time' in columns
+    rows = {}
+    for i, uid in enumerate(uids):
+        entry = entries.get(uid)
+        if (not needbroker and entry is not None and
+                not (needtime and entry['acquire_time'] is None)):
+            continue
+        row = _rows.get(uid)
+        if row is None:
+            header = headers[i]
+            row = _summary_row(header, entry)
+            try:
+                finished = header.stop is not None
+            except (KeyError, AttributeError):
+                finished = False
+            # a run that is still acquired may add frames, do not keep its row
+            if finished:
+                _store(uid, row)
+        rows[uid] = row
+    rv = OrderedDict()
+    for name in columns:
+        k = _INDEX[name]
+        values = [rows[uid][k] if uid in rows else _catalog_value(entries[uid], name)
+                  for uid in uids]
+        rv[name] = np.array(values, dtype=COLUMNS[name])
+    return rv
+
+
+def summary_table(headers, columns=None):
+    '''Return the summary of runs as a pandas DataFrame with typed columns.
+
+    headers  -- a header, a list of headers or the result of a search
+    columns  -- names of the columns to return, default all of COLUMNS
+    '''
+    import pandas as pd
+    columns = list(COLUMNS) if columns is None else list(columns)
+    return pd.DataFrame(summary_columns(headers, columns), columns=columns)
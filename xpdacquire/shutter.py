@@ -0,0 +1,292 @@
+'''Event driven control of the XPD photon shutter.
+
+The controller puts to the open or close PV and then waits for the shutter
+value to change, instead of sleeping a fixed time per try.  It works with
+any object that has a value attribute and open_pv/close_pv objects with a
+put method.  When the shutter supports ophyd style subscribe/clear_sub the
+wait is woken by the value-change callback, otherwise the value is polled.
+Inside bluesky plans the same transitions are yielded as messages by
+open_plan and close_plan, so the run engine is never blocked.
+'''
+
+import time
+import threading
+
+
+class ShutterController(object):
+    '''Open and close a shutter with timeout, retries and backoff.
+
+    shutter  -- shutter object, e.g., photon_shutter
+    timeout  -- seconds to wait for the first try to change the value
+    retries  -- maximum number of puts per transition
+    backoff  -- factor applied to timeout after every failed try
+    poll_interval -- seconds between value checks without subscriptions
+    verbose  -- print value changes and failures
+    '''
+
+    def __init__(self, shutter, timeout=4., retries=5, backoff=1.5,
+                 poll_interval=0.05, verbose=True):
+        self.shutter = shutter
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        self.metrics = []
+        return
+
+
+    @property
+    def is_open(self):
+        return self.shutter.value == 1
+
+
+    def open(self, retries=None):
+        '''Open the shutter, return True when it is open.
+        '''
+        return self._transition('open', 1, self.shutter.open_pv, retries)
+
+
+    def close(self, retries=None):
+        '''Close the shutter, return True when it is closed.
+        '''
+        return self._transition('close', 0, self.shutter.close_pv, retries)
+
+
+    def open_plan(self, retries=None):
+        '''Generate plan messages that open the shutter.
+
+        Raises RuntimeError when the shutter does not open.
+        '''
+        return self._transition_plan('open', 1, self.shutter.open_pv, retries)
+
+
+    def close_plan(self, retries=None):
+        '''Generate plan messages that close the shutter.
+
+        Raises RuntimeError when the shutter does not close.
+        '''
+        return self._transition_plan('close', 0, self.shutter.close_pv, retries)
+
+
+    def latency_summary(self):
+        '''Return statistics of recorded transitions keyed by 'open' and 'close'.
+
+        Every value is a dictionary with the number of transitions, of
+        failures, of puts and the mean and maximum seconds per transition.
+        '''
+        rv = {}
+        for name in ('open', 'close'):
+            recs = [m for m in self.metrics if m['transition'] == name]
+            secs = [m['seconds'] for m in recs]
+            rv[name] = {
+                'count' : len(recs),
+                'failures' : sum(1 for m in recs if not m['success']),
+                'tries' : sum(m['tries'] for m in recs),
+                'mean_seconds' : sum(secs) / len(secs) if secs else 0.0,
+                'max_seconds' : max(secs) if secs else 0.0,
+            }
+        return rv
+
+
+    def _transition(self, name, target, pv, retries):
+        if retries is None:
+            retries = self.retries
+        t0 = time.time()
+        timeout = self.timeout
+        tries = 0
+        while self.shutter.value != target and tries < retries:
+            tries += 1
+            self._put_and_wait(pv, target, timeout)
+            if self.verbose:
+                print('photon_shutter value after %s_pv.put(1): %s' % (name, self.shutter.value))
+            timeout *= self.backoff
+        success = self.shutter.value == target
+        self.metrics.append({'transition' : name, 'tries' : tries,
+                             'seconds' : time.time() - t0, 'success' : success})
+        if not success and self.verbose:
+            print('photon shutter failed to %s after %i tries. Please check before continuing' % (name, tries))
+        return success
+
+
+    def _transition_plan(self, name, target, pv, retries):
+        from bluesky import Msg
+        if retries is None:
+            retries = self.retries
+        t0 = time.time()
+        timeout = self.timeout
+        tries = 0
+        while self.shutter.value != target and tries < retries:
+            tries += 1
+            yield Msg('set', pv, 1, block_group='shutter')
+            yield Msg('wait', None, 'shutter')
+            deadline = time.time() + timeout
+            # the run engine keeps processing while the value is polled
+            while self.shutter.value != target and time.time() < deadline:
+                yield Msg('sleep', None, self.poll_interval)
+            timeout *= self.backoff
+        success = self.shutter.value == target
+        self.metrics.append({'transition' : name, 'tries' : tries,
+                             'seconds' : time.time() - t0, 'success' : success})
+        if not success:
+            raise RuntimeError('photon shutter failed to %s after %i tries' % (name, tries))
+        return
+
+
+    def _put_and_wait(self, pv, target, timeout):
+        reached = threading.Event()
+        def cb(value=None, **kwargs):
+            if value == target:
+                reached.set()
+        subscribe = getattr(self.shutter, 'subscribe', None)
+        if subscribe is not None:
+            subscribe(cb)
+        try:
+            pv.put(1)
+            deadline = time.time() + timeout
+            while self.shutter.value != target:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                # a callback ends the wait early, polling covers shutters
+                # without subscriptions or missed callbacks
+                if reached.wait(min(remaining, self.poll_interval)):
+                    break
+        finally:
+            if subscribe is not None:
+                self.shutter.clear_sub(cb)
+        return
+
+# class ShutterController
+
+
+class SimulatedShutter(object):
+    '''Shutter stand-in for tests and benchmarks.
+
+    delay    -- seconds between a put and the value change
+    ignore_puts -- number of initial puts that have no effect, to exercise
+                   retries
+    '''
+
+    def __init__(self, delay=0.1, ignore_puts=0, value=0):
+        self.value = value
+        self.delay = delay
+        self.ignore_puts = ignore_puts
+        self.open_pv = _SimulatedPV(self, 1)
+        self.close_pv = _SimulatedPV(self, 0)
+        self._subs = []
+        return
+
+
+    def subscribe(self, cb):
+        self._subs.append(cb)
+        return
+
+
+    def clear_sub(self, cb):
+        self._subs.remove(cb)
+        return
+
+
+    def _request(self, target):
+        if self.ignore_puts > 0:
+            self.ignore_puts -= 1
+            return
+        timer = threading.Timer(self.delay, self._set, (target,))
+        timer.daemon = True
+        timer.start()
+        return
+
+
+    def _set(self, value):
+        old_value, self.value = self.value, value
+        for cb in list(self._subs):
+            cb(value=value, old_value=old_value, timestamp=time.time())
+        return
+
+# class SimulatedShutter
+
+
+class _SimulatedPV(object):
+
+    def __init__(self, shutter, target):
+        self._shutter = shutter
+        self._target = target
+        return
+
+
+    def put(self, value):
+        if value:
+            self._shutter._request(self._target)
+        return
+
+
+    def set(self, value):
+        self.put(value)
+        return
+
+
+class DosePolicy(object):
+    '''Decide if the shutter closes while a series moves between points.
+
+    mode     -- 'cycle' closes the shutter after every point, 'open' keeps
+                it open for the whole series and 'settle' closes it only
+                for moves that are expected to take longer than
+                max_open_idle seconds
+    max_open_idle -- seconds of beam on the idle sample that are accepted
+                in 'settle' mode.  The duration of a move is estimated by
+                the previous one, the first move always closes the shutter.
+    '''
+
+    modes = ('cycle', 'open', 'settle')
+
+    def __init__(self, mode='cycle', max_open_idle=30.):
+        if mode not in self.modes:
+            emsg = 'invalid shutter policy %r, use one of %s' % (mode, ', '.join(self.modes))
+            raise ValueError(emsg)
+        self.mode = mode
+        self.max_open_idle = max_open_idle
+        self.last_move = None
+        return
+
+
+    @property
+    def cycles_per_point(self):
+        '''True when the shutter is opened and closed for every point.'''
+        return self.mode == 'cycle'
+
+
+    def close_before_move(self):
+        '''Return True when the shutter should be closed for the next move.
+        '''
+        if self.mode == 'open':
+            return False
+        if self.mode == 'settle':
+            return self.last_move is None or self.last_move > self.max_open_idle
+        return True
+
+
+    def record_move(self, seconds):
+        '''Remember the duration of the last move between points.
+        '''
+        self.last_move = seconds
+        return
+
+# class DosePolicy
+
+
+def report_saved_time(controller, npoints, first_metric=0):
+    '''Print and return seconds saved by not cycling the shutter per point.
+
+    controller -- ShutterController used during the series
+    npoints  -- number of points in the series
+    first_metric -- index of the first controller metric of the series
+    '''
+    # transitions of a shutter that was already in place put nothing
+    recs = [m for m in controller.metrics[first_metric:] if m['tries']]
+    avoided = max(2 * npoints - len(recs), 0)
+    secs = [m['seconds'] for m in controller.metrics if m['tries']]
+    mean_latency = sum(secs) / len(secs) if secs else 0.0
+    saved = avoided * mean_latency
+    print('%i shutter transitions avoided, about %.1f s saved' % (avoided, saved))
+    return saved
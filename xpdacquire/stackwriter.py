@@ -0,0 +1,192 @@
+'''Writers that put all frames of a run in one multi-frame file.
+
+A run of thousands of frames becomes a single file instead of thousands of
+tif files.  HDF5 files, written with h5py, hold the frames in a chunked and
+compressed 'data' dataset of shape (frames, rows, columns) together with
+'timestamps' and, for motor scans, 'motor_positions' datasets.  BigTIFF
+stacks, written with tifffile, hold one page per frame and store the
+timestamp and motor position of a frame as JSON in the page description.
+
+Both writers append: frames can be added while the run is acquired and an
+existing file is extended when it is opened again.
+'''
+
+import os
+import json
+
+import numpy as np
+
+
+STACK_FORMATS = ('hdf5', 'bigtiff')
+STACK_EXTENSIONS = {'hdf5' : '.h5', 'bigtiff' : '.tif'}
+
+
+class HDF5StackWriter(object):
+    '''Append frames to resizable datasets in an HDF5 file.
+
+    path     -- file name, an existing file is appended to
+    compression -- h5py compression filter, e.g., 'gzip' or 'lzf', or None
+    motor    -- name of the scanned motor, stored as attribute of the
+                'motor_positions' dataset
+    attrs    -- dictionary of file attributes, e.g., uid and acquire_time
+    '''
+
+    def __init__(self, path, compression='gzip', motor=None, attrs=None):
+        try:
+            import h5py
+        except ImportError:
+            raise RuntimeError('h5py is required to write HDF5 stacks, use stack_format="bigtiff" instead')
+        self.path = path
+        self.compression = compression
+        self.motor = motor
+        self._file = h5py.File(path, 'a')
+        for k, v in (attrs or {}).items():
+            self._file.attrs[k] = v
+        self.count = len(self._file['data']) if 'data' in self._file else 0
+        return
+
+
+    def __len__(self):
+        return self.count
+
+
+    def append(self, frame, timestamp, motor_position=None):
+        '''Add frame with its timestamp and motor position to the file.
+        '''
+        frame = np.asarray(frame)
+        f = self._file
+        if 'data' not in f:
+            f.create_dataset('data', shape=(0,) + frame.shape,
+                             maxshape=(None,) + frame.shape, dtype=frame.dtype,
+                             chunks=(1,) + frame.shape, compression=self.compression)
+            f.create_dataset('timestamps', shape=(0,), maxshape=(None,), dtype='f8')
+            if self.motor is not None:
+                ds = f.create_dataset('motor_positions', shape=(0,), maxshape=(None,), dtype='f8')
+                ds.attrs['motor'] = self.motor
+        n = len(f['data'])
+        f['data'].resize(n + 1, axis=0)
+        f['data'][n] = frame
+        f['timestamps'].resize((n + 1,))
+        f['timestamps'][n] = timestamp
+        if 'motor_positions' in f:
+            f['motor_positions'].resize((n + 1,))
+            f['motor_positions'][n] = np.nan if motor_position is None else motor_position
+        # readers see complete frames while the run is acquired
+        f.flush()
+        self.count = n + 1
+        return
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+# class HDF5StackWriter
+
+
+class TiffStackWriter(object):
+    '''Append frames as pages of a BigTIFF file.
+
+    path     -- file name, an existing file is appended to
+    compression -- zlib compression level 0-9, 0 means no compression
+    motor    -- name of the scanned motor, stored with every page
+    attrs    -- dictionary stored in the description of every page
+    '''
+
+    def __init__(self, path, compression=6, motor=None, attrs=None):
+        try:
+            import tifffile
+        except ImportError:
+            raise RuntimeError('tifffile is required to write BigTIFF stacks')
+        self.path = path
+        self.compression = compression
+        self.motor = motor
+        self.attrs = dict(attrs or {})
+        self.count = 0
+        # kept open for the whole run, reopening parses all pages written so far
+        self._tif = tifffile.TiffWriter(path, bigtiff=True, append=True)
+        return
+
+
+    def __len__(self):
+        return self.count
+
+
+    def append(self, frame, timestamp, motor_position=None):
+        '''Add frame as a new page with its timestamp and motor position.
+        '''
+        md = dict(self.attrs, timestamp=timestamp)
+        if self.motor is not None:
+            md['motor'] = self.motor
+            md['motor_position'] = motor_position
+        tif = self._tif
+        # every frame is a page of its own with its description
+        kwargs = {'description' : json.dumps(md), 'contiguous' : False}
+        if self.compression:
+            try:
+                tif.write(np.asarray(frame), compression='zlib',
+                          compressionargs={'level' : self.compression}, **kwargs)
+            except (TypeError, AttributeError):
+                # tifffile before 2022 has save(compress=level)
+                tif.save(np.asarray(frame), compress=self.compression, **kwargs)
+        else:
+            write = getattr(tif, 'write', None) or tif.save
+            write(np.asarray(frame), **kwargs)
+        # readers see complete frames while the run is acquired
+        fh = getattr(tif, 'filehandle', None) or tif._fh
+        fh.flush()
+        self.count += 1
+        return
+
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+# class TiffStackWriter
+
+
+def open_stack(path, stack_format='hdf5', compression=True, motor=None, attrs=None,
+               append=True):
+    '''Return a writer that appends frames to a single multi-frame file.
+
+    path     -- file name, the extension of stack_format is added if missing
+    stack_format -- 'hdf5' or 'bigtiff'
+    compression -- compress frames without loss when True
+    motor    -- name of the scanned motor, when positions are recorded
+    attrs    -- dictionary of run information stored in the file
+    append   -- add frames to an existing file, otherwise it is replaced
+    '''
+    if stack_format not in STACK_FORMATS:
+        emsg = 'invalid stack format %r, use one of %s' % (stack_format, ', '.join(STACK_FORMATS))
+        raise ValueError(emsg)
+    ext = STACK_EXTENSIONS[stack_format]
+    if not path.endswith(ext):
+        path += ext
+    if not append and os.path.exists(path):
+        os.remove(path)
+    if stack_format == 'hdf5':
+        return HDF5StackWriter(path, 'gzip' if compression else None, motor, attrs)
+    return TiffStackWriter(path, 6 if compression else 0, motor, attrs)
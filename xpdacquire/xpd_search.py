@@ -2,32 +2,15 @@ import os
 import time
 import copy
 import datetime
-import matplotlib.pyplot as plt
-import matplotlib as mpl
 import numpy as np
-import pandas as pd
 import json
 
-import bluesky
-from bluesky.scans import *
-from bluesky.broker_callbacks import LiveImage
-from bluesky.callbacks import CallbackBase, LiveTable, LivePlot
-
-from ophyd.commands import *
-from ophyd.controls import *
-
-from dataportal import DataBroker as db
-from dataportal import get_events, get_table, get_images
-from metadatastore.commands import find_run_starts
-
 from xpdacquire.config import datapath
 from xpdacquire.utils import composition_analysis
-from tifffile import *
+from xpdacquire.devices import db, lookup
+from xpdacquire.runsummary import COLUMNS, summary_table
 
 
-pd.set_option('max_colwidth',50)
-pd.set_option('colheader_justify','left')
-
 default_keys = ['owner', 'beamline_id', 'group', 'config', 'scan_id'] # required by dataBroker
 feature_keys = ['sample_name','experimenters'] # required by XPD, time_stub and uid will be automatically added up as well
 
@@ -47,40 +30,35 @@ def _bluesky_RE():
     bluesky.register_mds.register_mds(RE)
     return RE
 
-'''def _bluesky_metadata_store():
-    Return the dictionary of bluesky global metadata.
-    
-    gs = _bluesky_global_state()
+def _bluesky_metadata_store():
+    '''Return the dictionary of bluesky global metadata.'''
+
+    gs = lookup('gs')
     return gs.RE.md
-'''
-
-ipshell = get_ipython()
-gs = ipshell.user_ns['gs']
-RE = _bluesky_RE()
-pe1 = ipshell.user_ns['pe1']
-cs700 = ipshell.user_ns['cs700']
-sh1 = ipshell.user_ns['sh1']
-gs.TEMP_CONTROLLER = cs700
-tth_cal = ipshell.user_ns['tth_cal']
-th_cal = ipshell.user_ns['th_cal']
-photon_shutter = ipshell.user_ns['photon_shutter']
+
+def _start_doc(header):
+    '''Return the run start document of header, or header if it is one.'''
+    try:
+        return header['start']
+    except KeyError:
+        return header
 
 def feature_gen(header):
     ''' generate a human readable file name. It is made of time + uid + sample_name + user
 
+    header can be a header object or the start document of a run.
     field will be skipped if it doesn't exist
     '''
-    uid = header.start.uid
-    time_stub = _timestampstr(header.start.time)
+    start = _start_doc(header)
 
     dummy_list = []
     for key in feature_keys:
         try:
             # truncate length
-            if len(header.start[key])>12:
-                value = header.start[key][:12]
+            if len(start[key])>12:
+                value = start[key][:12]
             else:
-                value = header.start[key]
+                value = start[key]
             # clear space
             dummy = [ ch for ch in list(value) if ch!=' ']
             dummy_list.append(''.join(dummy))  # feature list elements is at the first level, as it should be
@@ -110,7 +88,7 @@ def _MD_template():
     ''' use to generate idealized metadata structure, for pictorial memory and
     also for data cleaning.
     '''
-    #gs = _bluesky_global_state()
+    gs = lookup('gs')
     _clean_metadata()
     gs.RE.md['iscalib'] = 0
     gs.RE.md['isdark'] = 0
@@ -136,7 +114,7 @@ def _MD_template():
 def scan_info():
     ''' hard coded scan information. Aiming for our standardized metadata
     dictionary'''
-    #gs = _bluesky_global_state()
+    gs = lookup('gs')
     all_scan_info = []
     try:
         all_scan_info.append(gs.RE.md['scan_info']['scan_exposure_time'])
@@ -163,21 +141,24 @@ def write_config(d, config_f_name):
     # temporarily solution, need a more robust one later on
     import configparser
     config = configparser.ConfigParser()
-    for k,v in _dig_dict(d).items():
-        config[k] = {}
-        config[k] = v # temporarily use
-    with open(config_f_name+'.cfg', 'w') as configfile:
+    for k,v in d.items():
+        if isinstance(v, dict): # sections of the config file, as read by load_calibration
+            config[k] = v
+    if not config_f_name.endswith('.cfg'):
+        config_f_name += '.cfg'
+    with open(config_f_name, 'w') as configfile:
         config.write(configfile)
 
 def filename_gen(header):
     '''generate a file name of tif file. It contains time_stub, uid and feature
-    of your header'''
+    of your header. header can be a header object or the start document of a run'''
 
-    uid = header.start.uid[:5]
+    start = _start_doc(header)
+    uid = start['uid'][:5]
     try:
-        time_stub = _timestampstr(header.start.time)
+        time_stub = _timestampstr(start['time'])
     except KeyError:
-        tim_stub = 'Imcomplete_Scan'
+        time_stub = 'Imcomplete_Scan'
     feature = feature_gen(header)
     file_name = '_'.join([time_stub, uid, feature])
     return file_name
@@ -197,125 +178,311 @@ def run_script(script_name):
 ##### common functions #####
 
 
-def table_gen(headers):
+def table_gen(headers, columns=None):
     ''' Takes in a header list generated by search functions and return a table
     with metadata information
 
     Argument:
-    headers - list - a list of bluesky header objects
+    headers - list - a list of bluesky header objects, a single header or the result of time_search
+    columns - list - optional. columns to show, e.g., ['Features', 'acquire_time', 'temperature'].
+              Default is all columns of xpdacquire.runsummary.COLUMNS with 'Features' and 'Comments' first
 
+    Rows are cached per run, so showing an overlapping search again only reads the new runs.
+    Columns kept in the run catalog, e.g., acquire_time or sample_name, are read from it
+    without the data broker.
     '''
-    plt_list = list()
-    feature_list = list()
-    comment_list = list()
-    uid_list = list()
-
-    if type(list(headers)[0]) == str:
-        header_list = []
-        header_list.append(headers)
-    else:
-        header_list = headers
-
-    for header in header_list:
-        #feature = _feature_gen(header)
-        #time_stub = _timestampstr(header.stop.time)
-        #header_uid = header.start.uid
-        #uid_list.append(header_uid[:5])
-        #f_name = "_".join([time_stub, feature])
-        f_name =filename_gen(header)
-        feature_list.append(f_name)
+    import pandas as pd
+    pd.set_option('max_colwidth',50)
+    pd.set_option('colheader_justify','left')
 
-        try:
-            comment_list.append(header.start['comments'])
-        except KeyError:
-            comment_list.append('None')
-        try:
-            uid_list.append(header.start['uid'][:5])
-        except KeyError:
-            # jsut in case, it should never happen
-            print('Some of your data do not even have a uid, it is very dangerous, please contact beamline scientist immediately')
-    plt_list = [feature_list, comment_list] # u_id for ultimate search
-    inter_tab = pd.DataFrame(plt_list)
-    tab = inter_tab.transpose()
-    tab.columns=['Features', 'Comments' ]
-
-    return tab
+    titles = {'features':'Features', 'comments':'Comments'}
+    if columns is None:
+        columns = ['Features', 'Comments'] + [c for c in COLUMNS if c not in titles]
+    names = dict((t, c) for c, t in titles.items())
+    # only ask for the columns shown, catalog columns need no data broker
+    tab = summary_table(headers, [names.get(c, c) for c in columns])
+    return tab.rename(columns=titles)
 
 
-def time_search(startTime,stopTime=False,exp_day1=False,exp_day2=False):
+def time_search(startTime,stopTime=False,exp_day1=False,exp_day2=False,overlap=False,refresh=False):
     '''return list of experiments run in the interval startTime to stopTime
 
-    this function will return a set of events from dataBroker that happened
-    between startTime and stopTime on exp_day
+    this function will return the headers of runs that started between
+    startTime on exp_day1 and stopTime on exp_day2.  Runs are found in the
+    local run catalog.  The data broker is asked only for the parts of the
+    interval that were never read from it before, and the runs it returns
+    are added to the catalog.  Headers are pulled from the broker when they
+    are first used.
 
     arguments:
-    startTime - datetime time object or string or integer - time a the beginning of the
-                period that you want to pull data from.  The format could be an integer
-                between 0 and 24 to set it at a  whole hour, or a datetime object to do
-                it more precisely, e.g., datetime.datetime(13,17,53) for 53 seconds after
-                1:17 pm, or a string in the time form, e.g., '13:17:53' in the example above
-    stopTime -  datetime object or string or integer - as starTime but the latest time
-                that you want to pull data from
-    exp_day - str or datetime.date object - the day of the experiment.
+    startTime - datetime time object or string or number - time a the beginning of the
+                period that you want to pull data from.  The format could be a number
+                between 0 and 24 for the hour, e.g., 13.5 for 1:30 pm, a datetime.time
+                object to do it more precisely, e.g., datetime.time(13,17,53) for 53 seconds
+                after 1:17 pm, or a string in the time form, e.g., '13:17:53' in the example
+                above.  A datetime.datetime object or a string like '2015-11-20 13:17'
+                sets the day as well
+    stopTime -  as startTime but the latest time that you want to pull data from.
+                Default is now
+    exp_day1 - str or datetime.date object - the day of startTime, e.g., '2015-11-20'. Default is today
+    exp_day2 - str or datetime.date object - the day of stopTime. Default is exp_day1
+    overlap - bool - optional. also return runs that started earlier and were still running at startTime
+    refresh - bool - optional. ask the data broker for runs in the whole interval again and add them to the catalog
     '''
-    # date part
-    if exp_day1:
-        if exp_day2:
-            d0 = exp_day1
-            d1 = exp_day2
-        else:
-            d0 = exp_day1
-            d1 = d0
+    from xpdacquire.catalog import run_catalog, time_index
+    d0 = _to_date(exp_day1) if exp_day1 else datetime.date.today()
+    d1 = _to_date(exp_day2) if exp_day2 else d0
+    t0 = _to_datetime(startTime, d0)
+    if stopTime is False or stopTime is None:
+        t1 = datetime.datetime.now() # if stopTime is not specified, set current time as stopTime
     else:
-        d0 = datetime.datetime.today().date()
-        d1 = d0
+        t1 = _to_datetime(stopTime, d1)
+    timeHead = t0.strftime('%Y-%m-%d %H:%M:%S')
+    timeTail = t1.strftime('%Y-%m-%d %H:%M:%S')
+
+    ts0 = time.mktime(t0.timetuple()) + t0.microsecond * 1e-6
+    ts1 = time.mktime(t1.timetuple()) + t1.microsecond * 1e-6
+    catalog = run_catalog()
+    headers = {}
+    gaps = [(ts0, ts1)] if refresh else catalog.missing(ts0, ts1)
+    for g0, g1 in gaps:
+        # the broker query has a resolution of seconds
+        g0 = np.floor(g0)
+        g1 = np.ceil(g1)
+        now = time.time()
+        for header in db(start_time=_timestr(g0), stop_time=_timestr(g1)):
+            headers[header['start']['uid']] = header
+            catalog.record_header(header, catalog.acquire_time(header['start']['uid']))
+        # runs may still start after now
+        catalog.record_backfill(g0, min(g1, np.floor(now)))
+    uids = time_index().between(ts0, ts1, overlap)
+    header_time = LazyHeaders(uids, headers)
 
-    # time part
-    if stopTime:
+    print('||You assign a time search in the period:\n'+str(timeHead)+' and '+str(timeTail)+'||' )
+    print('||Your search gives out '+str(len(header_time))+' results||')
 
-        t0 = datetime.time(startTime)
-        t1 = datetime.time(stopTime)
+    return header_time
 
-    else:
-        now = datetime.datetime.now()
-        hr = now.hour
-        minu = now.minute
-        sec = now.second
-        stopTime = datetime.time(hr,minu,sec) # if stopTime is not specified, set current time as stopTime
 
-        t0 = datetime.time(startTime)
-        t1 = stopTime
+def _timestr(timestamp):
+    '''Return timestamp as local time string understood by the data broker.'''
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
 
-    timeHead = str(d0)+' '+str(t0)
-    timeTail = str(d1)+' '+str(t1)
 
-    header_time=db(start_time=timeHead,
-                   stop_time=timeTail)
+def _to_date(day):
+    '''Return day, a date, datetime or 'YYYY-mm-dd' string, as datetime.date.'''
+    if isinstance(day, datetime.datetime):
+        return day.date()
+    if isinstance(day, datetime.date):
+        return day
+    return datetime.datetime.strptime(str(day), '%Y-%m-%d').date()
 
-    event_time = get_events(header_time, fill=False)
-    event_time = list(event_time)
 
-    print('||You assign a time search in the period:\n'+str(timeHead)+' and '+str(timeTail)+'||' )
-    print('||Your search gives out '+str(len(header_time))+' results||')
+def _to_datetime(value, day):
+    '''Return value, a time of day on day or a full date and time, as datetime.datetime.'''
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.time):
+        return datetime.datetime.combine(day, value)
+    if isinstance(value, (int, float)):
+        if not 0 <= value <= 24:
+            raise ValueError('hour %s is not between 0 and 24' % value)
+        return datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(hours=value)
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            return datetime.datetime.combine(day, datetime.datetime.strptime(value, fmt).time())
+        except ValueError:
+            pass
+    raise ValueError('cannot understand time %r, use e.g. 13, \'13:17:53\' or \'2015-11-20 13:17\'' % (value,))
 
-    return header_time
+
+class LazyHeaders(object):
+    '''Sequence of headers that are pulled from the data broker when used.
+
+    uids     -- list of run uids
+    headers  -- optional dictionary of headers that are already known
+    '''
+
+    def __init__(self, uids, headers=None):
+        self.uids = list(uids)
+        self._headers = dict(headers or {})
+        return
+
+
+    def __len__(self):
+        return len(self.uids)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return LazyHeaders(self.uids[i], self._headers)
+        uid = self.uids[i]
+        if uid not in self._headers:
+            self._headers[uid] = db[uid]
+        return self._headers[uid]
+
+
+    def __iter__(self):
+        for i in range(len(self.uids)):
+            yield self[i]
+
+
+    def __repr__(self):
+        return '<%i headers>' % len(self.uids)
+
+# class LazyHeaders
 
 
 #### block of search functions ####
-def _list_keys( d, container):
-    ''' list out all keys in dictionary, d
-    Argument:
-        d - dict - input dictionary
-        containter - list - auxiliary list
+class KeyIndex(object):
+    '''Prefix index of the keys of a nested metadata dictionary.
+
+    Every key is stored in a trie of its characters together with the
+    dotted keychains that lead to it, e.g., 'sample.composition.Ni' for key
+    'Ni'.  refresh() compares the keychains of the dictionary with the
+    indexed ones and only inserts or removes the difference.  The keys are
+    walked on every refresh, so changes deep in nested dictionaries are
+    always seen, but the trie is only touched when the key structure
+    changed.
     '''
+
+    def __init__(self, d=None):
+        self._trie = {}
+        self._chains = {}
+        self._leaves = set()
+        self._indexed = set()
+        self._structure = None
+        if d is not None:
+            self.refresh(d)
+        return
+
+
+    def refresh(self, d):
+        '''Bring the index up to date with dictionary d.
+        '''
+        current = []
+        leaves = set()
+        _walk_keychains(d, (), current, leaves)
+        structure = (current, leaves)
+        if structure == self._structure:
+            return
+        current_set = set(current)
+        for chain in self._indexed - current_set:
+            self._remove(chain)
+        for chain in current:
+            if chain not in self._indexed:
+                self._add(chain)
+        self._indexed = current_set
+        self._leaves = leaves
+        self._structure = structure
+        return
+
+
+    def _add(self, chain):
+        key = chain[-1]
+        chains = self._chains.setdefault(key, [])
+        if chains:
+            chains.append(chain)
+            return
+        chains.append(chain)
+        node = self._trie
+        for ch in key:
+            node = node.setdefault(ch, {})
+        node[''] = key
+        return
+
+
+    def _remove(self, chain):
+        key = chain[-1]
+        chains = self._chains[key]
+        chains.remove(chain)
+        if chains:
+            return
+        del self._chains[key]
+        path = [self._trie]
+        for ch in key:
+            path.append(path[-1][ch])
+        del path[-1]['']
+        # prune branches that lead to no other key
+        for ch, parent in zip(reversed(key), reversed(path[:-1])):
+            if parent[ch]:
+                break
+            del parent[ch]
+        return
+
+
+    def keys(self, prefix=''):
+        '''Return a sorted list of all keys starting with prefix.
+
+        prefix can also be a list or tuple of prefixes.
+        '''
+        if isinstance(prefix, (list, tuple)):
+            rv = set()
+            for p in prefix:
+                rv.update(self.keys(p))
+            return sorted(rv)
+        node = self._trie
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return []
+        rv = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for ch, child in node.items():
+                if ch == '':
+                    rv.append(child)
+                else:
+                    stack.append(child)
+        return sorted(rv)
+
+
+    def keychains(self, key):
+        '''Return a list of the dotted keychains that end in key and hold a value that is not a dictionary.
+        '''
+        return ['.'.join(chain) for chain in self._chains.get(key, []) if chain in self._leaves]
+
+
+    def resolve(self, keys):
+        '''Return a dictionary of the dotted keychains of every key in keys.
+        '''
+        return dict((key, self.keychains(key)) for key in keys)
+
+# class KeyIndex
+
+
+def _walk_keychains(d, parent, container, leaves):
+    '''append the keychain tuples of all keys in nested d to container, and add those of non dictionary values to leaves'''
     if isinstance(d, dict):
-        # append keys in the first layer
-        container += d.keys()
-        # add keys in next layer
-        list(map(lambda x: _list_keys(x, container), d.values()))
+        for k, v in d.items():
+            chain = parent + (str(k),)
+            container.append(chain)
+            if not isinstance(v, dict):
+                leaves.add(chain)
+            _walk_keychains(v, chain, container, leaves)
     elif isinstance(d, list):
-        list(map(lambda x: _list_keys(x, container), d))
-    
+        # dictionaries in lists are searched with the keychain of the list
+        for v in d:
+            _walk_keychains(v, parent, container, leaves)
+
+
+_metadata_key_index = KeyIndex()
+
+def key_index(d=None):
+    '''Return an up to date KeyIndex of d, by default of the bluesky metadata store.
+
+    The index of the metadata store is kept and refreshed incrementally.
+    '''
+    if d is not None:
+        return KeyIndex(d)
+    _metadata_key_index.refresh(_bluesky_metadata_store())
+    return _metadata_key_index
 
 
 def get_keys(fuzzy_key, d=None, verbose=0):
@@ -323,44 +490,40 @@ def get_keys(fuzzy_key, d=None, verbose=0):
     Return all possible key names starting with fuzzy_key:
     Arguments:
 
-    fuzzy_key - str - possible key name, can be fuzzy like 'exp', 'sca' or nearly complete like 'experiment'
+    fuzzy_key - str - possible key name, can be fuzzy like 'exp', 'sca' or nearly complete like 'experiment'.
+                A list or tuple of such names is also accepted
     d        -- dictionary you want to search.  Use bluesky metadata store
                 when not specified.
     '''
-    if d is None:
-        #d = _bluesky_metadata_store()
-        d = gs.RE.md
-
-    container = []
-    _list_keys(d, container)
-    
+    index = key_index(d)
     if verbose:
         # default is not verbose
-        print('All keys in target dictionary are: %s' % str(container))
-    
-    # filter out desired name
-    out = list(filter(lambda x: x.startswtih(fuzzy_key), container))
-        # just a practice. It is equivalent to out = [ x for x in container if x.startswith(fuzzy_key)]
-    return out
+        print('All keys in target dictionary are: %s' % str(index.keys()))
+    return index.keys(fuzzy_key)
 
 def get_keychain(wanted_key, d=None):
-    ''' Return keychian(s) of specific key(s) in a nested dictionary
+    ''' Return keychian of specific key in a nested dictionary as a list of keys
+
+    Only the first keychain is returned, use get_keychains for all of them.
 
     argumets:
     wanted_key - str - name of key you want to search for
     d        -- dictionary you want to search.  Use bluesky metadata store
                 when not specified.
     '''
-    if d is None:
-        #d = _bluesky_metadata_store()
-        d = gs.RE.md
-    for k, v in d.items():
-        if isinstance(v, dict):
-            result = get_keychain(wanted_key, v) # dig in nested element
-            if result:
-                return [k]+ result
-        elif k == wanted_key:
-            return [k]
+    chains = key_index(d).keychains(wanted_key)
+    if chains:
+        return chains[0].split('.')
+
+def get_keychains(wanted_key, d=None):
+    ''' Return all dotted keychains of a key with a value that is not a dictionary, e.g., ['sample.composition.Ni']
+
+    argumets:
+    wanted_key - str - name of key you want to search for
+    d        -- dictionary you want to search.  Use bluesky metadata store
+                when not specified.
+    '''
+    return key_index(d).keychains(wanted_key)
 
 
 def set_value(key, d=None):
@@ -373,8 +536,8 @@ def set_value(key, d=None):
                 when not specified.
     '''
     if d is None:
-        d = gs.RE.md
-    keychain = get_keychain(key)
+        d = _bluesky_metadata_store()
+    keychain = get_keychain(key, d)
     keychain.remove(key)
     d0 = {} # copy information
     for k, v in d.items():
@@ -397,51 +560,36 @@ def set_value(key, d=None):
 def build_keychain_list(key_list, d=None, verbose = 1):
     ''' Return a keychain list that yields all parent keys for every key in key_list
         E.g. d = {'layer1':{'layer2':{'mykey':'value'}}}
-            build_keychain_list([layer2, mykey],d) = ['layer1', 'layer1.layer2']
+            build_keychain_list([layer2, mykey],d) = ['layer1.layer2', 'layer1.layer2.mykey']
+        Keys found at several places yield all of their keychains.
     argumets:
     key_list - str or list - name of key(s) you want to search for
     d        -- dictionary you want to search.  Use bluesky metadata store
                 when not specified.
     '''
-    if d is None:
-        #d = _bluesky_metadata_store()
-        d = gs.RE.md
-    result = []
     if isinstance(key_list, str):
-        key_list_operate = []
-        key_list_operate.append(key_list)
-    elif isinstance(key_list, list):
-        key_list_operate = key_list
-
-    for key in key_list_operate:
-        dummy = get_keychain(key)
-        if dummy:
-            if len(dummy) > 1:
-                path = '.'.join(dummy)
-                result.append(path)
-            elif len(dummy) == 1: # key at first level
-                path = dummy[0]
-                result.append(path)
-        else:  # find an empty dictionary
-            path = key
-            result.append(path)
+        key_list = [key_list]
+    # all keychains are resolved from one index
+    resolved = key_index(d).resolve(key_list)
+    result = []
+    for key in key_list:
+        paths = resolved[key] or [key] # key is not in the dictionary yet
+        result += paths
         if verbose:
-            print('keychain to your desired key %s is "%s"' % (key, path))
-        else:
-            pass
+            print('keychain to your desired key %s is "%s"' % (key, '", "'.join(paths)))
     return result
 
-def search(desired_value, *args, **kwargs):
+def search(desired_value, *args, limit=None, offset=0, verbose=1, **kwargs):
     '''Return all possible header(s) that satisfy your searching criteria
 
     this function operates in two logics:
     1) When desired_value and args are both given. It will search on all headers matches args = desired_value.
-        args can be incomplete and in this case, this function yields multiple searches
+        args can be incomplete and in this case, all matching keychains are searched in one query
 
     example:
     desired_value = 'TiO2'
     search(desired_value, *'sa') will return all headers that has keys starting with 'sa' and its corresponding
-    values is 'TiO2' in metadata dictionary. Nanmely, it yields searchs on headers with sample = TiO2, sadness = TiO2 ...
+    values is 'TiO2' in metadata dictionary. Nanmely, it searches headers with sample = TiO2 or sadness = TiO2 ...
 
     2) When desired_value is not given. It implies you already knew your searching criteria and are ready to type them explicitly,
         even with additional constrains.
@@ -457,33 +605,71 @@ def search(desired_value, *args, **kwargs):
     arguments:
     desired_value - str - desired value you are looking for
     args - str - key name you want to search for. It can be fuzzy or complete. If it is fuzzy, all possibility will be listed.
+    limit - int - optional. maximum number of returned headers
+    offset - int - optional. number of headers to skip, use with limit to page through many results
+    verbose - bool - optional. print the queries with their number of results and timing
     kwargs - dict - an dictionary that contains exact key-value pairs you want to search for
 
+    Returns a list of headers without duplicates.  With limit, headers are
+    read from the broker only until offset + limit of them are found.
     '''
+    stop = None if limit is None else offset + limit
     if desired_value and args:
         possible_keys = get_keys(args)
         keychain_list = build_keychain_list(possible_keys, verbose =0)
-        search_header_list = []
-        for i in range(len(keychain_list)):
-            dummy_search_dict = {}
-            dummy_search_dict[keychain_list[i]] = desired_value
-            dummy_search_dict['group'] = 'XPD' # create an anchor as mongoDB and_search needs at least 2 key-value pairs
-            search_header = db(**dummy_search_dict)
-            search_header_list.append(search_header)
-            print('Your %ith search "%s=%s" yields %i headers' % (i,
-                keychain_list[i], desired_value, len(search_header)))
-            return search_header_list
-    elif not desired_value and kwars:
-        if len(kwargs)>1:
-            search_header = db(**kwargs)
-        elif len(kwargs) == 1:
-            kwargs['group'] = 'XPD'
-            search_header = db(**kwargs)
+        if len(keychain_list) == 1:
+            query = {keychain_list[0] : desired_value}
         else:
-            print('You gave empty search criteria. Please try again')
-            return
-        return search_header
+            query = {'$or' : [{chain : desired_value} for chain in keychain_list]}
+        try:
+            unique = _unique_headers([query], stop, verbose)
+        except Exception as e:
+            # brokers that cannot combine queries are asked once per keychain
+            if verbose:
+                print('Combined query failed (%s), searching keychains one by one' % e)
+            unique = _unique_headers([{chain : desired_value} for chain in keychain_list], stop, verbose)
+    elif not desired_value and kwargs:
+        unique = _unique_headers([kwargs], stop, verbose)
+    elif not desired_value:
+        print('You gave empty search criteria. Please try again')
+        return
     else:
         print('Sorry, your search is somehow unrecongnizable. Please make sure you are putting values to right fields')
+        return
+
+    rv = unique[offset:]
+    if verbose:
+        more = '' if stop is None or len(unique) < stop else ' or more'
+        print('Your search yields %i headers%s, returning %i' % (len(unique), more, len(rv)))
+    return rv
+
+
+def _unique_headers(queries, count=None, verbose=1):
+    '''Run broker queries one after the other and return their headers without duplicates.
+
+    The broker cursors are read only until count headers are found, None reads all.
+    '''
+    # the same run can match several keychains
+    unique = []
+    seen = set()
+    for query in queries:
+        if count is not None and len(unique) >= count:
+            break
+        query = dict(query)
+        if len(query) == 1:
+            query['group'] = 'XPD' # create an anchor as mongoDB and_search needs at least 2 key-value pairs
+        t0 = time.time()
+        n = 0
+        for header in db(**query):
+            n += 1
+            uid = header['start']['uid']
+            if uid not in seen:
+                seen.add(uid)
+                unique.append(header)
+                if count is not None and len(unique) >= count:
+                    break
+        if verbose:
+            print('query %s read %i headers in %.2f s' % (query, n, time.time() - t0))
+    return unique
 
 
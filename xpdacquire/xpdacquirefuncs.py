@@ -18,33 +18,27 @@ import os
 import time
 import copy
 import datetime
-import matplotlib.pyplot as plt
-import matplotlib as mpl
 import numpy as np
-import pandas as pd
 import json
 
-import bluesky
-from bluesky.scans import *
-from bluesky.broker_callbacks import LiveImage
-from bluesky.callbacks import CallbackBase, LiveTable, LivePlot
-from bluesky import Msg
-
-from ophyd.commands import *
-from ophyd.controls import *
-
-from dataportal import DataBroker as db
-from dataportal import get_events, get_table, get_images
-from metadatastore.commands import find_run_starts
-
 from xpdacquire.config import datapath
 from xpdacquire.utils import composition_analysis
-from xpdacquire.xpd_search import *
-from tifffile import *
-
-
-pd.set_option('max_colwidth',50)
-pd.set_option('colheader_justify','left')
+from xpdacquire.reduction import apply_mask, bad_pixel_mask, combine_frames, corrected_frames, last_frame, downsample
+from xpdacquire.darkcache import DarkCache
+from xpdacquire.catalog import run_catalog
+from xpdacquire import runinfo
+from xpdacquire.stackwriter import open_stack
+from xpdacquire.imagestack import ImageStack
+from xpdacquire.pipeline import SettleDetector, ExportPipeline
+from xpdacquire.exposure import measure_readout, plan_exposure, probe_rates, readout_overhead, save_readout
+from xpdacquire.integration import integrator
+from xpdacquire.corrections import correction_factor
+from xpdacquire.shutter import ShutterController, DosePolicy, report_saved_time
+from xpdacquire.devices import db, get_images, lookup
+
+# matplotlib, bluesky, ophyd and tifffile are imported in the functions that
+# use them and beamline devices are resolved on first use, see
+# xpdacquire.devices.  Importing this module has no side effects.
 
 default_keys = ['owner', 'beamline_id', 'group', 'config', 'scan_id'] # required by dataBroker
 feature_keys = ['sample_name','experimenters'] # required by XPD, time_stub and uid will be automatically added up as well
@@ -55,13 +49,15 @@ R_DIR = datapath.config             # where the xPDFsuite generated config files
 D_DIR = datapath.dark               # where the tifs from dark-field collections go. Local drive
 S_DIR = datapath.script             # where the user scripts go. Local drive
 
+# reduced dark frames, shared by all save_tif calls in this session
+dark_cache = DarkCache(cache_dir=datapath.dark_cache)
+
 # Instanciate bluesky objects
 
 def _bluesky_global_state():
-    '''Import and return the global state from bluesky.'''
+    '''Return the global state from bluesky, resolved on first use.'''
 
-    from bluesky.standard_config import gs
-    return gs
+    return lookup('gs')
 
 def _bluesky_metadata_store():
     '''Return the dictionary of bluesky global metadata.'''
@@ -69,6 +65,11 @@ def _bluesky_metadata_store():
     gs = _bluesky_global_state()
     return gs.RE.md
 
+def _bluesky_device(name):
+    '''Return beamline device, e.g., 'pe1' or 'photon_shutter', resolved on first use.'''
+
+    return lookup(name)
+
 def _bluesky_RE():
     import bluesky
     from bluesky.run_engine import RunEngine
@@ -77,40 +78,30 @@ def _bluesky_RE():
     bluesky.register_mds.register_mds(RE)
     return RE
 
-def _bluesky_metadata_store():
-    '''Return the dictionary of bluesky global metadata.
-    '''
-    gs = _bluesky_global_state()
-    return gs.RE.md
-
 
-ipshell = get_ipython()
-gs = ipshell.user_ns['gs']
-RE = _bluesky_RE()
-pe1 = ipshell.user_ns['pe1']
-cs700 = ipshell.user_ns['cs700']
-sh1 = ipshell.user_ns['sh1']
-gs.TEMP_CONTROLLER = cs700
-tth_cal = ipshell.user_ns['tth_cal']
-th_cal = ipshell.user_ns['th_cal']
-photon_shutter = ipshell.user_ns['photon_shutter']
+def _start_doc(header):
+    '''Return the run start document of header, or header if it is one.'''
+    try:
+        return header['start']
+    except KeyError:
+        return header
 
 def feature_gen(header):
     ''' generate a human readable file name. It is made of time + uid + sample_name + user
 
+    header can be a header object or the start document of a run.
     field will be skipped if it doesn't exist
     '''
-    uid = header.start.uid
-    time_stub = _timestampstr(header.start.time)
+    start = _start_doc(header)
 
     dummy_list = []
     for key in feature_keys:
         try:
             # truncate length
-            if len(header.start[key])>12:
-                value = header.start[key][:12]
+            if len(start[key])>12:
+                value = start[key][:12]
             else:
-                value = header.start[key]
+                value = start[key]
             # clear space
             dummy = [ ch for ch in list(value) if ch!=' ']
             dummy_list.append(''.join(dummy))  # feature list elements is at the first level, as it should be
@@ -140,7 +131,7 @@ def _MD_template():
     ''' use to generate idealized metadata structure, for pictorial memory and
     also for data cleaning.
     '''
-    #gs = _bluesky_global_state()
+    gs = _bluesky_global_state()
     _clean_metadata()
     gs.RE.md['iscalib'] = 0
     gs.RE.md['isdark'] = 0
@@ -166,7 +157,7 @@ def _MD_template():
 def scan_info():
     ''' hard coded scan information. Aiming for our standardized metadata
     dictionary'''
-    #gs = _bluesky_global_state()
+    gs = _bluesky_global_state()
     all_scan_info = []
     try:
         all_scan_info.append(gs.RE.md['scan_info']['scan_exposure_time'])
@@ -193,21 +184,24 @@ def write_config(d, config_f_name):
     # temporarily solution, need a more robust one later on
     import configparser
     config = configparser.ConfigParser()
-    for k,v in _dig_dict(d).items():
-        config[k] = {}
-        config[k] = v # temporarily use
-    with open(config_f_name+'.cfg', 'w') as configfile:
+    for k,v in d.items():
+        if isinstance(v, dict): # sections of the config file, as read by load_calibration
+            config[k] = v
+    if not config_f_name.endswith('.cfg'):
+        config_f_name += '.cfg'
+    with open(config_f_name, 'w') as configfile:
         config.write(configfile)
 
 def filename_gen(header):
     '''generate a file name of tif file. It contains time_stub, uid and feature
-    of your header'''
+    of your header. header can be a header object or the start document of a run'''
 
-    uid = header.start.uid[:5]
+    start = _start_doc(header)
+    uid = start['uid'][:5]
     try:
-        time_stub = _timestampstr(header.start.time)
+        time_stub = _timestampstr(start['time'])
     except KeyError:
-        tim_stub = 'Imcomplete_Scan'
+        time_stub = 'Imcomplete_Scan'
     feature = feature_gen(header)
     file_name = '_'.join([time_stub, uid, feature])
     return file_name
@@ -227,11 +221,12 @@ def run_script(script_name):
 
 ##################### common functions  #####################
 
-def sum_int(header=db[-1]):
-    int_value = list()
-    imgs = np.array(get_images(header,'pe1_image_lightfield'))
-    for i in range(imgs.shape[0]):
-        int_value.append(np.sum(imgs[i]))
+def sum_int(header=None):
+    import matplotlib.pyplot as plt
+    if header is None:
+        header = db[-1]
+    # frames are read and summed one at a time
+    int_value = ImageStack.from_header(header,'pe1_image_lightfield').sums()
     plt.figure()
     plt.plot(int_value)
     plt.show()
@@ -248,9 +243,10 @@ def get_calibration_images (calibrant, wavelength, calibration_scan_exposure_tim
         comments- str - User specified info about the calibration. Only use it to add information about the calibration
             It gets stored in the 'comments' field.
     '''
-    #gs = _bluesky_global_state()
-    #pe1 = _bluesky_pe1()
-    #RE = _bluesky_RE()
+    import bluesky.scans
+    from bluesky.callbacks import LiveTable
+    gs = _bluesky_global_state()
+    pe1 = _bluesky_device('pe1')
 
     # Prepare hold state
     try:
@@ -295,16 +291,7 @@ def get_calibration_images (calibrant, wavelength, calibration_scan_exposure_tim
         #pass
     #else:
         #sh1.open = 1
-    #print('photon_shutter value before open_pv.put(1): %s' % photon_shutter.value)
-    photon_shutter_try = 0
-    number_shutter_tries = 5
-    while photon_shutter.value == 0 and photon_shutter_try < number_shutter_tries:
-        photon_shutter.open_pv.put(1)
-        time.sleep(4.)   
-        print('photon_shutter value after open_pv.put(1): %s' % photon_shutter.value)
-        photon_shutter_try += 1
-    if photon_shutter.value == 0:
-        print('photon shutter failed to open after %i tries. Please check before continuing' % photon_shutter_try)
+    if not shutter_controller().open():
         return
 
     try:
@@ -314,15 +301,7 @@ def get_calibration_images (calibrant, wavelength, calibration_scan_exposure_tim
         ctscan.subs = LiveTable(['pe1_image_lightfield'])
         gs.RE(ctscan)
 
-        photon_shutter_try = 0
-        number_shutter_tries = 5
-        while photon_shutter.value == 1 and photon_shutter_try < number_shutter_tries:
-            photon_shutter.close_pv.put(1)
-            time.sleep(4.)   
-            print('photon_shutter value after close_pv.put(1): %s' % photon_shutter.value)
-            photon_shutter_try += 1
-        if photon_shutter.value == 1:
-            print('photon shutter failed to close after %i tries. Please check before continuing' % photon_shutter_try)
+        if not _close_shutter():
             return
 
         # recover to previous state, set to values before calibration
@@ -335,15 +314,7 @@ def get_calibration_images (calibrant, wavelength, calibration_scan_exposure_tim
 
     except:
         # recover to previous state, set to values before calibration
-        photon_shutter_try = 0
-        number_shutter_tries = 5
-        while photon_shutter.value == 1 and photon_shutter_try < number_shutter_tries:
-            photon_shutter.close_pv.put(1)
-            time.sleep(4.)   
-            print('photon_shutter value after close_pv.put(1): %s' % photon_shutter.value)
-            photon_shutter_try += 1
-        if photon_shutter.value == 1:
-            print('photon shutter failed to close after %i tries. Please check before continuing' % photon_shutter_try)
+        if not _close_shutter():
             return
 
         pe1.acquire_time = cnt_hold
@@ -367,7 +338,8 @@ def get_calibration_images (calibrant, wavelength, calibration_scan_exposure_tim
     LAST_CALIB_UID = calib_scan_header.start.uid
 
 
-def get_light_images(scan_time=1.0, scan_exposure_time=0.2,  comments='', number_shutter_tries=5):
+def get_light_images(scan_time=1.0, scan_exposure_time=0.2,  comments='', number_shutter_tries=5, manage_shutter=True,
+        live_save=True, auto_exposure=False, target_counts=None, target_snr=None, probe_time=0.1, dark_uid=False):
     '''function for getting a light image
 
     Arguments:
@@ -375,11 +347,23 @@ def get_light_images(scan_time=1.0, scan_exposure_time=0.2,  comments='', number
         scan_exposure_time - float - optional. exposure time per frame. number of exposures will be set to int(scan_time/exposure_time) (round off)
         comments - dictionary - optional. dictionary of user defined key:value pairs.
         scan_def - object - optional. bluesky scan object defined by user. Default is a count scan
+        manage_shutter - bool - optional. open the shutter before and close it after the scan. Set False when the caller keeps the shutter open
+        live_save - bool - optional. save the dark corrected average as tif file while the scan runs, like save_tif(db[-1]) does afterwards
+        auto_exposure - bool - optional. take a probe frame and choose the longest frame time with dark frames below saturation
+            and 5 seconds, with as many frames as scan_time allows. scan_exposure_time is ignored then
+        target_counts - float - optional. collect this many counts over the whole detector. Implies auto_exposure
+        target_snr - float - optional. collect enough frames for this signal-to-noise ratio of an average pixel. Implies auto_exposure
+        probe_time - float - optional. exposure time of the probe frame
+        dark_uid - str - optional. uid of the dark scan that corrects this run. It is stored in scan_info and used by
+            live_save and save_tif. Default is the most recent dark with the same exposure time
+
+    Returns the uid of the collected run or None when the collection failed.
     '''
-    #gs = _bluesky_global_state()
-    #RE = _bluesky_RE()
-    #pe1 = _bluesky_pe1()
-    #cs700 = _bluesky_cs700()
+    import bluesky.scans
+    from xpdacquire.livesave import LiveSave
+    gs = _bluesky_global_state()
+    pe1 = _bluesky_device('pe1')
+    cs700 = _bluesky_device('cs700')
     if comments:
         #extra_key = comments.keys()
         #for value in comments:
@@ -416,8 +400,21 @@ def get_light_images(scan_time=1.0, scan_exposure_time=0.2,  comments='', number
         pass
 
 
+    # open photon shutter
+    if manage_shutter or not shutter_controller().is_open:
+        if not _open_shutter(number_shutter_tries):
+            return
+
+    plan = None
+    if auto_exposure or target_counts or target_snr:
+        plan = _plan_light_exposure(pe1, scan_time, target_counts, target_snr, probe_time)
+    if plan is not None:
+        scan_exposure_time = plan['frame_time']
+        num = plan['num']
+        print('Exposure plan: %i frames of %.3f seconds, limited by %s, %.0f%% of the time exposing'
+                % (num, scan_exposure_time, plan['limit'], 100 * plan['duty_cycle']))
     # don't expose the PE for more than 5 seconds max, set it to 1 seconds if you go beyond limit
-    if scan_exposure_time > 5.0:
+    elif scan_exposure_time > 5.0:
         print('Your exposure time is larger than 5 seconds. This can damage detector')
         print('Exposure time is set to 5 seconds')
         print('Number of exposures will be recalculated so that scan time is the same....')
@@ -442,54 +439,26 @@ def get_light_images(scan_time=1.0, scan_exposure_time=0.2,  comments='', number
     gs.RE.md['scan_info']['total_scan_duration'] = num*pe1.acquire_time
     #gs.RE.md['scan_info']['scan_type'] = scan_type
     gs.RE.md['sample']['temp'] = str(cs700.value[1])+'k'
-
-    #shutter status
-    if sh1.open:
-        pass
+    if plan is not None:
+        gs.RE.md['scan_info']['exposure_plan'] = plan
     else:
-        sh1.open = 1
+        gs.RE.md['scan_info'].pop('exposure_plan', None)
+    if dark_uid:
+        gs.RE.md['scan_info']['dark_uid'] = dark_uid
+    else:
+        gs.RE.md['scan_info'].pop('dark_uid', None)
 
-    # this logic needed when we are using photon shutter at xpd
-    print('photon_shutter value before open_pv.put(1): %s' % photon_shutter.value)
-    # open photon shutter
-    photon_shutter_try = 0
-    while photon_shutter.value == 0 and photon_shutter_try < number_shutter_tries:
-        photon_shutter.open_pv.put(1)
-        time.sleep(4.)   
-        print('photon_shutter value after open_pv.put(1): %s' % photon_shutter.value)
-        photon_shutter_try += 1
-    if photon_shutter.value == 0:
-        print('photon shutter failed to open after %i tries. Please check before continuing' % photon_shutter)
-        return
-    
+    subs = [LiveSave()] if live_save else []
     try:
-        gs.RE(scan)
-        #try:
-            #sh1.close = 1
-        #except AttributeError:
-            #pass
-        print('photon_shutter value before close_pv.put(1): %s' % photon_shutter.value)
-        photon_shutter_try = 0
-        while photon_shutter.value ==1 and photon_shutter_try < 5:
-            photon_shutter.close_pv.put(1)
-            time.sleep(4.)   
-            print('photon_shutter value after close_pv.put(1): %s' % photon_shutter.value)
-            photon_shutter_try += 1
-        
+        gs.RE(scan, subs)
+        if manage_shutter:
+            _close_shutter()
+        header = db[-1]
+        return header.start.uid
+
     except:
         # deconstruct the metadata
-        #try:
-            #sh1.close = 1
-        #except AttributeError:
-            #pass
-        # close photon shutter
-        print('photon_shutter value before close_pv.put(1): %s' % photon_shutter.value)
-        photon_shutter_try = 0
-        while photon_shutter.value ==1 and photon_shutter_try < 5:
-            photon_shutter.close_pv.put(1)
-            time.sleep(4.)   
-            print('photon_shutter value after close_pv.put(1): %s' % photon_shutter.value)
-            photon_shutter_try += 1
+        _close_shutter()
 
         gs.RE.md['scan_info'] = {'scan_exposure_time' : scan_exposure_time_hold,'number_of_exposures' : scan_steps_hold, 'total_scan_duration' : total_scan_duration_hold }
         gs.RE.md['comments'] = {}
@@ -497,11 +466,79 @@ def get_light_images(scan_time=1.0, scan_exposure_time=0.2,  comments='', number
         print('image collection failed. Check why gs.RE(scan) is not working and rerun')
         return
 
+def _plan_light_exposure(pe1, scan_time, target_counts, target_snr, probe_time):
+    '''take a probe frame and return the exposure plan, or None if probing failed.
+
+    The frame time of the plan is one of the exposure times with dark frames.
+    '''
+    import bluesky.scans
+    from xpdacquire.darks import DEFAULT_DARK_TIMES
+    gs = _bluesky_global_state()
+    probe_hold = copy.copy(pe1.acquire_time)
+    pe1.acquire_time = probe_time
+    gs.RE.md['isprobe'] = True
+    try:
+        gs.RE(bluesky.scans.Count([pe1], 1))
+        header = db[-1]
+        frame = last_frame(get_images(header, 'pe1_image_lightfield'))
+    except Exception as e:
+        print('Probe frame failed (%s), exposure is not adjusted' % e)
+        return None
+    finally:
+        del gs.RE.md['isprobe']
+        pe1.acquire_time = probe_hold
+    catalog = run_catalog()
+    dark = None
+    if _find_dark_uid(probe_time) is not None:
+        dark = get_dark_frame(probe_time)
+    else:
+        print('No dark frame with probe_time = %s, count rates include the detector offset' % probe_time)
+    rates = probe_rates(frame, probe_time, dark)
+    # light runs without matching darks could not be corrected
+    dark_times = catalog.dark_times() or list(DEFAULT_DARK_TIMES)
+    plan = plan_exposure(scan_time, rates, readout_overhead('pe1'), target_counts, target_snr,
+            frame_times = dark_times)
+    plan['probe_uid'] = header.start.uid
+    plan['probe_time'] = probe_time
+    return plan
+
+
+def calibrate_readout(exposure_time = 0.1, num = 10):
+    '''measure the readout dead time of pe1 per frame and keep it for exposure planning.
+
+    The photon shutter is closed and num frames of exposure_time are collected. The median time between frames
+    minus the exposure time is stored in config_base and used by get_light_images(auto_exposure = True).
+
+    arguments:
+        exposure_time - float - optional. exposure time of the calibration frames
+        num - int - optional. number of calibration frames
+    '''
+    import bluesky.scans
+    gs = _bluesky_global_state()
+    pe1 = _bluesky_device('pe1')
+    _close_shutter()
+    hold = copy.copy(pe1.acquire_time)
+    pe1.acquire_time = exposure_time
+    gs.RE.md['isreadoutcalib'] = True
+    try:
+        gs.RE(bluesky.scans.Count([pe1], num))
+    finally:
+        del gs.RE.md['isreadoutcalib']
+        pe1.acquire_time = hold
+    header = db[-1]
+    overhead = measure_readout(runinfo.event_times(header), exposure_time)
+    save_readout(overhead, 'pe1', exposure_time = exposure_time, num = num, uid = header.start.uid)
+    print('pe1 readout takes %.3f seconds per frame' % overhead)
+    return overhead
+
+
 def nstep(start, stop, step_size):
     step = np.arange(start, stop, step_size)
     return np.append(step, stop)
 
-def tseries(start_temp, stop_temp, step_size = 5.0, total_exposure_time_per_point =1.0, exposure_time_per_frame = 0.2, t_device = cs700, comments = ''):
+def tseries(start_temp, stop_temp, step_size = 5.0, total_exposure_time_per_point =1.0, exposure_time_per_frame = 0.2, t_device = None, comments = '',
+        shutter_policy = 'cycle', max_open_idle = 30., live_save = True, pipeline = False, settle = None, max_queue = 2,
+        ramp_darks = False, dark_frames = 5):
     ''' run a temperature series scan.
 
     argument:
@@ -510,20 +547,45 @@ def tseries(start_temp, stop_temp, step_size = 5.0, total_exposure_time_per_poin
     step_size - flot - optional. step size of each temeprature scan
     total_scan_time_per_point - float - optional. total scan time at each temepratrue step
     exposure_time_per_point - flot - optional. exposure time per frame.
+    t_device - object - optional. temperature controller. Default is cs700
     comments - list - optional. comments to current experiment. It should be a list of strings
+    shutter_policy - str - optional. 'cycle' opens and closes the shutter at every point, 'open' keeps it open for the whole series,
+        'settle' closes it only during temperature moves longer than max_open_idle
+    max_open_idle - float - optional. seconds of beam on the sample between points accepted by the 'settle' policy
+    live_save - bool - optional. save a dark corrected tif file of every point while the series runs
+    pipeline - bool - optional. save every point on a worker thread while the controller moves to the next point,
+        instead of live saving. Timing of ramp, settle, acquisition and export is reported at the end
+    settle - SettleDetector - optional. wait until the readback of t_device is stable at every point instead of
+        trusting the move to return. Default is a SettleDetector() in pipeline and ramp_darks mode
+    max_queue - int - optional. number of points that may wait for export in pipeline mode before the series pauses
+    ramp_darks - bool - optional. take dark frames of exposure_time_per_frame while the controller ramps to a point with the
+        shutter closed. The following points are corrected with the latest of these darks, and the drift of the darks over
+        the series is reported at the end. How often the shutter is closed for a move is decided by shutter_policy
+    dark_frames - int - optional. number of dark frames taken during a ramp
     '''
     import uuid
+    from xpdacquire.darks import DarkDrift
+    from ophyd.commands import mov
+    gs = _bluesky_global_state()
+    if t_device is None:
+        t_device = _bluesky_device('cs700')
+    policy = DosePolicy(shutter_policy, max_open_idle)
+    exporter = None
+    if pipeline:
+        live_save = False
+        exporter = ExportPipeline(_export_point, max_queue)
+    if (pipeline or ramp_darks) and settle is None:
+        settle = SettleDetector()
+    dark_time = min(exposure_time_per_frame, 5.0) # get_light_images never exposes longer
+    drift = DarkDrift()
+    dark_uid = False
 
     temp_series = nstep(start_temp, stop_temp, step_size) 
     print('Temperature series will cover these points %s' % str(temp_series))
     print('Ctrl + c to exit if it is incorrect')
-    print('To view data from intermidate scans, open a new icollection session')
-    print('type "from xpdacquire.xpdacquirefuncs import *"')
-    print('type "save_tif(db[-1])"')
-    print('then use xPDFsuite or program of choice to investigate')
-    print('DO NOT ENTER ANY MOTOR COMMANDS IN NEW IPYTHON SESSION, that will ruin your scan')
+    _print_intermediate_help(live_save or pipeline)
 
-    md_hold = copy.copy(gs.RE.md)
+    md_hold = copy.deepcopy(gs.RE.md) # get_light_images changes nested dictionaries
     try:
         gs.RE.md['istseries'] = True
         tseries_uid = str(uuid.uuid4())
@@ -534,37 +596,144 @@ def tseries(start_temp, stop_temp, step_size = 5.0, total_exposure_time_per_poin
         gs.RE.md['tseries']['stop'] = stop_temp
         gs.RE.md['tseries']['step_size'] = step_size
         gs.RE.md['tseries']['device'] = str(t_device)
+        gs.RE.md['tseries']['shutter_policy'] = shutter_policy
+        gs.RE.md['tseries']['ramp_darks'] = ramp_darks
+        shutter = shutter_controller()
+        first_metric = len(shutter.metrics)
         for temp in temp_series:
-            mov(t_device, temp)
+            if shutter.is_open and policy.close_before_move():
+                _close_shutter()
+            t0 = time.time()
+            if settle is None:
+                mov(t_device, temp)
+            else:
+                _start_move(t_device, temp)
+            dark_seconds = 0.
+            if ramp_darks and not shutter.is_open:
+                # the detector is idle while the controller ramps
+                td = time.time()
+                dark_uid = _ramp_dark(dark_time, dark_frames, temp, t_device, drift) or dark_uid
+                dark_seconds = time.time() - td
+            t1 = time.time()
+            if settle is not None:
+                settle.wait(lambda: t_device.value[1], temp)
+            t2 = time.time()
+            policy.record_move(t2 - t0)
             actual_temp = t_device.value[1] # real temperature
             gs.RE.md['sample']['temp'] = actual_temp
-            get_light_images(total_exposure_time_per_point, exposure_time_per_frame, comments)
-            header = db[-1]
+            uid = get_light_images(total_exposure_time_per_point, exposure_time_per_frame, comments,
+                    manage_shutter = policy.cycles_per_point, live_save = live_save, dark_uid = dark_uid)
+            if exporter is not None and uid is not None:
+                record = exporter.submit(uid, ramp = t1 - t0 - dark_seconds, dark = dark_seconds, settle = t2 - t1, acquire = time.time() - t2)
+                print('point at %s queued for export, %i in queue' % (actual_temp, record['queue_depth'] + 1))
             # take care of file name in temperature scan
             #header = db[-1]
             #f_name = '_'.join(feature_gen(header), str(temp)+'K')
             #save_tif(db[-1], tif_name = f_name, dark_correction = correction_option)
+        _close_shutter()
         gs.RE.md = md_hold
         print('Temperature scan finished...')
+        if not policy.cycles_per_point:
+            report_saved_time(shutter, len(temp_series), first_metric)
+        if ramp_darks:
+            drift.report(extra = ('temperature',))
+        if exporter is not None:
+            print('Waiting for %i points to be saved...' % exporter.queue_depth)
+            exporter.report(exporter.drain())
 
     except:
         print('Error or keybord interupt. Please try again')
+        _close_shutter()
         gs.RE.md = md_hold
+        if exporter is not None:
+            exporter.drain()
     return
 
 
-def myMotorscan(start, stop, step_size, motor, det, exposure_time_per_point = 1.0, exposure_time_per_frame = 0.2):
+def _ramp_dark(exposure_time, num, target, t_device, drift):
+    '''take dark frames while t_device ramps to target with the shutter closed.
+
+    The run is tagged as opportunistic dark of the running series. Returns the dark uid or None.
+    '''
+    from xpdacquire.darks import dark_plan, DarkRegistrar
+    gs = _bluesky_global_state()
+    pe1 = _bluesky_device('pe1')
+    temperature = round(float(t_device.value[1]), 2)
+    gs.RE.md['isdark'] = True
+    gs.RE.md['dark_scan_info'] = {'dark_scan_exposure_time' : [exposure_time], 'dark_frames_per_exposure' : num,
+            'opportunistic' : True, 'target_temp' : target, 'temp' : temperature}
+    registrar = DarkRegistrar(dark_cache)
+    try:
+        gs.RE(dark_plan(pe1, [exposure_time], num), [registrar])
+        dark_uid = _registered_dark_uid(registrar, [exposure_time], num)
+        dark = get_dark_frame(exposure_time, dark_uid, pe1.name)
+    except Exception as e:
+        # the series goes on with the previous dark
+        print('Dark collection during the ramp to %s failed, %s: %s' % (target, type(e).__name__, e))
+        return
+    finally:
+        gs.RE.md['isdark'] = False
+        gs.RE.md.pop('dark_scan_info', None)
+    if dark is not None:
+        record = drift.add(dark_uid, exposure_time, dark, temperature = temperature)
+        print('dark %s taken during the ramp at %s, mean %.1f, drift %.2f' % (dark_uid[:5], temperature, record['mean'], record['drift']))
+    return dark_uid
+
+
+def _start_move(t_device, position):
+    '''start moving t_device to position without waiting for the move to finish.'''
+    try:
+        t_device.move(position, wait = False)
+    except TypeError:
+        # positioners without a non blocking move
+        from ophyd.commands import mov
+        mov(t_device, position)
+
+
+def _export_point(uid):
+    '''save a run of a pipelined series, used on the export worker.'''
+    _save_header(db[uid], plot = False)
+
+
+def _print_intermediate_help(live_save):
+    '''tell the user where to find data of intermediate scans.'''
+    if live_save:
+        print('Images are saved at %s while they are collected' % W_DIR)
+        print('use xPDFsuite or program of choice to investigate')
+        return
+    print('To view data from intermidate scans, open a new icollection session')
+    print('type "from xpdacquire.xpdacquirefuncs import *"')
+    print('type "save_tif(db[-1])"')
+    print('then use xPDFsuite or program of choice to investigate')
+    print('DO NOT ENTER ANY MOTOR COMMANDS IN NEW IPYTHON SESSION, that will ruin your scan')
+
+
+def myMotorscan(start, stop, step_size, motor, det, exposure_time_per_point = 1.0, exposure_time_per_frame = 0.2, dose_policy = None):
+    ''' plan of a motor scan that collects exposure_time_per_point worth of frames at every step.
+
+    dose_policy - DosePolicy - optional. If given, the photon shutter is opened for the exposures and
+        closed during moves as the policy decides, with plan messages that do not block the run engine.
+        Otherwise the shutter is left alone.
+    '''
+    from bluesky import Msg
     step_series = nstep(start, stop, step_size)
     if exposure_time_per_point > 5:
         exposure_time_per_point = 5
     exposure_num = np.rint(exposure_time_per_point/exposure_time_per_frame)
-    pe1.acquire_time = exposure_time_per_frame
+    det.acquire_time = exposure_time_per_frame
     yield Msg('open_run')
     yield Msg('configure',det)
     for step in step_series:
+        if dose_policy is not None and dose_policy.close_before_move():
+            yield from shutter_controller().close_plan()
+        t0 = time.time()
         yield Msg('create')
         yield Msg('set', motor, step, block_group = 'A')
         yield Msg('wait', None, 'A')
+        if dose_policy is not None:
+            dose_policy.record_move(time.time() - t0)
+            if not shutter_controller().is_open:
+                yield from _open_shutter_plan()
         yield Msg('read', motor)
         num = 0
         while num < exposure_num:
@@ -576,7 +745,8 @@ def myMotorscan(start, stop, step_size, motor, det, exposure_time_per_point = 1.
     yield Msg('close_run')
 
 
-def Tseries(start_temp, stop_temp, step_size, motor = cs700, det = pe1, exposure_time_per_point = 1.0, exposure_time_per_frame = 0.2):
+def Tseries(start_temp, stop_temp, step_size, motor = None, det = None, exposure_time_per_point = 1.0, exposure_time_per_frame = 0.2,
+        shutter_policy = 'open', max_open_idle = 30., live_save = True):
     ''' run a temperature series scan.
 
     argument:
@@ -585,20 +755,30 @@ def Tseries(start_temp, stop_temp, step_size, motor = cs700, det = pe1, exposure
     step_size - flot - optional. step size of each temeprature scan
     total_scan_time_per_point - float - optional. total scan time at each temepratrue step
     exposure_time_per_point - flot - optional. exposure time per frame.
-    comments - list - optional. comments to current experiment. It should be a list of strings
+    motor - object - optional. temperature controller. Default is cs700
+    det - object - optional. area detector. Default is pe1
+    shutter_policy - str - optional. 'open' keeps the shutter open for the whole series, 'settle' closes it only during
+        temperature moves longer than max_open_idle and 'cycle' closes it during every move
+    max_open_idle - float - optional. seconds of beam on the sample between points accepted by the 'settle' policy
+    live_save - bool - optional. save dark corrected tif files of all frames while the series runs
     '''
-    Tscan = myMotorscan(start_temp, stop_temp, step_size, exposure_time_per_point,exposure_time_per_frame, motor, det)
+    from bluesky.callbacks import LiveTable
+    from xpdacquire.livesave import LiveSave
+    gs = _bluesky_global_state()
+    if motor is None:
+        motor = _bluesky_device('cs700')
+    if det is None:
+        det = _bluesky_device('pe1')
+    policy = DosePolicy(shutter_policy, max_open_idle)
+    Tscan = myMotorscan(start_temp, stop_temp, step_size, motor, det, exposure_time_per_point, exposure_time_per_frame,
+            dose_policy = policy)
     
     temp_series = nstep(start_temp, stop_temp, step_size) 
     print('Temperature series will cover these points %s' % str(temp_series))
     print('Ctrl + c to exit if it is incorrect')
-    print('To view data from intermidate scans, open a new icollection session')
-    print('type "from xpdacquire.xpdacquirefuncs import *"')
-    print('type "save_tif(db[-1])"')
-    print('then use xPDFsuite or program of choice to investigate')
-    print('DO NOT ENTER ANY MOTOR COMMANDS IN NEW IPYTHON SESSION, that will ruin your scan')
+    _print_intermediate_help(live_save)
 
-    md_hold = copy.copy(gs.RE.md)
+    md_hold = copy.deepcopy(gs.RE.md) # nested dictionaries change during the series
     try:
         gs.RE.md['istseries'] = True
         #tseries_uid = str(uuid.uuid4())
@@ -609,13 +789,21 @@ def Tseries(start_temp, stop_temp, step_size, motor = cs700, det = pe1, exposure
         gs.RE.md['tseries']['stop'] = stop_temp
         gs.RE.md['tseries']['step_size'] = step_size
         gs.RE.md['tseries']['device'] = str(motor.name)
-        gs.RE(Tscan, LiveTable([str(motor),str(det)+'_image_lightfield']))
+        gs.RE.md['tseries']['shutter_policy'] = shutter_policy
+        shutter = shutter_controller()
+        first_metric = len(shutter.metrics)
+        subs = [LiveTable([str(motor),str(det)+'_image_lightfield'])]
+        if live_save:
+            subs.append(LiveSave(sum_frames = False, motor = motor.name))
+        gs.RE(Tscan, subs)
+        _close_shutter()
         gs.RE.md = md_hold
-        gs.RE(Tscan)
         print('Temperature scan finished...')
+        report_saved_time(shutter, len(temp_series), first_metric)
 
     except:
         print('Error or keybord interupt. Please try again')
+        _close_shutter()
         gs.RE.md = md_hold
     return
 
@@ -637,7 +825,7 @@ def load_calibration(config_file = False, config_dir = False):
     config_dir - str - optional. directory where your config files are located. If not specified, default directory is used
     normal usage is not to use change these defaults.
     '''
-    #gs = _bluesky_global_state()
+    gs = _bluesky_global_state()
     from configparser import ConfigParser
     # figure out directory to read from
     if not config_dir:
@@ -704,7 +892,7 @@ def new_experimenters(experimenters, update=True):
         experimenters - str or list - name of current experimenters
         update - bool - optional. set True to update experimenters list and set False to extend experimenters list
     '''
-    #gs = _bluesky_global_state()
+    gs = _bluesky_global_state()
     if update:
         gs.RE.md['experimenters'] = experimenters
     else:
@@ -752,7 +940,7 @@ def new_sample(sample_name, sample, experimenters=[], comments='', verbose = 1):
     comments - dict - optional. user supplied comments that relate to the current sample. Default = ""
     verbose - bool - optional. set to false to suppress printed output.
     '''
-    #gs = _bluesky_global_state()
+    gs = _bluesky_global_state()
     if verbose: print('Setting up global run engines(gs.RE) with your metadata.......')
 
     if not experimenters:
@@ -800,6 +988,7 @@ def new_sample(sample_name, sample, experimenters=[], comments='', verbose = 1):
     if verbose: print('To check what will be saved with your scans, type "gs.RE.md"')
 
 def view_image(headers=False):
+    import matplotlib.pyplot as plt
     if not headers:
         header_list = []
         header_list.append(db[-1])
@@ -810,12 +999,13 @@ def view_image(headers=False):
         else:
             header_list = headers
     for header in header_list:
-        img_len = np.array(get_images(header,'pe1_image_lightfield')).shape[0]
-        sum_img = np.sum(np.array(get_images(header,'pe1_image_lightfield')),0) / img_len
-        imshow(sum_img)
+        sum_img = ImageStack.from_header(header,'pe1_image_lightfield').mean()
+        plt.figure()
+        plt.imshow(sum_img)
+        plt.show()
 
 def sanity_check():
-    #gs = _bluesky_global_state()
+    gs = _bluesky_global_state()
     user = gs.RE.md['experimenters']
     print('Current experimenter(s) are: %s' % user)
     try:
@@ -856,13 +1046,14 @@ def print_dict(d, ident = '', braces=1):
             print (ident+'%s = %s' %(key, value))
 
 def print_metadata():
-    print_dict(gs.RE.md)
+    print_dict(_bluesky_metadata_store())
+
 def _clean_metadata():
     '''
     reserve for completely cleaning metadata dictionary
     return nothing
     '''
-    #gs = _bluesky_global_state()
+    gs = _bluesky_global_state()
     extra_key_list = [ f for f in gs.RE.md.keys() if f not in default_keys]
     for key in extra_key_list:
         del(gs.RE.md[key])
@@ -875,9 +1066,8 @@ def get_motor(header, motor_name):
     motor_name - str - name of motor in your scan
     '''
     img_field =[el for el in header.descriptors[0]['data_keys'] if el.endswith('_image_lightfield')][0]
-    img_len = np.array(get_images(header,img_field)).shape[0]
-    events = list(get_events(header))
-    motor_len = len(events)
+    img_len = len(ImageStack.from_header(header,img_field))
+    motor_len = runinfo.num_frames(header)
     if img_len == motor_len:
         pass
     else:
@@ -885,11 +1075,7 @@ def get_motor(header, motor_name):
         #print('Maybe some points are missing or unable to pull out from filestore. Please ask beamline scientist for what to do')
         return
     try:
-        motor_series = list()
-        for event in events:
-            motor_step = event['data'][motor_name]
-            motor_series.append(motor_step)
-        return motor_series
+        return runinfo.motor_positions(header, motor_name)
     except KeyError:
         print('There is no motor information to %s in this header, please check if you are looking at the correct data' % motor_name)
         return
@@ -897,223 +1083,316 @@ def get_motor(header, motor_name):
 def find_dark(light_cnt_time):
     '''find desired cnt_time in dark_base'''
 
-    f_d = [ f for f in os.listdir(D_DIR) ]
-    if not f_d:
-            print('You do not have any dark image in dark_base, please at least do one dark scan before all scans')
-            return
-    else:
-        pass
+    dark_uid = _find_dark_uid(light_cnt_time)
+    if dark_uid is None:
+        print('Could not find desired cnt_time in your dark_base. Please rerun get_dark_images with correct arugment to complete dark_base')
+        return
+    return db[str(dark_uid)]
 
-    uid_list = []
-    for f in f_d:
-        uid_list.append(f[17:22])
-    uid_unique = np.unique(uid_list)
-    
-    dark_header_list = []
-    for d_uid in uid_unique:
-        dark_header_list.append(db[d_uid])
 
-    dark_list = [ h for h in dark_header_list if find_cnt_time(h) == light_cnt_time ]
-    
-    if dark_list:
-        #for h in dark_list:
-            #print('cnt_time in dark_header_list are: %s' % str(find_cnt_time(h)))
-        dark_time_list = []
-        for dark_header in dark_list:
-            dark_time_list.append(dark_header.stop.time)
-
-        ind = np.argsort(dark_time_list)
-        dark_header = dark_list[ind[-1]]
-        #dark_header = dark_list[ind[0]]
-        #print('cnt_time after sorting is: %s' % str(find_cnt_time(dark_header)))
-        return dark_header
-    else:
-        print('Could not find desired cnt_time in your dark_base. Please rerun get_dark_images with correct arugment to complete dark_base')
+def _run_dark_uid(header, cnt_time):
+    '''Return uid of the dark recorded in the scan_info of a run if it has frames of cnt_time, else False.'''
+    scan_info = _start_doc(header).get('scan_info') or {}
+    dark_uid = scan_info.get('dark_uid')
+    if not dark_uid or cnt_time is None:
+        return False
+    if run_catalog().has_dark(dark_uid, cnt_time):
+        return dark_uid
+    try:
+        dark_header = db[str(dark_uid)]
+        field = [el for el in dark_header.descriptors[0]['data_keys'] if el.endswith('_acquire_time')][0]
+        times = runinfo.event_data(dark_header, field)
+    except (KeyError, IndexError):
+        times = []
+    if any(abs(float(t) - float(cnt_time)) < 1e-6 for t in times):
+        return dark_uid
+    print('dark %s recorded with the run has no frames with cnt_time = %s, using the latest dark' % (str(dark_uid)[:5], cnt_time))
+    return False
+
+
+def _find_dark_uid(cnt_time):
+    '''Return uid of the most recent dark scan with cnt_time or None.
+
+    The run catalog is asked first, darks collected before it existed are
+    found in the latest dark dictionary of dark_base.
+    '''
+    dark_uid = run_catalog().latest_dark(cnt_time)
+    if dark_uid is None:
+        read_dict = _load_dark_dict()
+        if read_dict is not None:
+            dark_uid = _match_cnt_time(read_dict, cnt_time)
+    return dark_uid
+
+
+_dark_dict_memo = {}
+
+def _load_dark_dict():
+    '''Return the most recent dark dictionary in dark_base or None.
+
+    The parsed dictionary is kept until a newer one is written.
+    '''
+    dark_dict_list = [os.path.join(D_DIR, f) for f in os.listdir(D_DIR) if f.endswith('txt')]
+    if not dark_dict_list:
+        return None
+    rv = max(dark_dict_list, key = os.path.getmtime) # find the lastest dark_dict
+    stamp = (rv, os.path.getmtime(rv))
+    if _dark_dict_memo.get('stamp') != stamp:
+        with open(rv) as f:
+            _dark_dict_memo['dict'] = json.load(f)
+        _dark_dict_memo['stamp'] = stamp
+    return _dark_dict_memo['dict']
+
+
+def _match_cnt_time(dark_dict, cnt_time):
+    '''Return the dark uid in dark_dict for cnt_time or None.
+
+    Keys of dark_dict are exposure times as strings, so compare numerically.
+    '''
+    for k, uid in dark_dict.items():
+        if abs(float(k) - float(cnt_time)) < 1e-6:
+            return uid
+    return None
+
+
+def get_dark_frame(cnt_time, dark_uid = False, detector = 'pe1'):
+    '''Return the dark frame for cnt_time, reading the broker only on a cache miss.
+
+    arguments:
+        cnt_time - float - exposure time of the light frames to correct
+        dark_uid - str - optional. uid of dark scan to use. If unspecified, the most recent dark scan with cnt_time is used.
+        detector - str - optional. name of the detector
+    '''
+    if not dark_uid:
+        dark_uid = _find_dark_uid(cnt_time)
+        if dark_uid is None:
+            print('Could not find cnt_time = %s in your dark_base. Please rerun get_dark_images()' % cnt_time)
+            return
+    # the dark uid is part of the key, so a newer dark dictionary never hits stale frames
+    key = dark_cache.key(detector, cnt_time, uid=dark_uid)
+    dark = dark_cache.get(key)
+    if dark is not None:
+        return dark
+
+    print('dark header used to correct image is %s: ' % dark_uid)
+    dark_imgs = _dark_images(dark_uid, cnt_time)
+    if dark_imgs is None:
+        print('dark %s has no frames with cnt_time = %s. Please rerun get_dark_images()' % (str(dark_uid)[:5], cnt_time))
         return
+    # zingers in a dark frame would show up in every corrected image
+    dark, acc = combine_frames(dark_imgs, method = 'sigma_clip')
+    if acc.rejected:
+        print('%i zinger pixels rejected in the %i frames of dark %s' % (acc.rejected, acc.count, str(dark_uid)[:5]))
+    dark_cache.put(key, dark)
+    return dark
+
+
+def _dark_images(dark_uid, cnt_time):
+    '''Return the lazy sequence of the frames of a dark scan with exposure cnt_time.
+
+    Dark scans of get_dark_images hold frames of several exposure times, which are told apart
+    by the acquire_time recorded with every frame. Returns None when the scan has several
+    exposure times but none of them is cnt_time.
+    '''
+    dark_header = db[str(dark_uid)]
+    dark_img_field =[el for el in dark_header.descriptors[0]['data_keys'] if el.endswith('_image_lightfield')][0]
+    dark_imgs = get_images(dark_header,dark_img_field)
+    cnt_field = dark_img_field[:-len('_image_lightfield')] + '_acquire_time'
+    try:
+        times = runinfo.event_data(dark_header, cnt_field)
+    except KeyError:
+        return dark_imgs
+    index = [i for i, t in enumerate(times) if abs(float(t) - float(cnt_time)) < 1e-6]
+    if len(index) == len(times):
+        return dark_imgs
+    if not index:
+        if len(set(round(float(t), 6) for t in times)) > 1:
+            return None
+        print('WARNING: dark %s was taken with %s s, not with cnt_time = %s' % (str(dark_uid)[:5], times[0], cnt_time))
+        return dark_imgs
+    return ImageStack(dark_imgs, index)
+
+
+def get_bad_pixel_mask(cnt_time, dark_uid = False, detector = 'pe1'):
+    '''Return a boolean mask of hot, dead and noisy pixels found in the dark scan for cnt_time.
+
+    The mask is computed once per dark scan and cached with the dark frames.
+
+    arguments:
+        cnt_time - float - exposure time of the light frames to correct
+        dark_uid - str - optional. uid of dark scan to use. If unspecified, the most recent dark scan with cnt_time is used.
+        detector - str - optional. name of the detector
+    '''
+    if not dark_uid:
+        dark_uid = _find_dark_uid(cnt_time)
+        if dark_uid is None:
+            return None
+    key = dark_cache.key(detector, cnt_time, uid=dark_uid, kind='bad_pixel_mask')
+    mask = dark_cache.get(key)
+    if mask is None:
+        dark_imgs = _dark_images(dark_uid, cnt_time)
+        if dark_imgs is None:
+            return None
+        mask = bad_pixel_mask(dark_imgs)
+        if mask is None:
+            return None
+        dark_cache.put(key, mask)
+        print('%i bad pixels found in dark %s' % (np.count_nonzero(mask), str(dark_uid)[:5]))
+    return np.asarray(mask, dtype = bool)
 
 
 def find_cnt_time(header):
     ''' find cnt_time of header given'''
 
-    events = list(get_events(header))
-    cnt_time_field = [ el for el in events[0]['data'] if el.endswith('acquire_time') ][0]
-    cnt_time = events[0]['data'][cnt_time_field]
+    catalog = run_catalog()
+    cnt_time = catalog.acquire_time(header.start.uid)
+    if cnt_time is not None:
+        return cnt_time
+    cnt_time = runinfo.acquire_time(header)
+    catalog.record_header(header, cnt_time)
     return cnt_time
 
-def get_dark_images(dark_scan_exposure_time = False):
+def get_dark_images(dark_scan_exposure_time = False, num = 1, flush_num = 10):
     ''' Manually acquire stacks of dark images that will be used for dark subtraction later
 
-    This module runs scans with the shutter closed (dark images) and saves them tagged
+    This module runs a scan with the shutter closed (dark images) and saves it tagged
     as such.  You shouldn't have to look at these, they will be automatically used later
     for doing dark subtraction when you collect actual images.
 
-    The default settings are to collect 1 minute worth of dark scans in increments
-    of 0.2 seconds.  This default behavior can be overridden by providing optional
-    values for num (number of frames) and dark_scan_exposure_time.
+    The detector is first flushed with frames of 0.1 seconds that are thrown away, then the
+    dark frames of all exposure times are taken in a single run, 0.1, 0.2, 0.3 and 0.4 seconds
+    by default.  The darks are registered for dark subtraction from the documents of the run,
+    without reading it back from the dataBroker.
 
     Arguments:
-       dark_scan_exposure_time - float- optional. exposure time of dark frames .
+       dark_scan_exposure_time - float or list - optional. exposure time(s) of dark frames. When given, the dark
+                                 dictionary in dark_base is updated instead of replaced
+       num - int - optional. number of dark frames per exposure time
+       flush_num - int - optional. number of frames taken to clear residual charge of the detector before the darks
     '''
-    # set up scan
-    #gs = _bluesky_global_state()
-    #RE = _bluesky_RE()
-    #pe1 = _bluesky_pe1()
-    gs.RE.md['isdark'] = True
-    dark_cnt_hold = copy.copy(pe1.acquire_time)
-    if not dark_scan_exposure_time:
-        try:
-            gs.RE.md['dark_scan_info']
-        except KeyError:
-            gs.RE.md['dark_scan_info'] = {}
-    
-        print('Collecting your dark stacks now...')
-        pe1.acquire_time=0.1
-        dummy_scan = bluesky.scans.Count([pe1], num=10)  # to get rid of residual current
-        from bluesky import RunEngine
-        #testRE = RunEngine()
-        #gs.RE(dummy_scan)
-        dark_dict = {}
-        try:
-            _close_shutter()
-            #photon_shutter_try = 0
-	    #number_shutter_tries = 5
-            #while photon_shutter.value == 1 and photon_shutter_try < number_shutter_tries:
-                #photon_shutter.close_pv.put(1)
-                #time.sleep(4.)   
-                #print('photon_shutter value after close_pv.put(1): %s' % photon_shutter.value)
-                #photon_shutter_try += 1
-            #if photon_shutter.value == 1:
-                #print('photon shutter failed to close after %i tries. Please check before continuing' % photon_shutter_try)
-                #return
-            for i in range(1,5):
-                pe1.acquire_time = 0.1*i
-                dark_scan_expsoure = pe1.acquire_time
-                gs.RE.md['dark_scan_info'] = {'dark_scan_exposure_time':pe1.acquire_time}
-
-                ctscan = bluesky.scans.Count([pe1],num=1)
-                ctscan.subs = LiveTable(['pe1_image_lightfield'])
-                gs.RE(ctscan)
-        
-                # save tif to dark_base
-                dark_base_header=db[-1]
-                #uid = dark_base_header.start.uid[:6]
-                #time_stub = _timestampstr(dark_base_header.stop.time)
-                img = np.array(get_images(dark_base_header,'pe1_image_lightfield'))
-                print('image shape is '+ str(np.shape(img)))
-
-                #f_name = '_'.join([time_stub, uid, 'dark','00'+str(i)+'.tif'])
-                #w_name = os.path.join(D_DIR,f_name)
-                #imsave(w_name, img) # overwrite mode
-        
-                 # fill up dark_dict
-                dark_dict[pe1.acquire_time] = dark_base_header.start.uid
-           
-            gs.RE.md['isdark'] = False
-            pe1.quire_time = dark_cnt_hold
-                #if os.path.isfile(w_name):
-                    #print('%s has been saved to %s' % (f_name, D_DIR))
-                    #pass
-                #else:
-                    #print('Error: dark image tif file not written')
-                    #print('Investigate and re-run')
-                    #return
-        
-            dark_dict_name = '_'.join(['dark_base', _timestampstr(time.time())])
-            w_dark_dict_name =  os.path.join(D_DIR, dark_dict_name)
-            #print(dark_dict)
-            #save dark_dict for search later on
-            with open(w_dark_dict_name+'.txt', 'w') as w_dark:
-                json.dump(dark_dict, w_dark)
-            if os.path.isfile(w_dark_dict_name+'.txt'):
-                print('%s has been saved to %s' % (w_dark_dict_name, W_DIR))
-            else:
-                print('dark dictionary is not saved, please run get_dark_images() again')
-                return
-
-        except:
-            gs.RE.md['isdark'] = False
-            pe1.acquire_time = dark_cnt_hold
-
-            _close_shutter()
-            print('Something went wrong, dark images acqusition was not complete. Please check everything and run get_dark_images() again')
-            #photon_shutter_try = 0
-            #number_shutter_tries = 5
-            #while photon_shutter.value == 1 and photon_shutter_try < number_shutter_tries:
-                #photon_shutter.close_pv.put(1)
-                #time.sleep(4.)   
-                #print('photon_shutter value after close_pv.put(1): %s' % photon_shutter.value)
-                #photon_shutter_try += 1
-	    #if photon_shutter.value == 1:
-                #print('photon shutter failed to close after %i tries. Please check before continuing' % photon_shutter_try)
-                #return
-            return
-
+    from xpdacquire.darks import dark_plan, DarkRegistrar, DEFAULT_DARK_TIMES
+    gs = _bluesky_global_state()
+    pe1 = _bluesky_device('pe1')
+    if dark_scan_exposure_time:
+        exposure_times = [float(t) for t in np.atleast_1d(dark_scan_exposure_time)]
     else:
-        #just a functionality, not planning to deliver
-        pe1.acquire_time = dark_scan_exposure_time
-        ctscan = bluesky.scans.Count([pe1], num=1)
-        gs.RE(ctscan)
-        dark_dict_name = [f_name for f_name in os.listdir(D_DIR) if f_name.endswith('txt')]
-        dark_dict_list = []
-        for d in dark_dict_name:
-            dark_dict_list.append(os.path.join(D_DIR,d))
-        if not dark_dict_list:
-            print('There is no dark dictionary in dark_base. Pleas run get_dark_images() again to build dark_base')
-            return
-        last_dark_dict = sorted(dark_dict_list, key = os.path.getmtime) # find the lastest dark_dict
-        rv = last_dark_dict[-1]
-        #print(rv)
-        with open(rv) as f:
-            read_dict = json.load(f)
-        new_dict = {str(pe1.acquire_time) : str(ctscan.start.uid)}
-        read_dict.update(new_dict)
-        with open(read_dict,'w') as f:
-            json.dump(read_dict, f)
+        exposure_times = list(DEFAULT_DARK_TIMES)
+
+    print('Collecting your dark stacks now...')
+    gs.RE.md['isdark'] = True
+    gs.RE.md['dark_scan_info'] = {'dark_scan_exposure_time' : exposure_times, 'dark_frames_per_exposure' : num}
+    registrar = DarkRegistrar(dark_cache)
+    t0 = time.time()
+    try:
+        if not _close_shutter():
+            raise RuntimeError('photon shutter is not closed')
+        dark_cache.clear() # new darks supersede all cached ones
+        gs.RE(dark_plan(pe1, exposure_times, num, flush_num), [registrar])
+    except Exception as e:
+        _close_shutter()
+        print('%s: %s' % (type(e).__name__, e))
+        print('Something went wrong, dark images acqusition was not complete. Please check everything and run get_dark_images() again')
         return
+    finally:
+        gs.RE.md['isdark'] = False
+
+    dark_uid = _registered_dark_uid(registrar, exposure_times, num)
+    print('%i dark exposures collected in %.1f s' % (len(exposure_times), time.time() - t0))
+
+    # dark dictionary of dark_base, read by older versions of xpdAcquire
+    dark_dict = {}
+    rv = None
+    if dark_scan_exposure_time:
+        dark_dict_list = [os.path.join(D_DIR, f) for f in os.listdir(D_DIR) if f.endswith('txt')]
+        if dark_dict_list:
+            rv = max(dark_dict_list, key = os.path.getmtime) # find the lastest dark_dict
+            with open(rv) as f:
+                dark_dict = json.load(f)
+    if rv is None:
+        rv = os.path.join(D_DIR, '_'.join(['dark_base', _timestampstr(time.time())]) + '.txt')
+    dark_dict.update((str(t), str(dark_uid)) for t in exposure_times)
+    with open(rv, 'w') as w_dark:
+        json.dump(dark_dict, w_dark)
+    if os.path.isfile(rv):
+        print('%s has been saved to %s' % (os.path.basename(rv), D_DIR))
+    else:
+        print('dark dictionary is not saved, please run get_dark_images() again')
+    return dark_uid
+
+def _registered_dark_uid(registrar, exposure_times, num):
+    '''Return uid of the dark run of registrar, registering it from the dataBroker if the callback missed documents.'''
+    if sorted(registrar.exposures) == sorted(round(t, 6) for t in exposure_times):
+        return registrar.uid
+    dark_header = db[-1]
+    dark_uid = dark_header.start.uid
+    catalog = run_catalog()
+    catalog.record_header(dark_header)
+    for t in exposure_times:
+        catalog.record_dark(dark_uid, t, num, dark_header.stop.time)
+    return dark_uid
+
+_shutter_controller = None
+
+def shutter_controller():
+    '''Return the controller of the photon shutter, built on first use.
+
+    Adjust its timeout, retries and backoff attributes to tune shutter
+    handling, and call its latency_summary() to see time spent per open and
+    close.
+    '''
+    global _shutter_controller
+    photon_shutter = _bluesky_device('photon_shutter')
+    if _shutter_controller is None or _shutter_controller.shutter is not photon_shutter:
+        _shutter_controller = ShutterController(photon_shutter)
+    return _shutter_controller
+
+def _open_shutter_plan():
+    '''plan messages that open sh1 and the photon shutter, for use inside bluesky plans.'''
+    sh1 = _bluesky_device('sh1')
+    if not sh1.open:
+        sh1.open = 1
+    yield from shutter_controller().open_plan()
 
-def _close_shutter():
-    photon_shutter_try = 0
-    number_shutter_tries = 5
-    while photon_shutter.value == 1 and photon_shutter_try < number_shutter_tries:
-        photon_shutter.close_pv.put(1)
-        time.sleep(4.)   
-        print('photon_shutter value after close_pv.put(1): %s' % photon_shutter.value)
-        photon_shutter_try += 1
-    if photon_shutter.value == 1:
-        print('photon shutter failed to close after %i tries. Please check before continuing' % photon_shutter_try)
-    return
+def _close_shutter(number_shutter_tries = None):
+    '''Close the photon shutter, return True when it is closed.'''
+    return shutter_controller().close(number_shutter_tries)
 
-def _open_shutter():
+def _open_shutter(number_shutter_tries = None):
+    '''Open sh1 and the photon shutter, return True when the photon shutter is open.'''
+    sh1 = _bluesky_device('sh1')
     #shutter status
-    if sh1.open:
-        pass
-    else:
+    if not sh1.open:
         sh1.open = 1
-
     # this logic needed when we are using photon shutter at xpd
-    print('photon_shutter value before open_pv.put(1): %s' % photon_shutter.value)
-    # open photon shutter
-    photon_shutter_try = 0
-    while photon_shutter.value == 0 and photon_shutter_try < number_shutter_tries:
-        photon_shutter.open_pv.put(1)
-        time.sleep(4.)   
-        print('photon_shutter value after open_pv.put(1): %s' % photon_shutter.value)
-        photon_shutter_try += 1
-    if photon_shutter.value == 0:
-        print('photon shutter failed to open after %i tries. Please check before continuing' % photon_shutter)
-        return
+    return shutter_controller().open(number_shutter_tries)
 
 
 
-def save_tif(headers, tif_name = False, sum_frames = True, dark_uid = False, dark_correct = True):
+def save_tif(headers, tif_name = False, sum_frames = True, dark_uid = False, dark_correct = True, plot = True, thumbnail = False,
+        stack_format = None, frame_tifs = None, integrate = False, corrections = False, flat_field = None,
+        combine = 'sigma_clip', mask_bad_pixels = False):
     ''' save images obtained from dataBroker as tiff format files. It returns nothing.
 
     arguments:
         headers - list - a list of header objects obtained from a query to dataBroker
         file_name - str - optional. File name of tif file being saved. default setting yields a name made of time, uid, feature of your header
         sum_frames - bool - optional. when it is set to True, image frames contained in header will be summed as one file
-        dark_uid - str - optional. The uid of dark_image you wish to use. If unspecified, the most recent dark stack in dark_base will beused.
+        dark_uid - str - optional. The uid of dark_image you wish to use. If unspecified, the dark recorded in the metadata of the run,
+                   e.g., by tseries, or else the most recent dark stack in dark_base will be used.
         dark_correct - bool - optional. Decide if you want to dark_correction or not
+        plot - bool - optional. show a downsampled preview of saved images. Set False to never touch matplotlib, e.g., on nodes without display
+        thumbnail - bool - optional. write downsampled png thumbnails next to tif files in the background
+        stack_format - str - optional. 'hdf5' or 'bigtiff'. frames of runs that are not summed are written into a single compressed file with their timestamps and motor positions, named like the tif files with a _stack suffix
+        frame_tifs - bool - optional. write one tif file per frame as well. Default is True without stack_format and False with it
+        integrate - bool or str - optional. write the integrated 1D pattern of every saved image as .chi file next to its tif file,
+                    using the calibration loaded with load_calibration when the run was collected. 'q' or 'tth' choose the
+                    integration space, True uses the one of the calibration
+        corrections - bool - optional. correct dark subtracted images for polarization and solid angle of the calibration, and for
+                    flat_field if given. The per-pixel maps are computed once per calibration and kept in config_base
+        flat_field - str or array - optional. relative pixel efficiency as array, .npy or .tif file, used with corrections
+        combine - str - optional. how summed frames are combined. 'sigma_clip' rejects zingers, 'median' averages medians of
+                  chunks of frames and 'mean' is the plain average
+        mask_bad_pixels - bool - optional. set hot, dead and noisy pixels found in the dark scan to NaN in dark corrected
+                  images and leave them out of integration. Off by default, images are saved unchanged
     '''
     # prepare header
     if type(list(headers)[1]) == str:
@@ -1122,221 +1401,371 @@ def save_tif(headers, tif_name = False, sum_frames = True, dark_uid = False, dar
     else:
         header_list = headers
 
-    # Find corresponding dark image that will be used to perform correction
-    #print('Finding dark image with the same cnt time....')
-    if not dark_uid:
-        dark_dict_name = [f_name for f_name in os.listdir(D_DIR) if f_name.endswith('txt')]
-        dark_dict_list = []
-        for d in dark_dict_name:
-            dark_dict_list.append(os.path.join(D_DIR,d))
-        if not dark_dict_list:
-            print('There is not dark dictionary in dark_base. Pleas run get_dark_images() again to build dark_base')
-            return
-        last_dark_dict = sorted(dark_dict_list, key = os.path.getmtime) # find the lastest dark_dict
-        rv = last_dark_dict[-1]
-        print(rv)
-        with open(rv) as f:
-            read_dict = json.load(f)
-        #print(read_dict)
-    else:
-        dark_header = db[str(dark_uid)]
-
     # iterate over header(s)
     for header in header_list:
-        print('Plotting and saving your image(s) now....')
-        # get images and exposure time from headers
         try:
-            img_field =[el for el in header.descriptors[0]['data_keys'] if el.endswith('_image_lightfield')][0]
-            print('Images are pulling out from %s' % img_field)
-            light_imgs = np.array(get_images(header,img_field))
-        except IndexError:
-            uid = header.start.uid
-            print('This header with uid = %s does not contain any image' % uid)
-            print('Was area detector correctly mounted then?')
+            _save_header(header, tif_name, sum_frames, dark_uid, dark_correct, plot, thumbnail,
+                    stack_format, frame_tifs, integrate, corrections, flat_field, combine, mask_bad_pixels)
+        except RuntimeError as e:
+            print(e)
             print('Stop saving')
             return
-        
-        header_events = list(get_events(header))
+        print('||********Saving process SUCCEEDED********||')
 
-        # get events from header
-        cnt_time = find_cnt_time(header)
-        print('cnt_time = %s' % cnt_time)
-        
-        
-        # container for final image, corrected or not
-        correct_imgs = []
-
-        if dark_correct:
-            dark_uid = read_dict[str(cnt_time)]
-            print('dark header used to correct image is %s: ' % dark_uid)
-            dark_header = db[str(dark_uid)]
-            print('dark_cnt_time = %s' % find_cnt_time(dark_header))
-            # dark correction
-            dark_img_field =[el for el in dark_header.descriptors[0]['data_keys'] if el.endswith('_image_lightfield')][0]
-            dark_img_list = np.array(get_images(dark_header,dark_img_field)) # confirmed that it comes with reverse order
-            dark_amount = dark_img_list[-1]
-
-            for i in range(light_imgs.shape[0]):
-                dummy = (light_imgs[i]-dark_amount)
-                correct_imgs.append(dummy)
-        else:
-            for i in range(light_imgs.shape[0]):
-                dummy = light_imgs[i] # raw image, no correction
-                correct_imgs.append(dummy)
-            
-        scan_type = header.start.scan_type
-        if scan_type != 'Count':
-            sum_frames = False
-        else:
-            pass
 
-        if sum_frames:
-            if not tif_name:
-                header_uid = header.start.uid[:5]
-                time_stub = _timestampstr(header.stop.time)
-                feature = feature_gen(header)
-                if dark_correct:
-                    f_name ='_'.join([time_stub, header_uid, feature+ '.tif'])
-                else:
-                    f_name = '_'.join([time_stub, header_uid, feature, 'raw.tif'])
-            else:
-                f_name = tif_name
-            w_name = os.path.join(W_DIR,f_name)
-            img = np.sum(correct_imgs,0)/len(correct_imgs)
-            #if np.isnan(img).any():
-                #print('we have nan in summed img')
-            #else:
-                #print('we do not have nan in summed img')
-                #pass
-            try:
-                fig = plt.figure(f_name)
-                plt.imshow(img)
-                plt.show()
-            except TypeError:
-                print('This is a squashed tif')
-            imsave(w_name, img) # overwrite mode now !!!!
-            if os.path.isfile(w_name):
-                print('dark corrected image "%s" has been saved at "%s"' % (f_name, W_DIR))
-            else:
-                print('Sorry, something went wrong with your tif saving')
-                return
+def save_tif_batch(headers, workers = 4, max_inflight = None, **kwargs):
+    ''' save many headers as tiff files in parallel worker processes.
 
-        else:
-            if scan_type == 'Count':  #fixme: is Count the only one doesn't move motor?
-                for i in range(len(header_events)):
-                    if not tif_name:
-                        header_uid = header.start.uid[:5]
-                        time_stub =_timestampstr(header_events[i]['timestamps'][img_field])
-                        feature = feature_gen(header)
-                        
-                        if dark_correct:
-                            f_name ='_'.join([time_stub, header_uid, feature, '00'+str(i)+'.tif'])
-                        else:
-                            f_name ='_'.join([time_stub, header_uid, feature, '00'+str(i), 'raw.tif'])
-                    else:
-                        f_name = tif_name + '_00' + str(i) +'.tif'
-                    w_name = os.path.join(W_DIR,f_name)
-                    img = correct_imgs[i]
-                    if np.isnan(img).any():
-                        print('we have nan in indivisual img')
-                    else:
-                        print('we do not have nan in indivisual img')
-                        pass
-                    if len(correct_imgs) <5:
-                        try:
-                            fig = plt.figure(f_name)
-                            plt.imshow(img)
-                            plt.show()
-                        except TypeError:
-                            pass
-                    else:
-                        #print('There are more than 5 images in this header, will not plot now for saving computation resource/')
-                        #print('You can view these images after they are saved')
-                        pass
-                    
-                    imsave(w_name, img) # overwrite mode now !!!!
-                    if os.path.isfile(w_name):
-                        print('dark corrected %s has been saved at %s' % (f_name, W_DIR))
-                    else:
-                        print('Sorry, something went wrong with your tif saving')
-                        return
+    Headers are handed out to a pool of processes, at most max_inflight at a
+    time so that memory stays bounded, and each worker reads, reduces and
+    writes its header independently of the others. A failed header does not
+    stop the batch.
 
+    arguments:
+        headers - list - header objects or uids, e.g., results of time_search or search
+        workers - int - optional. number of worker processes
+        max_inflight - int - optional. maximum number of headers queued at once. Default is twice the number of workers
+        kwargs - optional. sum_frames, dark_uid, dark_correct, thumbnail, stack_format, frame_tifs, integrate, corrections,
+                 flat_field, combine or mask_bad_pixels, as in save_tif. Workers never plot.
+
+    Returns a list of dictionaries, one per header, with keys 'uid', 'status'
+    ('saved' or 'failed'), 'files', 'error' and 'seconds'.
+    '''
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    if 'tif_name' in kwargs:
+        raise ValueError('tif_name would be shared by all headers, let save_tif_batch generate file names')
+    kwargs['plot'] = False
+    uids = [h if isinstance(h, str) else h.start.uid for h in headers]
+    if max_inflight is None:
+        max_inflight = 2 * workers
+
+    report = []
+    uid_iter = iter(uids)
+    with ProcessPoolExecutor(workers) as executor:
+        pending = set()
+        while True:
+            for uid in uid_iter:
+                pending.add(executor.submit(_save_tif_worker, uid, kwargs))
+                if len(pending) >= max_inflight:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                rv = future.result()
+                report.append(rv)
+                print('%s %s (%i/%i)' % (rv['uid'][:5], rv['status'], len(report), len(uids)))
+
+    failed = [rv for rv in report if rv['status'] != 'saved']
+    print('%i of %i headers saved, %i failed' % (len(report) - len(failed), len(uids), len(failed)))
+    return report
+
+
+def _save_tif_worker(uid, kwargs):
+    '''Save one header in a worker process and return its report entry.'''
+    t0 = time.time()
+    rv = {'uid' : uid, 'status' : 'saved', 'files' : [], 'error' : ''}
+    try:
+        header = db[uid]
+        rv['files'] = _save_header(header, **kwargs)
+        wait_thumbnails()
+    except Exception as e:
+        rv['status'] = 'failed'
+        rv['error'] = '%s: %s' % (type(e).__name__, e)
+    rv['seconds'] = time.time() - t0
+    return rv
 
-            else:
-                print('This is a motor scan, frames will be saved seperately..')
-                # is a motor scan now, get motor name
-                motor_name = eval(header.start.motor).name
-                motor_series = get_motor(header,motor_name)
-                for i in range(len(header_events)): # length of light images should be as long as temp series
-                    if not tif_name:
-                        header_uid = header.start.uid[:5]
-                        time_stub =_timestampstr(header_events[i]['timestamps'][img_field])
-                        feature = feature_gen(header)
-                        motor_step = str(motor_series[i])
-
-                        if dark_correct:
-                            f_name ='_'.join([time_stub, header_uid, feature, motor_step, '00'+str(i)+'.tif'])
-                        else:
-                            f_name ='_'.join([time_stub, header_uid, feature, motor_step, '00'+str(i), 'raw.tif'])
-                    else:
-                        f_name ='_'.join([tif_name, motor_step, '00'+str(i)+'.tif'])
-                        
-                    w_name = os.path.join(W_DIR,f_name)
-                    img = correct_imgs[i]
-                    if len(correct_imgs)<5:
-                        try:
-                            fig = plt.figure(f_name)
-                            plt.imshow(img)
-                            plt.show()
-                        except TypeError:
-                            pass
-                    else:
-                        #print('There are more than 5 images in this header, will not plot now for saving computation resource/')
-                        #print('You can view these images after they are saved')
-                        pass
-                    imsave(w_name, img) # overwrite mode now !!!!
-                    if os.path.isfile(w_name):
-                        print('dark corrected %s has been saved at %s' % (f_name, W_DIR))
-                    else:
-                        print('Sorry, something went wrong with your tif saving')
-                        return
 
-        
-        # write config data
-        print('Writing config file used in header....')
-        f_name = None # clear value and re-assign it as we don't need to save multiple files
-        #f_name = '_'.join([time_stub, uid, feature+'.cfg'])
-        f_name = filename_gen(header) + '.cfg'
-        config_f_name = '_'.join(['config', f_name])
-        config_w_name = os.path.join(W_DIR, config_f_name)
+def _display_available():
+    '''Return False on nodes without a display, where figures cannot be shown.'''
+    if os.name == 'posix' and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+        import sys
+        return sys.platform == 'darwin'
+    return True
+
+
+# names of preview figures still open, oldest first
+_preview_figures = []
+MAX_PREVIEW_FIGURES = 5
+
+# background jobs writing png thumbnails
+_thumbnail_executor = None
+_thumbnail_jobs = []
+
+def _preview(f_name, w_name, img, plot = True, thumbnail = False):
+    '''Show and/or write a downsampled preview of a saved image.
+
+    Only the MAX_PREVIEW_FIGURES most recent figures are kept open.
+    Thumbnails are written in a background thread.
+    '''
+    global _thumbnail_executor
+    if not (plot or thumbnail):
+        return
+    if plot:
+        import matplotlib.pyplot as plt
+    thumb = downsample(img)
+    if thumbnail:
+        from concurrent.futures import ThreadPoolExecutor
+        if _thumbnail_executor is None:
+            _thumbnail_executor = ThreadPoolExecutor(1)
+        t_name = os.path.splitext(w_name)[0] + '_thumb.png'
+        _thumbnail_jobs.append(_thumbnail_executor.submit(_write_thumbnail, t_name, thumb))
+    if plot:
         try:
-            config_dict = header.start['calibration_scan_info']['calibration_information']['config_data']
-            if isinstance(config_dict, dict):
-                pass
+            plt.figure(f_name)
+            plt.imshow(thumb)
+            plt.show()
+        except TypeError:
+            print('This is a squashed tif')
+            return
+        if f_name in _preview_figures:
+            _preview_figures.remove(f_name)
+        _preview_figures.append(f_name)
+        while len(_preview_figures) > MAX_PREVIEW_FIGURES:
+            plt.close(_preview_figures.pop(0))
+    return
+
+
+def _write_thumbnail(t_name, thumb):
+    '''Write thumb as png without pyplot, so it is safe in a background thread.'''
+    from matplotlib.image import imsave as imsave_png
+    vmin, vmax = np.percentile(thumb, [1, 99])
+    imsave_png(t_name, thumb, vmin = vmin, vmax = vmax, cmap = 'gray')
+    return t_name
+
+
+def wait_thumbnails():
+    '''Block until all pending thumbnails are written and return their file names.'''
+    rv = [job.result() for job in _thumbnail_jobs]
+    del _thumbnail_jobs[:]
+    return rv
+
+
+def _motor_name(header):
+    '''Return the name of the motor scanned in header.'''
+    motor = header.start.motor
+    try:
+        return _bluesky_device(motor).name
+    except RuntimeError:
+        return motor # already the name, e.g., 'cs700'
+
+
+def _write_tif(w_name, img):
+    '''Write img to w_name and raise RuntimeError if the file did not appear.'''
+    from tifffile import imsave
+    imsave(w_name, img) # overwrite mode now !!!!
+    if not os.path.isfile(w_name):
+        raise RuntimeError('Sorry, something went wrong with your tif saving')
+    print('dark corrected %s has been saved at %s' % (os.path.basename(w_name), W_DIR))
+    return w_name
+
+
+def _frame_tif_name(header, tif_name, dark_correct, i, timestamp, motor_step = None):
+    '''Return the tif file name of frame i of a header, or run start document, saved frame by frame.'''
+    parts = []
+    if not tif_name:
+        parts += [_timestampstr(timestamp), _start_doc(header)['uid'][:5], feature_gen(header)]
+    else:
+        parts.append(tif_name)
+    if motor_step is not None:
+        parts.append(str(motor_step))
+    parts.append('00'+str(i))
+    if not tif_name and not dark_correct:
+        parts.append('raw')
+    return '_'.join(parts) + '.tif'
+
+
+def _calibration_config(header):
+    '''Return the calibration config data recorded in a header or run start document.
+
+    Raises RuntimeError when the run was collected without calibration.
+    '''
+    try:
+        config_data = _start_doc(header)['calibration_scan_info']['calibration_information']['config_data']
+    except KeyError:
+        config_data = None
+    if not isinstance(config_data, dict):
+        raise RuntimeError('Run with uid = %s has no calibration to integrate its images. '
+                'Use load_calibration() before collecting data' % _start_doc(header)['uid'])
+    return config_data
+
+
+def _image_shape(light_imgs):
+    '''Return (rows, columns) of the first frame, descriptor shapes do not follow one axis order.'''
+    return tuple(np.shape(light_imgs[0])[-2:])
+
+
+def _write_chi(header, tif_w_name, img, config_data, space = True, mask = None):
+    '''write the integrated pattern of img next to the tif file tif_w_name and return its path.'''
+    integ = integrator(config_data, img.shape, None if space is True else space, mask = mask)
+    chi_w_name = os.path.splitext(tif_w_name)[0] + '.chi'
+    return integ.write(chi_w_name, img, ['uid = %s' % _start_doc(header)['uid'], 'image = %s' % os.path.basename(tif_w_name)])
+
+
+def _write_run_info(header, reduction = None):
+    '''write config and metadata files of a header, or run start document.
+
+    reduction is an optional dictionary of reduction statistics added to the metadata file.
+    Returns a list of written files.
+    '''
+    written = []
+    print('Writing config file used in header....')
+    f_name = filename_gen(header) + '.cfg'
+    config_f_name = '_'.join(['config', f_name])
+    config_w_name = os.path.join(W_DIR, config_f_name)
+    try:
+        config_dict = _start_doc(header)['calibration_scan_info']['calibration_information']['config_data']
+        if not isinstance(config_dict, dict):
+            raise RuntimeError('Your config data is not a dictionary, please make sure you load your config file properly. '
+                    'User load_calibration() and then try again.')
+        write_config(config_dict, config_w_name)
+        if os.path.isfile(config_w_name):
+            print('%s has been saved at %s' % (config_f_name, W_DIR))
+            written.append(config_w_name)
+    except KeyError:
+        print('It seems there is no config data in your metadata dictioanry or it is at wrong dictionary')
+        print('User load_calibration() and then try again.')
+
+    print('Writing metadata stored in header....')
+    metadata = dict((k, v) for k, v in _start_doc(header).items() if k != 'calibration_scan_info')
+    if reduction is not None:
+        metadata['reduction'] = reduction
+    md_f_name = filename_gen(header)+'.txt'
+    md_w_name = os.path.join(W_DIR, md_f_name)
+    with open(md_w_name, 'w') as f:
+        json.dump(metadata, f, default = str)
+    if os.path.isfile(md_w_name):
+        print('%s has been saved at %s' % (md_f_name, W_DIR))
+        written.append(md_w_name)
+    else:
+        print('Something went wrong when saving your metadata locally. Do not worry, it is still saved remotely in centralized filestore')
+    return written
+
+
+def _save_header(header, tif_name = False, sum_frames = True, dark_uid = False, dark_correct = True,
+        plot = True, thumbnail = False, stack_format = None, frame_tifs = None, integrate = False,
+        corrections = False, flat_field = None, combine = 'sigma_clip', mask_bad_pixels = False):
+    ''' save images of a single header as tiff files.
+
+    Arguments are the same as in save_tif.  Returns a list of written files
+    and raises RuntimeError when the header cannot be saved.
+    '''
+    print('Plotting and saving your image(s) now....')
+    plot = plot and _display_available()
+    written = []
+    # get images and exposure time from headers
+    try:
+        img_field =[el for el in header.descriptors[0]['data_keys'] if el.endswith('_image_lightfield')][0]
+    except IndexError:
+        uid = header.start.uid
+        raise RuntimeError('This header with uid = %s does not contain any image. '
+                'Was area detector correctly mounted then?' % uid)
+    print('Images are pulling out from %s' % img_field)
+    light_imgs = get_images(header,img_field) # lazy, frames are read one at a time
+    config_data = _calibration_config(header) if integrate or corrections else None
+    # polarization, solid angle and flat field as a single per-pixel factor
+    scale = None
+    if corrections:
+        scale = correction_factor(config_data, _image_shape(light_imgs), flat_field)
+
+    scan_type = header.start.scan_type
+    # exposure time and frame timestamps without reading the images
+    cnt_time = find_cnt_time(header)
+    print('cnt_time = %s' % cnt_time)
+
+    # dark frame used for correction, None means raw images
+    dark_amount = None
+    if not dark_uid:
+        dark_uid = _run_dark_uid(header, cnt_time)
+    if dark_correct:
+        detector = img_field[:-len('_image_lightfield')]
+        dark_amount = get_dark_frame(cnt_time, dark_uid, detector)
+        if dark_amount is None:
+            raise RuntimeError('No dark frame with cnt_time = %s to correct uid = %s' % (cnt_time, header.start.uid))
+    mask = None
+    if dark_correct and mask_bad_pixels:
+        mask = get_bad_pixel_mask(cnt_time, dark_uid, detector)
+    reduction = {'method' : combine if sum_frames and scan_type == 'Count' else 'frames', 'frames' : 0,
+            'rejected' : 0, 'nonfinite' : 0, 'masked' : 0 if mask is None else int(np.count_nonzero(mask))}
+
+    if scan_type != 'Count':
+        sum_frames = False
+
+    if not sum_frames:
+        frame_times = runinfo.timestamps(header, img_field)
+
+    if sum_frames:
+        if not tif_name:
+            header_uid = header.start.uid[:5]
+            time_stub = _timestampstr(header.stop.time)
+            feature = feature_gen(header)
+            if dark_correct:
+                f_name ='_'.join([time_stub, header_uid, feature+ '.tif'])
             else:
-                print('Your config data is not a dictionary, please make sure you load your config file properly')
-                print('User load_calibration() and then try again.')
-                print('Stop saving')
-                return
-            write_config(config_dict, config_w_name)
-            if os.path.isfile(config_w_name):
-                print('%s has been saved at %s' % (config_f_name, W_DIR))
-        except KeyError:
-            print('It seems there is no config data in your metadata dictioanry or it is at wrong dictionary')
-            print('User load_calibration() and then try again.')
-
-        print('Writing metadata stored in header....')
-        metadata = [ info for info in gs.RE.md if info != 'calibration_scan_info']
-        md_f_name = filename_gen(header)+'.txt'
-        md_w_name = os.path.join(W_DIR, md_f_name)
-        with open(md_w_name, 'w') as f:
-            json.dump(metadata, f)
-        if os.path.isfile(md_w_name):
-                print('%s has been saved at %s' % (md_f_name, W_DIR))
+                f_name = '_'.join([time_stub, header_uid, feature, 'raw.tif'])
         else:
-            print('Something went wrong when saving your metadata locally. Do not worry, it is still saved remotely in centralized filestore')
-        
-        print('||********Saving process SUCCEEDED********||')
+            f_name = tif_name
+        w_name = os.path.join(W_DIR,f_name)
+        img, acc = combine_frames(light_imgs, dark_amount, scale, combine)
+        reduction['frames'] = acc.count
+        reduction['rejected'] = getattr(acc, 'rejected', 0)
+        reduction['nonfinite'] = getattr(acc, 'nonfinite', 0)
+        apply_mask(img, mask)
+        written.append(_write_tif(w_name, img))
+        if integrate:
+            written.append(_write_chi(header, w_name, img, config_data, integrate, mask))
+        _preview(f_name, w_name, img, plot, thumbnail)
+
+    else:
+        motor_name = None
+        motor_series = None
+        if scan_type != 'Count':  #fixme: is Count the only one doesn't move motor?
+            print('This is a motor scan, frames will be saved seperately..')
+            # is a motor scan now, get motor name
+            motor_name = _motor_name(header)
+            motor_series = get_motor(header,motor_name)
+        if frame_tifs is None:
+            frame_tifs = not stack_format
+        stack = None
+        if stack_format:
+            s_name = filename_gen(header) + ('' if dark_correct else '_raw') + '_stack'
+            attrs = {'uid' : header.start.uid, 'scan_type' : scan_type, 'acquire_time' : cnt_time,
+                    'dark_corrected' : bool(dark_correct)}
+            stack = open_stack(os.path.join(W_DIR, s_name), stack_format, motor = motor_name, attrs = attrs,
+                    append = False)
+        try:
+            for i, img in enumerate(corrected_frames(light_imgs, dark_amount, scale = scale)): # length of light images should be as long as temp series
+                motor_step = None if motor_series is None else motor_series[i]
+                reduction['frames'] += 1
+                reduction['nonfinite'] += int(img.size - np.count_nonzero(np.isfinite(img)))
+                apply_mask(img, mask)
+                if stack is not None:
+                    stack.append(img, frame_times[i], motor_step)
+                if not (frame_tifs or integrate):
+                    continue
+                f_name = _frame_tif_name(header, tif_name, dark_correct, i, frame_times[i], motor_step)
+                w_name = os.path.join(W_DIR,f_name)
+                if integrate:
+                    written.append(_write_chi(header, w_name, img, config_data, integrate, mask))
+                if not frame_tifs:
+                    continue
+                written.append(_write_tif(w_name, img))
+                _preview(f_name, w_name, img, plot and len(frame_times) < 5, thumbnail)
+        finally:
+            if stack is not None:
+                stack.close()
+        if stack is not None:
+            print('%i frames have been saved in %s' % (len(frame_times), stack.path))
+            written.append(stack.path)
+
+    if reduction['rejected'] or reduction['nonfinite'] or reduction['masked']:
+        print('%(rejected)i outlier pixel values rejected, %(nonfinite)i NaN or infinite pixel values, '
+                '%(masked)i bad pixels masked' % reduction)
+    written += _write_run_info(header, reduction)
+    catalog = run_catalog()
+    catalog.record_reduction(header.start.uid, **reduction)
+    catalog.add_files(header.start.uid, written)
+    return written
 
 # Holding place
     #print(str(check_output(['ls', '-1t', '|', 'head', '-n', '10'], shell=True)).replace('\\n', '\n'))